@@ -19,3 +19,32 @@ class DkpSpecialAwardSerializer(serializers.ModelSerializer):
         model = models.DkpSpecialAward
         fields = ('character', 'value', 'attendance_value', 'time', 'notes')
 
+
+class CharacterProfileSerializer(serializers.ModelSerializer):
+    name = serializers.CharField(source='character_id')
+    alts = serializers.ListField(source='alt_names', child=serializers.CharField())
+    days_since_raid = serializers.IntegerField()
+
+    class Meta:
+        model = models.CharacterProfile
+        fields = ('name', 'character_class', 'rank', 'alts', 'main_dkp', 'alt_dkp',
+                  'attendance_30', 'last_raid', 'days_since_raid')
+
+
+class StandingSerializer(serializers.Serializer):
+    """ one character's line in the standings, from ledger.standings().
+    pass fields to keep only some of them. """
+    name = serializers.CharField()
+    character_class = serializers.CharField()
+    status = serializers.CharField()
+    rank = serializers.CharField(source='display_rank')
+    main_dkp = serializers.IntegerField()
+    alt_dkp = serializers.IntegerField()
+    attendance_30 = serializers.FloatField(source='attendance')
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
@@ -1,9 +1,17 @@
 from rest_framework.test import APIRequestFactory, force_authenticate
 from django.contrib.auth.models import User
+from django.db import connection
+from django.core.management import call_command
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from padkp_show.models import Character, RaidDump, CharacterAlt, Purchase, Auction, AuctionBid
+from padkp_show.models import CasualCharacter, CharacterBalance
+from padkp_show.ledger import generation
+from padkp_show.querybudget import QueryBudgetTestMixin
 from django.utils import timezone
 from django.urls import resolve
+import contextlib
+import io
 import json
 import hashlib
 import datetime as dt
@@ -155,6 +163,29 @@ class CorrectAuctionTests(TestCase):
         self.assertEqual(auction, purchase.auction)
         self.assertTrue(auction.corrected)
 
+    def test_correction_with_unknown_character_changes_nothing(self):
+        bids = [{'name': 'Lancegar', 'bid': '7', 'tag': ''},
+                {'name': 'Quaff', 'bid': '6', 'tag': ''}]
+        time = dt.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        rdata = {'bids': bids, 'item_count': 1, 'item_name': 'Test Item',
+                 'fingerprint': 'testfingerprint', 'time': time, 'auction_type': 'english'}
+        factory = APIRequestFactory()
+        request = factory.post('/api/resolve_auction/', rdata, format='json')
+        force_authenticate(request, user=self.user)
+        resolve(request.get_full_path()).func(request).render()
+
+        rdata = {'bids': [{'name': 'Quaff', 'bid': '6'}, {'name': 'Nobody', 'bid': '7'}],
+                 'fingerprint': 'testfingerprint'}
+        request = factory.post('/api/correct_auction/', rdata, format='json')
+        force_authenticate(request, user=self.user)
+        response = resolve(request.get_full_path()).func(request)
+        response.render()
+
+        self.assertEqual(response.status_code, 400)
+        lance, = Character.objects.filter(name='Lancegar')
+        self.assertEqual(lance.current_dkp(), 13)
+        self.assertFalse(Auction.objects.get(fingerprint='testfingerprint').corrected)
+
 
 class CancelAuctionTests(TestCase):
 
@@ -1560,3 +1591,389 @@ class ResolveFlagsTests(TestCase):
 
 
 # %%
+
+
+class QueryBudgetTests(QueryBudgetTestMixin, TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='robert', email='robert@…', password='top_secret')
+        self.characters = [Character.objects.create(name='Char{}'.format(i), status='MN')
+                           for i in range(10)]
+        dump = RaidDump(value=20, attendance_value=1, time=timezone.now())
+        dump.save()
+        dump.characters_present.set(self.characters)
+
+    def post(self, url, rdata):
+        factory = APIRequestFactory()
+        request = factory.post(url, rdata, format='json')
+        view = resolve(request.get_full_path()).func
+        force_authenticate(request, user=self.user)
+        response = view(request)
+        response.render()
+        self.assertLess(response.status_code, 300, response.content)
+        return response
+
+    def test_resolve_auction(self):
+        bids = [{'name': c.name, 'bid': str(i + 1), 'tag': ''}
+                for i, c in enumerate(self.characters)]
+        time = dt.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        rdata = {'bids': bids, 'item_count': 1, 'item_name': 'Test Item',
+                 'fingerprint': 'testfingerprint', 'time': time}
+        # the bidders are looked up together, the count does not grow with the bids
+        self.assertMaxQueries(35, self.post, '/api/resolve_auction/', rdata)
+
+    def test_upload_raid_dump(self):
+        contents = '\n'.join('1\t{}\t60\tWarrior\t\t\t\tYes\t'.format(c.name)
+                             for c in self.characters)
+        rdata = {'dump_contents': contents, 'value': 2, 'counts_for_attendance': True,
+                 'filename': 'RaidRoster_mangler-20210101-200000.txt',
+                 'time': dt.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                 'notes': '', 'award_type': 'Time'}
+        # including the savepoints that keep the dump and its refresh atomic
+        self.assertMaxQueries(45, self.post, '/api/upload_dump/', rdata)
+
+    def test_upload_casual_raid_dump(self):
+        casual = [CasualCharacter.objects.create(name='Casual{}'.format(i), character_class='Bard')
+                  for i in range(10)]
+        contents = '\n'.join('1\t{}\t60\tBard\t\t\t\tYes\t'.format(c.name) for c in casual)
+        rdata = {'dump_contents': contents, 'value': 2,
+                 'filename': 'RaidRoster_mangler-20210101-200000.txt',
+                 'time': dt.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'), 'notes': ''}
+        self.assertMaxQueries(25, self.post, '/api/upload_casual_dump/', rdata)
+        self.assertEqual(casual[0].current_dkp(), 2)
+
+
+class CharacterHistoryTests(TestCase):
+
+    def setUp(self):
+        char1 = Character.objects.create(name='Lancegar', status='MN')
+        for i in range(3):
+            dump = RaidDump(value=10, attendance_value=1,
+                            time=timezone.now() - dt.timedelta(days=i))
+            dump.save()
+            dump.characters_present.set([char1])
+
+    def test_history_pages(self):
+        response = self.client.get('/api/characters/Lancegar/history/?limit=2')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(len(data['results']), 2)
+        response = self.client.get('/api/characters/Lancegar/history/',
+                                   {'limit': 2, 'before': data['next']})
+        data = response.json()
+        self.assertEqual(len(data['results']), 1)
+        self.assertIsNone(data['next'])
+
+    def test_summary(self):
+        response = self.client.get('/api/characters/Lancegar/summary/')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['main_dkp'], 30)
+        self.assertEqual(data['alts'], [])
+        self.assertEqual(data['days_since_raid'], 0)
+        self.assertEqual(self.client.get('/api/characters/Nobody/summary/').status_code, 404)
+
+    def test_bad_requests(self):
+        response = self.client.get('/api/characters/Lancegar/history/?before=1.2')
+        self.assertEqual(response.status_code, 400)
+        for cursor in ('99999999999999999999.0.1', '-99999999999999999999.0.1', '0.0.99999999999999999999'):
+            response = self.client.get('/api/characters/Lancegar/history/?before=' + cursor)
+            self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/characters/Nobody/history/')
+        self.assertEqual(response.status_code, 404)
+
+
+class StandingsTests(QueryBudgetTestMixin, TestCase):
+
+    def setUp(self):
+        self.characters = [Character.objects.create(name='Char{}'.format(i), status='MN',
+                                                    character_class='Bard')
+                           for i in range(20)]
+        dump = RaidDump(value=10, attendance_value=1, time=timezone.now())
+        dump.save()
+        dump.characters_present.set(self.characters[:10])
+        Purchase(character=self.characters[0], item_name='Shiny', value=4,
+                 time=timezone.now(), is_alt=True).save()
+
+    def test_standings(self):
+        # the first request stores the balances of the characters without any
+        self.client.get('/api/standings/')
+        self.characters[1].give_bonus(0, 'nothing', dry_run=False)
+        # the generation, the standings and the available attendance points
+        response = self.assertMaxQueries(3, self.client.get, '/api/standings/')
+        data = response.json()
+        self.assertEqual(len(data), 20)
+        self.assertEqual(data[0], {'name': 'Char0', 'character_class': 'Bard', 'status': 'MN',
+                                   'rank': 'Main', 'main_dkp': 10, 'alt_dkp': 6,
+                                   'attendance_30': 100.0})
+        self.assertEqual({c['name']: c['attendance_30'] for c in data}['Char19'], 0.0)
+
+    def test_field_selection_and_detail(self):
+        data = self.client.get('/api/standings/?fields=name,main_dkp').json()
+        self.assertEqual(data[1], {'name': 'Char1', 'main_dkp': 10})
+        data = self.client.get('/api/standings/char0/?fields=alt_dkp').json()
+        self.assertEqual(data, {'alt_dkp': 6})
+        self.assertEqual(self.client.get('/api/standings/?fields=name,bogus').status_code, 400)
+        self.assertEqual(self.client.get('/api/standings/Nobody/').status_code, 404)
+
+    def test_etag_and_gzip(self):
+        response = self.client.get('/api/standings/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        etag = response['ETag']
+        # polling with the etag is answered without touching the ledger
+        response = self.assertMaxQueries(1, self.client.get, '/api/standings/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.characters[1].give_bonus(5, 'bonus', dry_run=False)
+        response = self.client.get('/api/standings/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[1]['main_dkp'], 15)
+
+
+class ResolveAuctionRetryTests(QueryBudgetTestMixin, TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='robert', email='robert@…', password='top_secret')
+        self.characters = [Character.objects.create(name=name, status='MN')
+                           for name in ('Lancegar', 'Quaff')]
+        dump = RaidDump(value=20, attendance_value=1, time=timezone.now())
+        dump.save()
+        dump.characters_present.set(self.characters)
+        self.rdata = {'bids': [{'name': 'Lancegar', 'bid': '7', 'tag': ''},
+                               {'name': 'Quaff', 'bid': '30', 'tag': ''}],
+                      'item_count': 1, 'item_name': 'Test Item', 'fingerprint': 'retried',
+                      'time': dt.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')}
+
+    def post(self, rdata):
+        factory = APIRequestFactory()
+        request = factory.post('/api/resolve_auction/', rdata, format='json')
+        view = resolve(request.get_full_path()).func
+        force_authenticate(request, user=self.user)
+        response = view(request)
+        response.render()
+        return response
+
+    def test_retry_returns_stored_reply(self):
+        first = self.post(self.rdata)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.data['message'], 'Test Item awarded to - Quaff for 8*')
+        self.assertEqual(first.data['warnings'], ['Quaff bid 30 dkp but only has 20 on the site'])
+        retry = self.assertMaxQueries(1, self.post, self.rdata)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(Purchase.objects.count(), 1)
+        self.assertEqual(Auction.objects.get().message, first.data['message'])
+
+    def test_failed_resolution_leaves_nothing_behind(self):
+        self.rdata['bids'].append({'name': 'Quaff', 'bid': 'lots', 'tag': ''})
+        self.assertEqual(self.post(self.rdata).status_code, 400)
+        self.rdata['bids'].pop()
+        self.rdata['auction_type'] = 'dutch'
+        self.assertEqual(self.post(self.rdata).status_code, 400)
+        self.assertFalse(Auction.objects.exists())
+        self.assertFalse(Purchase.objects.exists())
+        # the client can try again with the same fingerprint
+        del self.rdata['auction_type']
+        self.assertEqual(self.post(self.rdata).status_code, 200)
+
+
+class ResolveAuctionsTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='robert', email='robert@…', password='top_secret')
+        characters = [Character.objects.create(name=name, status='MN') for name in ('Lancegar', 'Quaff')]
+        dump = RaidDump(value=20, attendance_value=1, time=timezone.now())
+        dump.save()
+        dump.characters_present.set(characters)
+
+    def auction(self, fingerprint, bids):
+        return {'fingerprint': fingerprint, 'item_name': fingerprint, 'item_count': 1,
+                'time': dt.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'bids': [{'name': name, 'bid': bid, 'tag': ''} for name, bid in bids]}
+
+    def post(self, auctions):
+        factory = APIRequestFactory()
+        request = factory.post('/api/resolve_auctions/', {'auctions': auctions}, format='json')
+        view = resolve(request.get_full_path()).func
+        force_authenticate(request, user=self.user)
+        response = view(request)
+        response.render()
+        return response
+
+    def test_spend_carries_forward(self):
+        auctions = [self.auction('First', [('Quaff', 15), ('Lancegar', 10)]),
+                    self.auction('Second', [('Quaff', 15), ('Lancegar', 3)])]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post(auctions)
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual([r['message'] for r in response.data['results']],
+                         ['First awarded to - Quaff for 11', 'Second awarded to - Quaff for 4*'])
+        self.assertEqual(response.data['results'][1]['warnings'],
+                         ['Quaff bid 15 dkp but only has 9 on the site'])
+        self.assertEqual(AuctionBid.objects.get(auction__fingerprint='Second', character='Quaff').dkp_snapshot, 9)
+        balance_reads = [q for q in queries.captured_queries
+                         if q['sql'].startswith('SELECT') and 'FROM "padkp_show_characterbalance"' in q['sql']]
+        self.assertEqual(len(balance_reads), 1)
+        # a retried batch gets the same replies back
+        self.assertEqual(self.post(auctions).data, response.data)
+        self.assertEqual(Purchase.objects.count(), 2)
+
+    def test_lookups_do_not_grow_with_the_batch(self):
+        def lookups(count):
+            auctions = [self.auction('Batch{}-{}'.format(count, number), [('Quaff', 1), ('Lancegar', 1)])
+                        for number in range(count)]
+            with CaptureQueriesContext(connection) as queries:
+                response = self.post(auctions)
+            self.assertEqual(response.status_code, 200, response.data)
+            # bidder names and balances are read once for the whole batch
+            return [len([q for q in queries.captured_queries if q['sql'].startswith('SELECT') and table in q['sql']])
+                    for table in ('JOIN "padkp_show_characteralt"', 'FROM "padkp_show_characterbalance"')]
+        self.assertEqual(lookups(5), lookups(1))
+        self.assertEqual(lookups(1), [1, 1])
+
+    def test_batch_is_all_or_nothing(self):
+        auctions = [self.auction('First', [('Quaff', 15)]),
+                    self.auction('Second', [('Quaff', 'lots')])]
+        self.assertEqual(self.post(auctions).status_code, 400)
+        self.assertFalse(Auction.objects.exists())
+        self.assertFalse(Purchase.objects.exists())
+
+
+class PreviewAuctionTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='robert', email='robert@…', password='top_secret')
+        characters = [Character.objects.create(name=name, status='MN')
+                      for name in ('Lancegar', 'Quaff', 'Quaff2')]
+        CharacterAlt.objects.create(name='Seped', main=characters[0])
+        dump = RaidDump(value=20, attendance_value=1, time=timezone.now())
+        dump.save()
+        dump.characters_present.set(characters)
+        self.rdata = {'item_count': 2, 'item_name': 'Test Item', 'fingerprint': 'preview',
+                      'time': dt.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                      'bids': [{'name': 'Quaff', 'bid': '12', 'tag': ''},
+                               {'name': 'Seped', 'bid': '25', 'tag': ''},
+                               {'name': 'Quaff2', 'bid': '6', 'tag': ''},
+                               {'name': 'Nobody', 'bid': '3', 'tag': ''}]}
+
+    def post(self, url, rdata):
+        factory = APIRequestFactory()
+        request = factory.post(url, json.loads(json.dumps(rdata)), format='json')
+        view = resolve(request.get_full_path()).func
+        force_authenticate(request, user=self.user)
+        response = view(request)
+        response.render()
+        return response
+
+    def test_preview_matches_resolution_without_writing(self):
+        CharacterBalance.objects.filter(character='Quaff2').delete()
+        before = generation()
+        with CaptureQueriesContext(connection) as queries:
+            preview = self.post('/api/preview_auction/', self.rdata)
+        self.assertEqual(preview.status_code, 200, preview.data)
+        self.assertTrue(all(q['sql'].startswith('SELECT') for q in queries.captured_queries))
+        self.assertEqual(generation(), before)
+        self.assertFalse(CharacterBalance.objects.filter(character='Quaff2').exists())
+        # the alt's bid counts as 5 against mains
+        self.assertEqual(preview.data['winners'], [{'name': 'Quaff', 'price': 6, 'tag': ''},
+                                                   {'name': 'Quaff2', 'price': 6, 'tag': ''}])
+        self.assertEqual(preview.data['tied'], [])
+
+        resolved = self.post('/api/resolve_auction/', self.rdata)
+        self.assertEqual(preview.data['message'], resolved.data['message'])
+        self.assertEqual(preview.data['warnings'], resolved.data['warnings'])
+
+    def test_bad_preview(self):
+        self.rdata['auction_type'] = 'dutch'
+        self.assertEqual(self.post('/api/preview_auction/', self.rdata).status_code, 400)
+        del self.rdata['auction_type']
+        self.rdata['bids'][0]['bid'] = 'lots'
+        self.assertEqual(self.post('/api/preview_auction/', self.rdata).status_code, 400)
+
+
+class ReplayAuctionsTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='robert', email='robert@…', password='top_secret')
+        self.characters = [Character.objects.create(name='Char{}'.format(i), status='MN')
+                           for i in range(8)]
+        dump = RaidDump(value=50, attendance_value=1, time=timezone.now())
+        dump.save()
+        dump.characters_present.set(self.characters)
+
+    def post(self, url, rdata):
+        factory = APIRequestFactory()
+        request = factory.post(url, json.loads(json.dumps(rdata)), format='json')
+        view = resolve(request.get_full_path()).func
+        force_authenticate(request, user=self.user)
+        response = view(request)
+        response.render()
+        self.assertEqual(response.status_code, 200, response.data)
+        return response
+
+    def auction(self, fingerprint, item_count=1):
+        # everyone bids the same, only the tiebreaker decides
+        return {'fingerprint': fingerprint, 'item_name': fingerprint, 'item_count': item_count,
+                'time': dt.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'bids': [{'name': c.name, 'bid': '10', 'tag': ''} for c in self.characters]}
+
+    def replay(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            call_command('replay_auctions')
+        lines = output.getvalue()
+        return json.loads(lines[lines.index('{'):]), lines
+
+    def test_ties_are_reproducible(self):
+        preview = self.post('/api/preview_auction/', self.auction('tied'))
+        self.assertEqual(len(preview.data['tied']), 7)
+        resolved = self.post('/api/resolve_auction/', self.auction('tied'))
+        self.assertEqual(preview.data['message'], resolved.data['message'])
+        names = [c.name for c in self.characters]
+        tiebreak = [self.post('/api/tiebreak/', {'characters': names, 'fingerprint': 'tied'}).data
+                    for _ in range(2)]
+        self.assertEqual(tiebreak[0], tiebreak[1])
+
+    def test_ties_without_fingerprint_are_random(self):
+        # the same bidders must not always lose their ties to each other
+        names = [c.name for c in self.characters]
+        orders = {tuple(name for name, _ in self.post('/api/tiebreak/', {'characters': names}).data)
+                  for _ in range(10)}
+        self.assertGreater(len(orders), 1)
+        flags = {self.post('/api/resolve_flags/', {'players': names, 'item_name': 'flag'}).data['message']
+                 for _ in range(10)}
+        self.assertGreater(len(flags), 1)
+
+    def test_replay_matches_recorded_purchases(self):
+        for number in range(3):
+            self.post('/api/resolve_auction/', self.auction('auction{}'.format(number), item_count=2))
+        summary, _ = self.replay()
+        self.assertEqual((summary['replayed'], summary['divergent']), (3, 0))
+
+        Purchase.objects.filter(auction__fingerprint='auction1').update(value=3)
+        self.post('/api/correct_auction/', {'fingerprint': 'auction2', 'bids': [{'name': 'Char0', 'bid': 1}]})
+        summary, lines = self.replay()
+        self.assertEqual((summary['replayed'], summary['skipped_corrected'], summary['divergent']), (2, 1, 1))
+        self.assertIn('auction1 on', lines)
+
+    def test_replay_uses_the_recorded_rules(self):
+        for auction_type in ('english', 'vickrey'):
+            data = self.auction(auction_type)
+            data['auction_type'] = auction_type
+            for number, bid in enumerate(data['bids']):
+                bid['bid'] = str(10 + 2 * number)
+            self.post('/api/resolve_auction/', data)
+        self.assertEqual(Auction.objects.get(fingerprint='english').auction_type, 'english')
+        summary, _ = self.replay()
+        self.assertEqual((summary['rules'], summary['replayed'], summary['divergent']), ('recorded', 2, 0))
+
+        # english charges the top bid, vickrey one more than the runner up
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            call_command('replay_auctions', rules='vickrey')
+        self.assertIn('english on', output.getvalue())
+        self.assertNotIn('vickrey on', output.getvalue())
@@ -5,12 +5,15 @@ from . import views
 router = routers.DefaultRouter()
 router.register(r'characters', views.CharacterViewSet)
 router.register(r'awards', views.DkpSpecialAwardViewSet)
+router.register(r'standings', views.Standings, basename='standings')
 router.register(r'upload_dump', views.UploadRaidDump)
 router.register(r'upload_casual_dump', views.UploadCasualRaidDump)
 router.register(r'charge_dkp', views.ChargeDKP)
 router.register(r'tiebreak', views.Tiebreak)
 router.register(r'second_class', views.SecondClassCitizens)
 router.register(r'resolve_auction', views.ResolveAuction, basename='api')
+router.register(r'resolve_auctions', views.ResolveAuctions, basename='api')
+router.register(r'preview_auction', views.PreviewAuction, basename='api')
 router.register(r'correct_auction', views.CorrectAuction, basename='api')
 router.register(r'cancel_auction', views.CancelAuction, basename='api')
 router.register(r'resolve_flags', views.ResolveFlags, basename='api')
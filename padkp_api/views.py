@@ -5,19 +5,25 @@ import datetime as dt
 import random
 import traceback
 
+from django.db import IntegrityError, transaction
 from django.db.models import Q
+from django.utils.decorators import method_decorator
+from django.views.decorators.gzip import gzip_page
 
 from rest_framework import viewsets, status
 from rest_framework.response import Response
 from rest_framework.decorators import action
 from rest_framework.authentication import TokenAuthentication, BasicAuthentication, SessionAuthentication
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import JSONRenderer
 from rest_framework.views import APIView
 
 from django.core.exceptions import ObjectDoesNotExist
 
 from . import serializers
 from padkp_show import models
+from padkp_show import auction_rules, ledger
+from padkp_show.pagecache import versioned_page
 
 
 def _parse_dump(dump_contents):
@@ -52,69 +58,190 @@ def _get_or_create_characters(chars, create=True):
     return result
 
 
+AUCTION_TYPES = ('vickrey', 'english')
+
+
+def _stored_reply(fingerprint):
+    """ the reply recorded for an already resolved auction, None if the
+    fingerprint is new. auctions resolved before replies were stored have an
+    empty message. """
+    auction = models.Auction.objects.filter(fingerprint=fingerprint).only('message', 'warnings').first()
+    if auction is None:
+        return None
+    return {'message': auction.message, 'warnings': auction.warning_list()}
+
+
+def _award_message(auc, tied, winning_bids, warnings):
+    """ the announcement for an auction's result """
+    winners = []
+    for winner in winning_bids:
+        char_name = winner['char'].name
+        if winner['tag'] == 'ALT':
+            char_name += "'s alt"
+        winners.append('{} for {}'.format(char_name, winner['bid']))
+    while len(winners) < auc.item_count:
+        winners.append('Rot')
+    if len(tied) == 0:
+        message = '{} awarded to - {}'.format(
+            auc.item_name, ', '.join(winners))
+    else:
+        tied.sort()
+        message = '{} awarded to - {} - {} Lost the random tiebreaker'.format(
+            auc.item_name, ', '.join(winners), ', '.join(tied))
+
+    if len(warnings) > 0:
+        message += "*"
+    return message
+
+
+def _resolve_auction(data, balances=None, found=None):
+    """ resolve one auction from its request data and return the reply. runs in
+    the caller's transaction.
+
+    balances is an optional ledger.bulk_balances() result the bid snapshots are
+    read from; the winners' purchases are charged against it so it can be
+    carried on to the next auction. found is an optional
+    Character.find_characters() result for the bid names.
+    """
+    item_name = data['item_name']
+    auction_type = data.get('auction_type', 'vickrey')
+    auc = models.Auction(fingerprint=data['fingerprint'], item_name=item_name,
+                         item_count=data.get('item_count', 1), time=data['time'],
+                         auction_type=auction_type)
+    auc.save()
+
+    warnings = auc.process_bids(data['bids'], balances, found)
+    if auction_type == 'vickrey':
+        tied, winning_bids = auc.determine_winners_vickrey()
+    else:
+        tied, winning_bids = auc.determine_winners_english()
+
+    winning_bids = list(winning_bids)
+    for winner in winning_bids:
+        models.Purchase(
+            character=winner['char'],
+            item_name=auc.item_name,
+            value=winner['bid'],
+            time=auc.time,
+            is_alt=winner['tag'] == 'ALT',
+            auction=auc
+        ).save()
+        char_name = winner['char'].name
+        if balances is not None and char_name in balances:
+            balances[char_name]['alt_dkp' if winner['tag'] == 'ALT' else 'main_dkp'] -= int(winner['bid'])
+
+    message = _award_message(auc, tied, winning_bids, warnings)
+    auc.message = message
+    auc.warnings = '\n'.join(warnings)
+    auc.save(update_fields=['message', 'warnings'])
+    return {
+        'message': message,
+        'warnings': warnings
+    }
+
+
 class ResolveAuction(viewsets.ViewSet):
-    """ submit a set of bids for resolution """
+    """ submit a set of bids for resolution. resolving is all or nothing, and
+    resubmitting a fingerprint returns the reply of the first resolution """
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
 
+    def _reply(self, reply):
+        if not reply['message']:
+            return Response('Auction with this fingerprint was already resolved',
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response(reply, status=status.HTTP_200_OK)
+
     def create(self, request):
         fingerprint = request.data['fingerprint']
-        bids = request.data['bids']
-        item_name = request.data['item_name']
-        item_count = request.data.get('item_count', 1)
-        time = request.data['time']
-        auction_type = request.data.get('auction_type', 'vickrey')
+        reply = _stored_reply(fingerprint)
+        if reply is not None:
+            return self._reply(reply)
+
+        if request.data.get('auction_type', 'vickrey') not in AUCTION_TYPES:
+            return Response("Invalid auction_type specified, valid options are vickrey, english.", status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            auc = models.Auction(fingerprint=fingerprint, item_name=item_name,
-                                 item_count=item_count, time=time)
-            auc.save()
+            with transaction.atomic():
+                result = _resolve_auction(request.data)
+        except IntegrityError:
+            # a retry of the same auction committed first
+            reply = _stored_reply(fingerprint)
+            if reply is not None:
+                return self._reply(reply)
+            return Response(traceback.format_exc(), status=status.HTTP_400_BAD_REQUEST)
+        except Exception:
+            return Response(traceback.format_exc(), status=status.HTTP_400_BAD_REQUEST)
+        return Response(result, status=status.HTTP_200_OK)
 
-            warnings = auc.process_bids(bids)
-            winners = []
-            tied, winning_bids = [1,1]
+
+class PreviewAuction(viewsets.ViewSet):
+    """ resolve a set of bids without recording anything and return who would
+    win at what price, the tie losers and the warnings. takes the same data as
+    ResolveAuction; the fingerprint and time are not needed """
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def create(self, request):
+        auction_type = request.data.get('auction_type', 'vickrey')
+        if auction_type not in AUCTION_TYPES:
+            return Response("Invalid auction_type specified, valid options are vickrey, english.", status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            # with the fingerprint, ties fall the way resolving would break them
+            auc = models.Auction(fingerprint=request.data.get('fingerprint', ''),
+                                 item_name=request.data['item_name'],
+                                 item_count=request.data.get('item_count', 1))
+            bids, warnings = auc.bid_rows(request.data['bids'], store=False)
             if auction_type == 'vickrey':
-                tied, winning_bids = auc.determine_winners_vickrey()
-            elif auction_type == 'english':
-                tied, winning_bids = auc.determine_winners_english()
+                tied, winning_bids = auc.determine_winners_vickrey(bids)
             else:
-                return Response("Invalid auction_type specified, valid options are vickrey, english.", status=status.HTTP_400_BAD_REQUEST)
+                tied, winning_bids = auc.determine_winners_english(bids)
+            winning_bids = list(winning_bids)
+        except Exception:
+            return Response(traceback.format_exc(), status=status.HTTP_400_BAD_REQUEST)
 
-            for winner in winning_bids:
-                models.Purchase(
-                    character=winner['char'],
-                    item_name=auc.item_name,
-                    value=winner['bid'],
-                    time=auc.time,
-                    is_alt=winner['tag'] == 'ALT',
-                    auction=auc
-                ).save()
-                char_name = winner['char'].name
-                if winner['tag'] == 'ALT':
-                    char_name += "'s alt"
-                winners.append('{} for {}'.format(char_name, winner['bid']))
-            while len(winners) < auc.item_count:
-                winners.append('Rot')
-            if len(tied) == 0:
-                message = '{} awarded to - {}'.format(
-                    item_name, ', '.join(winners))
-            else:
-                tied.sort()
-                message = '{} awarded to - {} - {} Lost the random tiebreaker'.format(
-                    item_name, ', '.join(winners), ', '.join(tied))
+        result = {
+            'message': _award_message(auc, tied, winning_bids, warnings),
+            'winners': [{'name': w['char'].name, 'price': w['bid'], 'tag': w['tag']} for w in winning_bids],
+            'tied': tied,
+            'warnings': warnings
+        }
+        return Response(result, status=status.HTTP_200_OK)
 
-            if len(warnings) > 0:
-                message += "*"
 
-            result = {
-                'message': message,
-                'warnings': warnings
-            }
-            return Response(result, status=status.HTTP_200_OK)
+class ResolveAuctions(viewsets.ViewSet):
+    """ submit several auctions, each shaped like a ResolveAuction request, to
+    resolve in order. the batch is all or nothing, and what a character wins in
+    one auction counts against their dkp in the later ones. """
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAuthenticated]
 
+    def create(self, request):
+        auctions = request.data['auctions']
+        for number, data in enumerate(auctions):
+            if data.get('auction_type', 'vickrey') not in AUCTION_TYPES:
+                return Response('Auction {}: invalid auction_type specified, valid options are vickrey, english.'.format(number),
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        replies = []
+        try:
+            with transaction.atomic():
+                # every bidder's balance is read once and carried through the batch
+                found = models.Character.find_characters(
+                    {bid['name'] for data in auctions for bid in data['bids']})
+                balances = ledger.bulk_balances({char.name for _, char in found.values() if char}, windows=(30,))
+                for number, data in enumerate(auctions):
+                    reply = _stored_reply(data['fingerprint'])
+                    if reply is None:
+                        reply = _resolve_auction(data, balances, found)
+                    elif not reply['message']:
+                        raise ValueError('Auction {} with this fingerprint was already resolved'.format(number))
+                    replies.append(reply)
         except Exception:
-            auc.delete()
             return Response(traceback.format_exc(), status=status.HTTP_400_BAD_REQUEST)
+        return Response({'results': replies}, status=status.HTTP_200_OK)
+
 
 class ResolveFlags(viewsets.ViewSet):
     """ submit a set of bids for resolution """
@@ -122,7 +249,7 @@ class ResolveFlags(viewsets.ViewSet):
     permission_classes = [IsAuthenticated]
 
     def create(self, request):
-        players = list(set(request.data['players']))
+        players = sorted(set(request.data['players']))
         item_name = request.data['item_name']
         item_count = request.data.get('item_count', 1)
 
@@ -139,10 +266,11 @@ class ResolveFlags(viewsets.ViewSet):
 
             winners = []
 
-            random.shuffle(characters)
+            _tie_rng(request.data.get('fingerprint')).shuffle(characters)
+            attendance = ledger.bulk_attendance(characters)
 
             def att30(char):
-                return char.attendance(30)
+                return attendance[char.name][30]
 
             ordered = sorted(characters, key=att30, reverse=True)
 
@@ -178,21 +306,26 @@ class CorrectAuction(viewsets.ViewSet):
         except ObjectDoesNotExist:
             return Response('Auction not found that matches fingerprint', status=status.HTTP_400_BAD_REQUEST)
 
-        models.Purchase.objects.filter(auction=auction).delete()
+        winners = []
         for bid in bids:
             is_alt, char = models.Character.find_character(bid['name'])
             if not char:
                 return Response('Could not find character:{}'.format(bid['name']), status=status.HTTP_400_BAD_REQUEST)
-            models.Purchase(
-                character=char,
-                item_name=auction.item_name,
-                value=bid['bid'],
-                time=auction.time,
-                is_alt=is_alt,
-                auction=auction
-            ).save()
-        auction.corrected = True
-        auction.save()
+            winners.append((is_alt, char, bid['bid']))
+
+        with transaction.atomic():
+            models.Purchase.objects.filter(auction=auction).delete()
+            for is_alt, char, value in winners:
+                models.Purchase(
+                    character=char,
+                    item_name=auction.item_name,
+                    value=value,
+                    time=auction.time,
+                    is_alt=is_alt,
+                    auction=auction
+                ).save()
+            auction.corrected = True
+            auction.save()
         return Response('Auction corrected', status=status.HTTP_200_OK)
 
 
@@ -213,8 +346,9 @@ class CancelAuction(viewsets.ViewSet):
         if dt.datetime.now(dt.timezone.utc) > cutoff:
             return Response('Auction is more than two hours old', status=status.HTTP_400_BAD_REQUEST)
 
-        models.Purchase.objects.filter(auction=auction).delete()
-        auction.delete()
+        with transaction.atomic():
+            models.Purchase.objects.filter(auction=auction).delete()
+            auction.delete()
 
         return Response('Auction canceled', status=status.HTTP_200_OK)
 
@@ -262,17 +396,18 @@ class UploadRaidDump(viewsets.ViewSet):
 
         dump_query = models.RaidDump.objects.filter(time=time)
 
-        if len(dump_query) == 1:
-            dump = dump_query.get()
-            new_characters = list(
-                set([c for c in dump.characters_present.all()]) | set(characters_present))
-            dump.characters_present.set(new_characters)
-        else:
-            dump = models.RaidDump(value=value, attendance_value=attendance_value,
-                                   filename=filename, time=time, notes=notes,
-                                   award_type=award_type)
-            dump.save()
-            dump.characters_present.set(characters_present)
+        with transaction.atomic():
+            if len(dump_query) == 1:
+                dump = dump_query.get()
+                new_characters = list(
+                    set([c for c in dump.characters_present.all()]) | set(characters_present))
+                dump.characters_present.set(new_characters)
+            else:
+                dump = models.RaidDump(value=value, attendance_value=attendance_value,
+                                       filename=filename, time=time, notes=notes,
+                                       award_type=award_type)
+                dump.save()
+                dump.characters_present.set(characters_present)
 
         return Response('Raid dump upload successful', status=status.HTTP_201_CREATED)
 
@@ -306,10 +441,11 @@ class UploadCasualRaidDump(viewsets.ViewSet):
 
         notes = request.data['notes']
 
-        dump = models.CasualRaidDump(
-            value=value, filename=filename, time=time, notes=notes)
-        dump.save()
-        dump.characters_present.set(characters_present)
+        with transaction.atomic():
+            dump = models.CasualRaidDump(
+                value=value, filename=filename, time=time, notes=notes)
+            dump.save()
+            dump.characters_present.set(characters_present)
         return Response('Raid dump upload successful', status=status.HTTP_201_CREATED)
 
 
@@ -344,6 +480,64 @@ class CharacterViewSet(viewsets.ModelViewSet):
     serializer_class = serializers.CharacterSerializer
     queryset = models.Character.objects.all()
 
+    @action(detail=True)
+    def history(self, request, pk=None):
+        """ one page of a character's history, newest first. pass the returned
+        next cursor as ?before= to continue """
+        character = self.get_object()
+        try:
+            limit = min(int(request.query_params.get('limit', ledger.HISTORY_PAGE)), 200)
+            items, cursor = ledger.history(ledger.MAIN, character, limit=max(limit, 1),
+                                           before=request.query_params.get('before'))
+        except ValueError:
+            return Response('Invalid cursor or limit', status=status.HTTP_400_BAD_REQUEST)
+        return Response({'results': items, 'next': cursor}, status=status.HTTP_200_OK)
+
+    @action(detail=True)
+    def summary(self, request, pk=None):
+        """ the character page header: dkp, alts, attendance and rank """
+        profile = ledger.get_profile(pk)
+        if profile is None:
+            return Response('Character not found', status=status.HTTP_404_NOT_FOUND)
+        return Response(serializers.CharacterProfileSerializer(profile).data, status=status.HTTP_200_OK)
+
+
+@method_decorator(gzip_page, name='dispatch')
+@method_decorator(versioned_page, name='dispatch')
+class Standings(viewsets.ViewSet):
+    """ read-only dkp standings for bots and clients. ?fields=name,main_dkp picks
+    the fields returned. responses are cached until the ledger changes and
+    carry an ETag, so polling clients should send If-None-Match. """
+    # only json, the cached response must not depend on the Accept header
+    renderer_classes = [JSONRenderer]
+
+    def _standings(self, request, characters):
+        """ serialized standings of the characters, raising ValueError for an
+        unknown field """
+        fields = request.query_params.get('fields')
+        if fields is not None:
+            fields = [f.strip() for f in fields.split(',') if f.strip()]
+            unknown = set(fields) - set(serializers.StandingSerializer().fields)
+            if unknown:
+                raise ValueError('Unknown fields: {}'.format(', '.join(sorted(unknown))))
+        return serializers.StandingSerializer(ledger.standings(characters), many=True, fields=fields).data
+
+    def list(self, request):
+        try:
+            result = self._standings(request, models.Character.objects.order_by('name'))
+        except ValueError as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+        return Response(result, status=status.HTTP_200_OK)
+
+    def retrieve(self, request, pk=None):
+        try:
+            result = self._standings(request, models.Character.objects.filter(name=pk.capitalize()))
+        except ValueError as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+        if not result:
+            return Response('Character not found', status=status.HTTP_404_NOT_FOUND)
+        return Response(result[0], status=status.HTTP_200_OK)
+
 
 class DkpSpecialAwardViewSet(viewsets.ModelViewSet):
     serializer_class = serializers.DkpSpecialAwardSerializer
@@ -375,15 +569,29 @@ class Tiebreak(viewsets.ViewSet):
             names.append(alt.main.name)
 
         characters = models.Character.objects.filter(name__in=names)
-        result = tiebreak(characters, bid_names)
+        result = tiebreak(characters, bid_names, request.data.get('fingerprint'))
         return Response(result, status=status.HTTP_200_OK)
 
 
-def tiebreak(characters, bid_names):
+def _tie_rng(fingerprint):
+    """ the rng ties are broken with: seeded from the auction's fingerprint so
+    the result can be reproduced, or unseeded when there is none so the same
+    bidders don't always lose to each other """
+    if fingerprint:
+        return auction_rules.seeded_rng(fingerprint)
+    return random.Random()
+
+
+def tiebreak(characters, bid_names, fingerprint=None):
+    """ order the bidders by dkp then attendance. unbreakable ties are decided
+    at random, reproducibly when an auction fingerprint is given """
+    balances = ledger.bulk_balances(characters)
+
     def ordering(character, is_main):
+        balance = balances[character.name]
         if is_main:
-            return character.current_dkp(), character.attendance(30)
-        return character.current_alt_dkp(), character.attendance(30)
+            return balance['main_dkp'], balance['attendance'][30]
+        return balance['alt_dkp'], balance['attendance'][30]
 
     orderings = {bid_names[c.name]: ordering(
         c, c.name == bid_names[c.name]) for c in characters}
@@ -391,8 +599,9 @@ def tiebreak(characters, bid_names):
     def explain(name):
         dkp, attendance = orderings[name]
         return "{} has {} DKP and {} 30-day attendance".format(name, dkp, '%.2f' % attendance)
-    names = [bid_names[c.name] for c in characters]
-    random.shuffle(names)  # shuffle so unbreakable ties are decided at random
+    names = sorted(bid_names[c.name] for c in characters)
+    # shuffle so unbreakable ties are decided at random
+    _tie_rng(fingerprint).shuffle(names)
     winners = sorted(names, key=lambda name: orderings[name], reverse=True)
     return [(name, explain(name)) for name in winners]
 
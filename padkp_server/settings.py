@@ -44,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'padkp_show.querybudget.QueryBudgetMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -51,8 +52,18 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'padkp_show.snapshot.SnapshotMiddleware',
 ]
 
+# per-request query accounting, see padkp_show/querybudget.py
+QUERY_BUDGET_ENABLED = True
+QUERY_BUDGET_HEADERS = DEBUG
+QUERY_BUDGET = 50
+
+# static export of the public pages, refreshed in the background after api writes when set.
+# see padkp_show/snapshot.py
+SNAPSHOT_DIR = None
+
 ROOT_URLCONF = 'padkp_server.urls'
 
 TEMPLATES = [
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class PadkpShowConfig(AppConfig):
     name = 'padkp_show'
+
+    def ready(self):
+        from . import ledger
+        ledger.connect_signals()
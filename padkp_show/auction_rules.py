@@ -0,0 +1,117 @@
+"""
+The english and vickrey auction rules, free of the ORM.
+
+Both take a list of BidRecord and the number of items and return
+(tie_losers, winners): the names that lost a tie for the last item and a list
+of (record, price) pairs in award order. Ties are broken by shuffling the bids
+with rng before a stable sort; seeded_rng() gives the generator an auction's
+fingerprint always produces, so any result can be reproduced.
+Auction.determine_winners_english/vickrey adapt the stored AuctionBid rows to
+these functions.
+"""
+import hashlib
+import random
+
+# bids on alts count as at most this much against mains
+ALT_CAP = 5
+# and bids from these ranks at most this much in english auctions
+NON_MAIN_CAP = 10
+NON_MAIN_TAGS = ('INA', 'Recruit', 'FNF')
+
+
+def seeded_rng(seed):
+    """ a random.Random that depends only on the seed string """
+    return random.Random(int(hashlib.sha256(seed.encode('utf-8')).hexdigest(), 16))
+
+
+class BidRecord(object):
+    """ one bid with the bidder's dkp and attendance when it was placed """
+    __slots__ = ('name', 'bid', 'tag', 'dkp', 'attendance')
+
+    def __init__(self, name, bid, tag, dkp=0, attendance=0.0):
+        self.name = name
+        self.bid = bid
+        self.tag = tag
+        self.dkp = dkp
+        self.attendance = attendance
+
+    def __repr__(self):
+        return 'BidRecord({!r}, {!r}, {!r}, {!r}, {!r})'.format(
+            self.name, self.bid, self.tag, self.dkp, self.attendance)
+
+
+def _capped(bid):
+    if bid.tag == 'ALT':
+        return min(bid.bid, ALT_CAP)
+    return bid.bid
+
+
+def english(bids, item_count, rng=random):
+    """ highest bids win and pay what they bid. alts and non-mains are capped,
+    then bid, dkp and attendance break ties. """
+    def ordering(bid):
+        max_bid = _capped(bid)
+        if bid.tag in NON_MAIN_TAGS:
+            max_bid = min(max_bid, NON_MAIN_CAP)
+        return max_bid, bid.bid, bid.dkp, bid.attendance
+
+    bids = list(bids)
+    rng.shuffle(bids)
+    in_order = sorted(bids, key=ordering, reverse=True)
+    tie_losers = []
+    if len(in_order) > item_count:  # More bidders than items to hand out
+        i = item_count
+        while in_order[i-1].bid == in_order[i].bid:
+            tie_losers.append(in_order[i].name)
+            i += 1
+            if len(in_order) == i:
+                break
+    return tie_losers, [(bid, bid.bid) for bid in in_order[:item_count]]
+
+
+def vickrey(bids, item_count, rng=random):
+    """ highest bids win and pay one more than the bid below them, mains before
+    alts. """
+    def offset_value(target, offset, tie_fallback):
+        if offset is None:
+            return 5
+        if offset.tag == 'ALT' and target.tag != 'ALT':
+            return _capped(offset) + 1
+        if offset.bid == target.bid or offset.name == target.name:
+            return min(tie_fallback, target.bid)
+        return offset.bid + 1
+
+    bids = list(bids)
+    rng.shuffle(bids)
+    in_order = sorted(bids, key=lambda bid: (_capped(bid), bid.bid), reverse=True)
+
+    top = in_order[:item_count]
+    all_winners = [x for x in top if x.tag != 'ALT'] + [x for x in top if x.tag == 'ALT']
+    chosen = set(map(id, all_winners))
+    left_overs = [x for x in in_order if id(x) not in chosen]
+    tie_losers = []
+
+    effective_count = min(len(all_winners), item_count)
+    if effective_count == 0:
+        return tie_losers, []
+
+    last_winner = all_winners[effective_count-1]
+    offset_from = None
+    if item_count > 1 and item_count <= len(bids):
+        offset_from = last_winner
+    for possible in all_winners[effective_count:] + left_overs:
+        if possible.name != last_winner.name:
+            if possible.bid == last_winner.bid:
+                tie_losers.append(possible.name)
+            if offset_from is None:
+                offset_from = possible
+
+    # prices are set from the last winner up, none may exceed the one below
+    result = []
+    price = 10000
+    for winner in reversed(all_winners[:effective_count]):
+        price = min(price, offset_value(winner, offset_from, price))
+        offset_from = winner
+        result.append((winner, price))
+    result.reverse()
+    return tie_losers, result
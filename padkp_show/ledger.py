@@ -0,0 +1,782 @@
+"""
+Materialized DKP balances, attendance buckets and the bulk balance engine.
+
+Every write to the ledger (raid dumps and their attendee lists, purchases and
+special awards) refreshes the CharacterBalance rows of the characters it
+touches, inside the same transaction as the write. The casual track keeps its
+balances in CasualCharacterBalance through the same code, parameterized by
+LedgerFamily. Balances are recomputed from grouped aggregates rather than
+adjusted by deltas, so edits, deletes and backdated entries can never leave a
+stale total behind.
+
+Balances as of a point in time are served from BalanceCheckpoint rows plus the
+ledger entries recorded since the nearest checkpoint. A write that lands at or
+before a checkpoint drops the affected characters' checkpoints from that time
+on, so a checkpoint is always consistent with the ledger beneath it.
+
+Each track (main and casual, see LedgerFamily) also keeps a flattened
+LedgerEntry stream, one row per dump attended, award and purchase, indexed on
+(character, time) so a character's history is a single ordered query.
+
+Attendance is bucketed per raid day (a calendar day in US/Eastern):
+AttendanceDay holds the points every raid dump on that day made available and
+CharacterAttendanceDay the points each character earned, so any attendance
+window is a sum over at most that many small rows.
+
+Any write to the DKP data, derived tables aside, also bumps the single
+LedgerGeneration row, which versions the cached pages (see
+padkp_show.pagecache) and the CharacterProfile summaries.
+
+bulk_balances() answers "dkp and attendance for these characters" for any
+number of characters with a constant number of grouped queries, and should be
+used instead of calling current_dkp()/attendance() in a loop.
+"""
+import datetime as dt
+import pytz
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Exists, F, IntegerField, Max, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import TruncDay
+from django.utils import timezone
+from django.db.models.signals import post_save, pre_save, post_delete, pre_delete, m2m_changed
+
+from .models import Character, CharacterBalance, RaidDump, Purchase, DkpSpecialAward, CasualCharacterBalance
+from .models import AttendanceDay, CharacterAttendanceDay, BalanceCheckpoint
+from .models import LedgerEntry, CasualLedgerEntry, LedgerGeneration, CharacterProfile, CharacterAlt
+from .models import CasualCharacter, CasualRaidDump, CasualPurchase, CasualDkpSpecialAward
+from .models import DON_RELEASE
+
+EASTERN = pytz.timezone('US/Eastern')
+
+
+class LedgerFamily(object):
+    """ the models one DKP track keeps its ledger in """
+
+    def __init__(self, character, raid_dump, purchase, award, entry, balance, checkpoint=None):
+        self.character = character
+        self.raid_dump = raid_dump
+        self.purchase = purchase
+        self.award = award
+        self.entry = entry
+        self.balance = balance
+        self.checkpoint = checkpoint
+        attendees = raid_dump._meta.get_field('characters_present')
+        self.attendees = attendees.remote_field.through
+        self.attendee_dump_field = attendees.m2m_field_name()
+        self.attendee_character_field = attendees.m2m_reverse_field_name()
+        # the name of the balance row when querying from the character model
+        self.balance_relation = balance._meta.get_field('character').related_query_name()
+        # only the main track has alt purchases and attendance
+        self.has_alts = any(f.name == 'is_alt' for f in purchase._meta.get_fields())
+        self.has_attendance = any(f.name == 'attendance_value' for f in raid_dump._meta.get_fields())
+
+
+MAIN = LedgerFamily(Character, RaidDump, Purchase, DkpSpecialAward, LedgerEntry,
+                    CharacterBalance, BalanceCheckpoint)
+CASUAL = LedgerFamily(CasualCharacter, CasualRaidDump, CasualPurchase,
+                      CasualDkpSpecialAward, CasualLedgerEntry, CasualCharacterBalance)
+FAMILIES = (MAIN, CASUAL)
+
+
+def compute_balances(names, after=None, until=None, family=MAIN):
+    """ compute balances for the given character names with three grouped queries.
+
+    after and until optionally restrict the sum to ledger entries with
+    after < time <= until.
+    """
+    dump = family.attendee_dump_field + '__'
+    character = family.attendee_character_field
+
+    def during(prefix):
+        window = Q()
+        if after is not None:
+            window &= Q(**{prefix + 'time__gt': after})
+        if until is not None:
+            window &= Q(**{prefix + 'time__lte': until})
+        return window
+
+    def totals(value, main=None, alt=None):
+        sums = {'total': Sum(value, filter=main)}
+        # casual characters have no alts, their alt totals stay at 0
+        if family.has_alts:
+            sums['alt_total'] = Sum(value, filter=alt)
+        return sums
+
+    dumps = family.attendees.objects.filter(
+        during(dump), **{character + '__in': names}).values(character).annotate(
+        **totals(dump + 'value', alt=Q(**{dump + 'time__gte': DON_RELEASE})))
+    awards = family.award.objects.filter(during(''), character__in=names).values(
+        'character').annotate(**totals('value', alt=Q(time__gte=DON_RELEASE)))
+    purchases = family.purchase.objects.filter(during(''), character__in=names).values(
+        'character').annotate(**totals('value', main=Q(is_alt=False) if family.has_alts else None,
+                                       alt=Q(is_alt=True)))
+
+    earned = {name: 0 for name in names}
+    alt_earned = {name: 0 for name in names}
+    spent = {name: 0 for name in names}
+    alt_spent = {name: 0 for name in names}
+    for row in dumps:
+        earned[row[character]] += row['total'] or 0
+        alt_earned[row[character]] += row.get('alt_total') or 0
+    for row in awards:
+        earned[row['character']] += row['total'] or 0
+        alt_earned[row['character']] += row.get('alt_total') or 0
+    for row in purchases:
+        spent[row['character']] += row['total'] or 0
+        alt_spent[row['character']] += row.get('alt_total') or 0
+
+    return {name: family.balance(character_id=name,
+                                 main_dkp=earned[name] - spent[name],
+                                 alt_dkp=alt_earned[name] - alt_spent[name],
+                                 earned=earned[name],
+                                 spent=spent[name])
+            for name in names}
+
+
+def refresh_balances(names, since=None, family=MAIN):
+    """ recompute and store the balances of the given characters.
+
+    since is the earliest ledger time the triggering write touched; their
+    checkpoints from that time on are dropped.
+    """
+    names = set(names)
+    if not names:
+        return {}
+    with transaction.atomic():
+        names = set(family.character.objects.filter(
+            name__in=names).values_list('name', flat=True))
+        if since is not None and family.checkpoint is not None:
+            family.checkpoint.objects.filter(character__in=names, time__gte=since).delete()
+        balances = compute_balances(names, family=family)
+        family.balance.objects.filter(character__in=names).delete()
+        family.balance.objects.bulk_create(balances.values())
+    return balances
+
+
+def rebuild_balances(family=MAIN):
+    """ recompute every stored balance of a track from scratch """
+    with transaction.atomic():
+        family.balance.objects.all().delete()
+        names = list(family.character.objects.values_list('name', flat=True))
+        balances = compute_balances(names, family=family)
+        family.balance.objects.bulk_create(balances.values())
+    return balances
+
+
+def get_balance(name, family=MAIN):
+    """ the stored balance for a character, computing it if it is missing """
+    try:
+        return family.balance.objects.get(character=name)
+    except family.balance.DoesNotExist:
+        return refresh_balances([name], family=family).get(name) or family.balance(character_id=name)
+
+
+def as_datetime(time):
+    """ a ledger timestamp as an aware datetime.
+
+    accepts anything a DateTimeField accepts on save (strings, naive datetimes
+    in the default timezone) since signal handlers see unsaved values.
+    """
+    time = RaidDump._meta.get_field('time').to_python(time)
+    if timezone.is_naive(time):
+        time = timezone.make_aware(time)
+    return time
+
+
+def raid_day(time):
+    """ the raid day a ledger timestamp falls on """
+    return as_datetime(time).astimezone(EASTERN).date()
+
+
+def today():
+    return raid_day(timezone.now())
+
+
+def day_bounds(day):
+    """ the [start, end) times of a raid day """
+    start = EASTERN.localize(dt.datetime.combine(day, dt.time()))
+    end = EASTERN.localize(dt.datetime.combine(day + dt.timedelta(days=1), dt.time()))
+    return start, end
+
+
+def _attendance_buckets(days=None, names=None):
+    """ attendance points per raid day, from the raw ledger.
+
+    returns ({day: available}, {(name, day): earned}) for the given days (all
+    days if None), restricting earned points to the given names if not None.
+    """
+    def on_days(prefix):
+        window = Q()
+        for day in days or []:
+            start, end = day_bounds(day)
+            window |= Q(**{prefix + 'time__gte': start, prefix + 'time__lt': end})
+        return window
+
+    def by_day(queryset, prefix):
+        return queryset.filter(on_days(prefix)).annotate(
+            raid_day=TruncDay(prefix + 'time', tzinfo=EASTERN))
+
+    dumps = by_day(RaidDump.characters_present.through.objects, 'raiddump__')
+    awards = by_day(DkpSpecialAward.objects, '').exclude(attendance_value=0)
+    if names is not None:
+        dumps = dumps.filter(character__in=names)
+        awards = awards.filter(character__in=names)
+
+    available = {row['raid_day'].date(): row['total'] or 0 for row in
+                 by_day(RaidDump.objects, '').values('raid_day').annotate(total=Sum('attendance_value'))}
+    earned = {}
+    for row in list(dumps.values('character', 'raid_day').annotate(total=Sum('raiddump__attendance_value'))) + \
+            list(awards.values('character', 'raid_day').annotate(total=Sum('attendance_value'))):
+        key = (row['character'], row['raid_day'].date())
+        earned[key] = earned.get(key, 0) + (row['total'] or 0)
+    return available, earned
+
+
+def _store_attendance(available, earned):
+    AttendanceDay.objects.bulk_create(
+        [AttendanceDay(day=day, available=points) for day, points in available.items() if points])
+    CharacterAttendanceDay.objects.bulk_create(
+        [CharacterAttendanceDay(character_id=name, day=day, earned=points)
+         for (name, day), points in earned.items() if points])
+
+
+def refresh_attendance(days, names=None):
+    """ recompute the attendance buckets of the given raid days.
+
+    every character's bucket on those days is rebuilt unless names is given,
+    in which case only those characters' buckets are.
+    """
+    days = set(days) - {None}
+    if not days:
+        return
+    with transaction.atomic():
+        available, earned = _attendance_buckets(days, names)
+        AttendanceDay.objects.filter(day__in=days).delete()
+        stale = CharacterAttendanceDay.objects.filter(day__in=days)
+        if names is not None:
+            stale = stale.filter(character__in=names)
+        stale.delete()
+        _store_attendance(available, earned)
+
+
+def rebuild_attendance():
+    """ recompute every attendance bucket from scratch """
+    with transaction.atomic():
+        AttendanceDay.objects.all().delete()
+        CharacterAttendanceDay.objects.all().delete()
+        _store_attendance(*_attendance_buckets())
+
+
+def write_checkpoints(characters=None, when=None):
+    """ record the balances of the given characters (default: everyone) as of when (default: now) """
+    when = as_datetime(when or timezone.now())
+    if characters is None:
+        names = list(Character.objects.values_list('name', flat=True))
+    else:
+        names = _names(characters)
+    with transaction.atomic():
+        balances = compute_balances(names, until=when)
+        BalanceCheckpoint.objects.filter(character__in=names, time=when).delete()
+        BalanceCheckpoint.objects.bulk_create(
+            [BalanceCheckpoint(character_id=name, time=when, main_dkp=b.main_dkp,
+                               alt_dkp=b.alt_dkp, earned=b.earned, spent=b.spent)
+             for name, b in balances.items()])
+    return len(balances)
+
+
+def balance_as_of(character, when):
+    """ the balance a character had at a point in time.
+
+    starts from the nearest checkpoint at or before when and adds the ledger
+    entries recorded since, so the cost depends on how recent the checkpoint
+    is rather than on how much history exists. returns an unsaved
+    CharacterBalance.
+    """
+    name = _names([character])[0]
+    when = as_datetime(when)
+    checkpoint = BalanceCheckpoint.objects.filter(
+        character=name, time__lte=when).order_by('-time').first()
+    balance = compute_balances([name], after=checkpoint and checkpoint.time, until=when)[name]
+    if checkpoint:
+        balance.main_dkp += checkpoint.main_dkp
+        balance.alt_dkp += checkpoint.alt_dkp
+        balance.earned += checkpoint.earned
+        balance.spent += checkpoint.spent
+    return balance
+
+
+def _dump_entry(family, dump, name):
+    return family.entry(source=family.entry.DUMP, character_id=name, raid_dump=dump,
+                        time=dump.time, dkp=dump.value,
+                        attendance=getattr(dump, 'attendance_value', 0),
+                        description=str(dump))
+
+
+def _award_entry(family, award):
+    return family.entry(source=family.entry.AWARD, character_id=award.character_id,
+                        award=award, time=award.time, dkp=award.value,
+                        attendance=getattr(award, 'attendance_value', 0),
+                        description=str(award))
+
+
+def _purchase_entry(family, purchase):
+    return family.entry(source=family.entry.PURCHASE, character_id=purchase.character_id,
+                        purchase=purchase, time=purchase.time, dkp=-purchase.value,
+                        is_alt=bool(getattr(purchase, 'is_alt', False)),
+                        description=str(purchase))
+
+
+def _entries(family, dumps=None, purchases=None, awards=None, names=None):
+    """ build ledger entries for the given source querysets """
+    entries = []
+    if dumps is not None:
+        attendees = family.attendees.objects.filter(
+            **{family.attendee_dump_field + '__in': dumps})
+        if names is not None:
+            attendees = attendees.filter(**{family.attendee_character_field + '__in': names})
+        dumps = {dump.pk: dump for dump in dumps}
+        for dump_id, name in attendees.values_list(family.attendee_dump_field,
+                                                   family.attendee_character_field).iterator():
+            entries.append(_dump_entry(family, dumps[dump_id], name))
+    if purchases is not None:
+        entries += [_purchase_entry(family, p) for p in purchases.select_related('character')]
+    if awards is not None:
+        entries += [_award_entry(family, a) for a in awards]
+    return entries
+
+
+def refresh_entries(family, dumps=(), purchases=(), awards=(), names=None):
+    """ rebuild the ledger entries of the given source rows (by primary key).
+
+    dump entries are only rebuilt for the given character names if not None.
+    """
+    with transaction.atomic():
+        stale = family.entry.objects.filter(
+            Q(raid_dump__in=dumps) | Q(purchase__in=purchases) | Q(award__in=awards))
+        if names is not None:
+            stale = stale.filter(Q(character__in=names) | Q(raid_dump__isnull=True))
+        stale.delete()
+        family.entry.objects.bulk_create(_entries(
+            family,
+            dumps=family.raid_dump.objects.filter(pk__in=dumps) if dumps else None,
+            purchases=family.purchase.objects.filter(pk__in=purchases) if purchases else None,
+            awards=family.award.objects.filter(pk__in=awards) if awards else None,
+            names=names))
+
+
+def rebuild_entries(family=MAIN):
+    """ recompute a track's whole ledger entry stream from scratch """
+    with transaction.atomic():
+        family.entry.objects.all().delete()
+        family.entry.objects.bulk_create(_entries(
+            family, dumps=family.raid_dump.objects.all(),
+            purchases=family.purchase.objects.all(),
+            awards=family.award.objects.all()), batch_size=500)
+
+
+# history streams, in the order they sort within the same instant
+MISSED, ENTRIES = 0, 1
+HISTORY_PAGE = 50
+EPOCH = dt.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def encode_cursor(time, stream, pk):
+    return '{}.{}.{}'.format((time - EPOCH) // dt.timedelta(microseconds=1), stream, pk)
+
+
+def decode_cursor(cursor):
+    """ (time, stream, pk) from encode_cursor's output, ValueError when malformed """
+    micros, stream, pk = (int(x) for x in cursor.split('.'))
+    if stream not in (MISSED, ENTRIES):
+        raise ValueError('unknown history stream {}'.format(stream))
+    if not 0 <= pk < 2 ** 63:
+        raise ValueError('malformed cursor')
+    try:
+        return EPOCH + dt.timedelta(microseconds=micros), stream, pk
+    except OverflowError:
+        raise ValueError('malformed cursor')
+
+
+def _after_cursor(queryset, stream, cursor):
+    """ rows of one stream that sort after cursor in (time, stream, id) descending order """
+    time, cursor_stream, pk = cursor
+    if stream == cursor_stream:
+        return queryset.filter(Q(time__lt=time) | Q(time=time, id__lt=pk))
+    if stream < cursor_stream:
+        return queryset.filter(time__lte=time)
+    return queryset.filter(time__lt=time)
+
+
+def history(family, character, before=None, since=None, limit=HISTORY_PAGE):
+    """ a character's history, newest first: the dumps they attended, their
+    awards and purchases, and the dumps they missed since their first raid.
+
+    keyset paginated on (time, stream, id). before is the cursor returned with
+    the previous page, since an optional lower bound on time and limit None for
+    everything. returns (items, cursor for the next page or None).
+    """
+    name = _names([character])[0]
+    entries = family.entry.objects.filter(character=name)
+    first_raid = entries.filter(source=family.entry.DUMP).order_by('time').values('time')[:1]
+    missed = family.raid_dump.objects.exclude(characters_present=name).filter(time__gte=Subquery(first_raid))
+    if since is not None:
+        entries = entries.filter(time__gte=since)
+        missed = missed.filter(time__gte=since)
+    if before is not None:
+        cursor = decode_cursor(before)
+        entries = _after_cursor(entries, ENTRIES, cursor)
+        missed = _after_cursor(missed, MISSED, cursor)
+    entries = entries.order_by('-time', '-id').values('id', 'source', 'time', 'dkp', 'is_alt', 'description')
+    missed = missed.order_by('-time', '-id')
+    if limit is not None:
+        entries = entries[:limit + 1]
+        missed = missed[:limit + 1]
+
+    items = [((e['time'], ENTRIES, e['id']),
+              {'kind': e['source'], 'time': e['time'], 'dkp': e['dkp'], 'is_alt': e['is_alt'],
+               'present': True, 'description': e['description']}) for e in entries]
+    items += [((d.time, MISSED, d.id),
+               {'kind': 'missed', 'time': d.time, 'dkp': 0, 'is_alt': False,
+                'present': False, 'description': str(d)}) for d in missed]
+    items.sort(key=lambda x: x[0], reverse=True)
+    next_cursor = None
+    if limit is not None and len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(*items[-1][0])
+    return [item for _, item in items], next_cursor
+
+
+def _names(characters):
+    return [c if isinstance(c, str) else c.name for c in characters]
+
+
+def bulk_attendance(characters=None, windows=(30,)):
+    """ attendance percentage over each window for many characters.
+
+    a window of N days covers the last N raid days, today included; a window
+    of None covers all time. returns {name: {window: percentage}} using two
+    queries over the attendance buckets no matter how many characters or
+    windows are requested.
+    """
+    if characters is None:
+        return _attendance(list(Character.objects.values_list('name', flat=True)), windows, roster=True)
+    return _attendance(_names(characters), windows)
+
+
+def _attendance(names, windows, roster=False):
+    first_days = {days: _first_day(days) for days in windows}
+    earliest = None if None in first_days.values() else min(first_days.values())
+
+    def windowed(field):
+        return {'window_{}'.format(days): Sum(field, filter=Q(day__gte=first_day) if first_day else Q())
+                for days, first_day in first_days.items()}
+
+    totals = AttendanceDay.objects.all()
+    earned = CharacterAttendanceDay.objects.all()
+    if earliest is not None:
+        totals = totals.filter(day__gte=earliest)
+        earned = earned.filter(day__gte=earliest)
+    if not roster:
+        earned = earned.filter(character__in=names)
+    totals = totals.aggregate(**windowed('available'))
+    earned = {row['character']: row for row in
+              earned.values('character').annotate(**windowed('earned'))}
+
+    def percentage(name, days):
+        key = 'window_{}'.format(days)
+        points = earned[name][key] if name in earned else 0
+        return 100 * float(points or 0) / (totals[key] or 1)
+
+    return {name: {days: percentage(name, days) for days in windows} for name in names}
+
+
+def bulk_balances(characters=None, windows=(30,), store=True):
+    """ main dkp, alt dkp and windowed attendance for many characters.
+
+    characters may be names or Character objects; None means the whole roster.
+    missing stored balances are computed and, unless store is False, saved.
+    returns {name: {'main_dkp': int, 'alt_dkp': int, 'attendance': {days: float}}}
+    """
+    if characters is None:
+        balances = CharacterBalance.objects.all()
+        names = list(Character.objects.values_list('name', flat=True))
+    else:
+        names = _names(characters)
+        balances = CharacterBalance.objects.filter(character__in=names)
+    balances = {b.character_id: b for b in balances}
+    missing = [name for name in names if name not in balances]
+    if missing:
+        balances.update(refresh_balances(missing) if store else compute_balances(missing))
+    attendance = _attendance(names, windows, roster=characters is None)
+
+    return {name: {'main_dkp': balances[name].main_dkp,
+                   'alt_dkp': balances[name].alt_dkp,
+                   'attendance': attendance[name]}
+            for name in names if name in balances}
+
+
+def _first_day(days):
+    return None if days is None else today() - dt.timedelta(days=days - 1)
+
+
+def standings(characters=None, days=30, family=MAIN):
+    """ characters annotated with main_dkp, alt_dkp, earned (attendance points in
+    the window) and attendance (percentage) from one query, plus one aggregate
+    for the points available in the window.
+
+    characters is a queryset of the family's characters and defaults to
+    everyone who has attended a raid dump. the casual track keeps no
+    attendance, its characters only get main_dkp and alt_dkp, from one query.
+    """
+    if characters is None:
+        attended = family.attendees.objects.filter(**{family.attendee_character_field: OuterRef('pk')})
+        characters = family.character.objects.annotate(attended=Exists(attended)).filter(attended=True)
+
+    annotations = {'main_dkp': F(family.balance_relation + '__main_dkp'),
+                   'alt_dkp': F(family.balance_relation + '__alt_dkp')}
+    if family.has_attendance:
+        first_day = _first_day(days)
+        earned = CharacterAttendanceDay.objects.filter(character=OuterRef('pk'))
+        available = AttendanceDay.objects.all()
+        if first_day is not None:
+            earned = earned.filter(day__gte=first_day)
+            available = available.filter(day__gte=first_day)
+        earned = earned.values('character').annotate(total=Sum('earned')).values('total')
+        available = available.aggregate(total=Sum('available'))['total'] or 1
+        annotations['earned'] = Subquery(earned, output_field=IntegerField())
+
+    characters = list(characters.annotate(**annotations))
+    missing = [c.name for c in characters if c.main_dkp is None]
+    balances = refresh_balances(missing, family=family) if missing else {}
+    for character in characters:
+        if character.name in balances:
+            character.main_dkp = balances[character.name].main_dkp
+            character.alt_dkp = balances[character.name].alt_dkp
+        if family.has_attendance:
+            character.earned = character.earned or 0
+            character.attendance = 100 * float(character.earned) / available
+    return characters
+
+
+def _dump_attendees(dump):
+    return list(dump.characters_present.values_list('name', flat=True))
+
+
+def _counts_for_attendance(entry):
+    return bool(getattr(entry, 'attendance_value', 0))
+
+
+def _ledger_changed(family, names, times, attendance_times=None, attendance_names=None):
+    """ refresh everything derived from the family's ledger after a write.
+
+    names had ledger entries at the given times change. attendance_times are
+    the times of the changed entries that carry attendance (all of them by
+    default); attendance_names restricts which characters' attendance buckets
+    are rebuilt on those days (everyone's by default).
+    """
+    times = [as_datetime(t) for t in times]
+    if attendance_times is None:
+        attendance_times = times
+    refresh_balances(names, since=min(times) if times else None, family=family)
+    if family.has_attendance:
+        refresh_attendance([raid_day(t) for t in attendance_times], attendance_names)
+
+
+def _family_of(sender):
+    """ the family a ledger model or attendee table belongs to """
+    for family in FAMILIES:
+        if sender in (family.raid_dump, family.purchase, family.award, family.attendees):
+            return family
+
+
+def _remember_previous_entry(sender, instance, **kwargs):
+    instance._previous_entry = None
+    if instance.pk is not None:
+        instance._previous_entry = sender.objects.filter(pk=instance.pk).first()
+
+
+def _entry_saved(sender, instance, **kwargs):
+    entries = [instance]
+    previous = getattr(instance, '_previous_entry', None)
+    if previous:
+        entries.append(previous)
+    names = {entry.character_id for entry in entries}
+    _ledger_changed(_family_of(sender), names, [entry.time for entry in entries],
+                    [entry.time for entry in entries if _counts_for_attendance(entry)], names)
+
+
+def _entry_deleted(sender, instance, **kwargs):
+    names = [instance.character_id]
+    _ledger_changed(_family_of(sender), names, [instance.time],
+                    [instance.time] if _counts_for_attendance(instance) else [], names)
+
+
+def _remember_previous_dump(sender, instance, **kwargs):
+    instance._previous_time = None
+    if instance.pk is not None:
+        instance._previous_time = sender.objects.filter(
+            pk=instance.pk).values_list('time', flat=True).first()
+
+
+def _dump_saved(sender, instance, created, **kwargs):
+    times = [instance.time]
+    if getattr(instance, '_previous_time', None):
+        times.append(instance._previous_time)
+    if created:
+        # nobody is attending yet, only the available points change
+        _ledger_changed(_family_of(sender), [], times, attendance_names=[])
+    else:
+        _ledger_changed(_family_of(sender), _dump_attendees(instance), times)
+
+
+def _remember_dump_attendees(sender, instance, **kwargs):
+    instance._previous_attendees = _dump_attendees(instance)
+
+
+def _dump_deleted(sender, instance, **kwargs):
+    _ledger_changed(_family_of(sender), getattr(instance, '_previous_attendees', []), [instance.time])
+
+
+def _attendees_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    family = _family_of(sender)
+    if action == 'pre_clear':
+        if reverse:
+            instance._cleared_dumps = list(instance.raid_dumps.values_list('time', flat=True))
+        else:
+            instance._cleared_attendees = _dump_attendees(instance)
+        return
+    if action == 'post_clear':
+        if reverse:
+            names, times = [instance.pk], getattr(instance, '_cleared_dumps', [])
+        else:
+            names, times = getattr(instance, '_cleared_attendees', []), [instance.time]
+    elif action in ('post_add', 'post_remove'):
+        if reverse:
+            names = [instance.pk]
+            times = list(family.raid_dump.objects.filter(
+                pk__in=pk_set).values_list('time', flat=True))
+        else:
+            names, times = pk_set, [instance.time]
+    else:
+        return
+    _ledger_changed(family, names, times, attendance_names=names)
+
+
+def _families_by(attribute):
+    return {getattr(family, attribute): family for family in FAMILIES}
+
+
+def _source_saved(sender, instance, created, **kwargs):
+    family = _families_by('raid_dump').get(sender)
+    if family:
+        if not created:
+            refresh_entries(family, dumps=[instance.pk])
+        return
+    family = _families_by('purchase').get(sender)
+    if family:
+        refresh_entries(family, purchases=[instance.pk])
+        return
+    refresh_entries(_families_by('award')[sender], awards=[instance.pk])
+
+
+def _source_attendees_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    family = _families_by('attendees')[sender]
+    if action == 'post_clear':
+        field = 'character' if reverse else 'raid_dump'
+        family.entry.objects.filter(raid_dump__isnull=False, **{field: instance.pk}).delete()
+    elif action in ('post_add', 'post_remove'):
+        if reverse:
+            refresh_entries(family, dumps=pk_set, names=[instance.pk])
+        else:
+            refresh_entries(family, dumps=[instance.pk], names=pk_set)
+
+
+# tables padkp_show.ledger derives from the others, writing them does not
+# change what any page shows
+DERIVED = (CharacterBalance, CasualCharacterBalance, BalanceCheckpoint, AttendanceDay, CharacterAttendanceDay,
+           LedgerEntry, CasualLedgerEntry, LedgerGeneration, CharacterProfile)
+
+
+def bump_generation():
+    """ record that the DKP data changed, see LedgerGeneration """
+    now = timezone.now()
+    if not LedgerGeneration.objects.filter(pk=1).update(generation=F('generation') + 1, changed=now):
+        LedgerGeneration.objects.create(pk=1, generation=1, changed=now)
+
+
+def generation():
+    """ the current (generation, changed) pair; (0, None) before the first write """
+    return LedgerGeneration.objects.filter(pk=1).values_list('generation', 'changed').first() or (0, None)
+
+
+def refresh_profiles(names, current=None):
+    """ rebuild the CharacterProfile rows of the given character names """
+    number = (current or generation())[0]
+    day = today()
+    characters = standings(Character.objects.filter(name__in=names), days=30)
+    alts = {}
+    for alt, main in CharacterAlt.objects.filter(main__in=names).order_by('name').values_list('name', 'main'):
+        alts.setdefault(main, []).append(alt)
+    last_raids = dict(LedgerEntry.objects.filter(character__in=names, source=LedgerEntry.DUMP)
+                      .values('character').annotate(last=Max('time')).values_list('character', 'last'))
+
+    profiles = {c.name: CharacterProfile(character_id=c.name, character_class=c.character_class,
+                                         rank=c.display_rank(), alts=','.join(alts.get(c.name, [])),
+                                         main_dkp=c.main_dkp, alt_dkp=c.alt_dkp,
+                                         attendance_30=c.attendance, last_raid=last_raids.get(c.name),
+                                         generation=number, day=day)
+                for c in characters}
+    with transaction.atomic():
+        CharacterProfile.objects.filter(character__in=names).delete()
+        CharacterProfile.objects.bulk_create(profiles.values(), ignore_conflicts=True)
+    return profiles
+
+
+def get_profile(name):
+    """ the character's profile, rebuilt when the ledger or the raid day has moved
+    on since it was built. None for an unknown character. """
+    current = generation()
+    profile = CharacterProfile.objects.filter(character=name).first()
+    if profile is None or profile.generation != current[0] or profile.day != today():
+        profile = refresh_profiles([name], current).get(name)
+    return profile
+
+
+def _data_changed(sender, **kwargs):
+    if kwargs.get('action', 'post_').startswith('post_'):
+        bump_generation()
+
+
+def _character_deleted(sender, instance, **kwargs):
+    # the cascade deletes the character's purchases and awards first, and their
+    # signals store a new balance and attendance for the character. remove those
+    # rows again before the transaction commits.
+    family = next(family for family in FAMILIES if family.character is sender)
+    family.balance.objects.filter(character=instance.pk).delete()
+    if family.has_attendance:
+        CharacterAttendanceDay.objects.filter(character=instance.pk).delete()
+
+
+def connect_signals():
+    for family in FAMILIES:
+        for model in (family.purchase, family.award):
+            pre_save.connect(_remember_previous_entry, sender=model)
+            post_save.connect(_entry_saved, sender=model)
+            post_delete.connect(_entry_deleted, sender=model)
+        pre_save.connect(_remember_previous_dump, sender=family.raid_dump)
+        post_save.connect(_dump_saved, sender=family.raid_dump)
+        pre_delete.connect(_remember_dump_attendees, sender=family.raid_dump)
+        post_delete.connect(_dump_deleted, sender=family.raid_dump)
+        m2m_changed.connect(_attendees_changed, sender=family.attendees)
+        for model in (family.raid_dump, family.purchase, family.award):
+            post_save.connect(_source_saved, sender=model)
+        m2m_changed.connect(_source_attendees_changed, sender=family.attendees)
+        post_delete.connect(_character_deleted, sender=family.character)
+    for model in apps.get_app_config('padkp_show').get_models(include_auto_created=True):
+        if model in DERIVED:
+            continue
+        post_save.connect(_data_changed, sender=model)
+        post_delete.connect(_data_changed, sender=model)
+        if model._meta.auto_created:
+            m2m_changed.connect(_data_changed, sender=model)
@@ -0,0 +1,173 @@
+import contextlib
+import datetime as dt
+import io
+import json
+import statistics
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.urls import URLPattern
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from padkp_api.urls import router
+from padkp_show import urls as show_urls
+from padkp_show.models import Auction, CasualCharacter, Character
+from padkp_show.synthetic import generate_guild
+
+
+def _show_requests(sample):
+    """ a GET for every page in padkp_show.urls """
+    result = []
+    for pattern in show_urls.urlpatterns:
+        if not isinstance(pattern, URLPattern):
+            continue
+        route = str(pattern.pattern)
+        if '<slug:character>' in route:
+            route = route.replace('<slug:character>', sample['casual'] if route.startswith('casual/') else sample['main'])
+        route = route.replace('<int:auction_id>', str(sample['auction']))
+        route = route.replace('<str:window>', 'all')
+        result.append(('GET /' + str(pattern.pattern), 'get', '/' + route, None))
+    return result
+
+
+def _api_requests(sample, run):
+    """ a representative request for every endpoint registered on padkp_api's router.
+    run keeps the write requests from colliding with the previous repetition. """
+    names = sample['bidders']
+    now = timezone.now() + dt.timedelta(minutes=run)
+    fingerprint = 'benchmark-{}'.format(run)
+    dump = '\n'.join('1\t{}\t60\tWarrior\t\t\t\tYes\t'.format(name) for name in names)
+    bids = [{'name': name, 'bid': 5 + i, 'tag': 'MN'} for i, name in enumerate(names)]
+    posts = {
+        'upload_dump': {'dump_contents': dump, 'value': 2, 'counts_for_attendance': True,
+                        'filename': 'benchmark.txt', 'time': now.isoformat(), 'notes': '',
+                        'award_type': 'Time'},
+        'upload_casual_dump': {'dump_contents': dump, 'value': 2, 'filename': 'benchmark.txt',
+                               'time': now.isoformat(), 'notes': ''},
+        'charge_dkp': {'character': names[0], 'item_name': 'Benchmark item', 'value': 1,
+                       'time': now.isoformat(), 'notes': '', 'is_alt': False},
+        'tiebreak': {'characters': names},
+        'resolve_auction': {'fingerprint': fingerprint, 'bids': bids, 'item_name': 'Benchmark item',
+                            'item_count': 1, 'time': now.isoformat()},
+        'resolve_auctions': {'auctions': [
+            {'fingerprint': '{}-batch-{}'.format(fingerprint, number), 'bids': bids,
+             'item_name': 'Benchmark item', 'item_count': 1, 'time': now.isoformat()}
+            for number in range(5)]},
+        'preview_auction': {'bids': bids, 'item_name': 'Benchmark item', 'item_count': 1},
+        'correct_auction': {'fingerprint': fingerprint, 'bids': bids[:1]},
+        'cancel_auction': {'fingerprint': fingerprint},
+        'resolve_flags': {'players': names, 'item_name': 'Benchmark item', 'item_count': 1},
+    }
+    result = []
+    for prefix, viewset, basename in router.registry:
+        path = '/api/{}/'.format(prefix)
+        if prefix in posts:
+            result.append(('POST ' + path, 'post', path, posts[prefix]))
+            continue
+        result.append(('GET ' + path, 'get', path, None))
+        if prefix == 'characters':
+            detail = '{}{}/'.format(path, sample['main'])
+            result.append(('GET {}<pk>/'.format(path), 'get', detail, None))
+    return result
+
+
+def _measure(client, method, path, data, headers):
+    tracemalloc.start()
+    # the api views print debugging output, keep it out of the report
+    with CaptureQueriesContext(connection) as queries, contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        if method == 'post':
+            response = client.post(path, json.dumps(data), content_type='application/json', **headers)
+        else:
+            response = client.get(path, **headers)
+        if response.streaming:
+            # streamed pages run their queries as the body is read
+            b''.join(response.streaming_content)
+        elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return response.status_code, elapsed, len(queries), peak
+
+
+class Command(BaseCommand):
+    help = ('Time every padkp_show page and padkp_api endpoint against synthetic guilds of several '
+            'sizes, reporting wall time, query count and peak memory as JSON. Runs in a throwaway '
+            'test database, the configured database is not touched.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='50,200',
+                            help='comma separated numbers of characters to generate')
+        parser.add_argument('--years', type=float, default=1)
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='write the report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(x) for x in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes must be a comma separated list of integers')
+
+        report = {'years': options['years'], 'repeat': options['repeat'],
+                  'seed': options['seed'], 'sizes': []}
+        setup_test_environment()
+        try:
+            for size in sizes:
+                report['sizes'].append(self.run_size(size, options))
+        finally:
+            teardown_test_environment()
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            print(output)
+
+    def run_size(self, size, options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            counts = generate_guild(characters=size, years=options['years'], seed=options['seed'])
+            user = User.objects.create_user('benchmark')
+            headers = {'HTTP_AUTHORIZATION': 'Token {}'.format(Token.objects.create(user=user).key)}
+            mains = list(Character.objects.filter(status=Character.MAIN, inactive=False)
+                         .order_by('name').values_list('name', flat=True)[:5])
+            sample = {
+                'main': mains[0],
+                'bidders': mains,
+                'casual': CasualCharacter.objects.order_by('name').values_list('name', flat=True)[0],
+                'auction': Auction.objects.order_by('id').values_list('id', flat=True).last(),
+            }
+
+            client = Client()
+            timings = {}
+            for run in range(options['repeat']):
+                for label, method, path, data in _show_requests(sample) + _api_requests(sample, run):
+                    status, elapsed, queries, peak = _measure(client, method, path, data, headers)
+                    timing = timings.setdefault(label, {'status': status, 'wall_ms': [],
+                                                        'queries': [], 'peak_kb': []})
+                    timing['wall_ms'].append(elapsed * 1000)
+                    timing['queries'].append(queries)
+                    timing['peak_kb'].append(peak / 1024)
+
+            endpoints = {}
+            for label, timing in timings.items():
+                endpoints[label] = {
+                    'status': timing['status'],
+                    'wall_ms': round(statistics.median(timing['wall_ms']), 2),
+                    'wall_ms_min': round(min(timing['wall_ms']), 2),
+                    'queries': max(timing['queries']),
+                    'peak_kb': round(max(timing['peak_kb']), 1),
+                }
+                self.stderr.write('{:>6} characters {:<40} {:>9.2f} ms {:>5} queries'.format(
+                    size, label, endpoints[label]['wall_ms'], endpoints[label]['queries']))
+            return {'characters': size, 'rows': counts, 'endpoints': endpoints}
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -1,5 +1,6 @@
 import datetime as dt
 from padkp_show.models import Character, RaidDump
+from padkp_show.ledger import bulk_attendance, write_checkpoints
 
 from django.core.management.base import BaseCommand, CommandError
 
@@ -11,8 +12,10 @@ class Command(BaseCommand):
         pass
 
     def handle(self, *args, **options):
+        attendance_by_name = bulk_attendance()
         for character in Character.objects.all():
-            bonus = int(character.attendance(30)/5)
+            bonus = int(attendance_by_name[character.name][30]/5)
             character.cap_alt_dkp(500, dry_run=False)
             if bonus > 0:
                 character.give_bonus(bonus, 'CoTF Bonus: 20 dkp max based on 30 day attendance', dry_run=False)
+        write_checkpoints()
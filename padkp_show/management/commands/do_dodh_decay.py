@@ -1,5 +1,6 @@
 import datetime as dt
 from padkp_show.models import Character, RaidDump
+from padkp_show.ledger import bulk_attendance, write_checkpoints
 
 from django.core.management.base import BaseCommand, CommandError
 
@@ -11,9 +12,11 @@ class Command(BaseCommand):
         pass
 
     def handle(self, *args, **options):
+        attendance_by_name = bulk_attendance()
         for character in Character.objects.all():
             character.decay_dkp(
                 0.5, '50% DKP decay for Depths of Darkhollow', dry_run=False)
-            attendance = character.attendance(30)
+            attendance = attendance_by_name[character.name][30]
             character.give_bonus(
                 int(attendance/2.), 'DoDH bonus: 50% of 30 day attendance', dry_run=False)
+        write_checkpoints()
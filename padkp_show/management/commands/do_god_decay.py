@@ -1,5 +1,6 @@
 import datetime as dt
 from padkp_show.models import Character, RaidDump
+from padkp_show.ledger import bulk_attendance, write_checkpoints
 
 from django.core.management.base import BaseCommand, CommandError
 
@@ -10,9 +11,11 @@ class Command(BaseCommand):
         pass
 
     def handle(self, *args, **options):
+        attendance_by_name = bulk_attendance()
         for character in Character.objects.all():
             character.decay_dkp(0.8, '80% DKP decay for gates of discord', dry_run=False)
-            attendance = character.attendance(30)
+            attendance = attendance_by_name[character.name][30]
             if attendance >= 50:
                 character.give_bonus(int(attendance/2.), 'GoD bonus: 50% of 30 day attendance', dry_run=False)
+        write_checkpoints()
 
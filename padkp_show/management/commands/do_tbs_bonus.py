@@ -1,5 +1,6 @@
 import datetime as dt
 from padkp_show.models import Character, RaidDump
+from padkp_show.ledger import bulk_attendance, write_checkpoints
 
 from django.core.management.base import BaseCommand, CommandError
 
@@ -11,7 +12,9 @@ class Command(BaseCommand):
         pass
 
     def handle(self, *args, **options):
+        attendance_by_name = bulk_attendance()
         for character in Character.objects.all():
-            bonus = int(character.attendance(30)/2)
+            bonus = int(attendance_by_name[character.name][30]/2)
             if bonus > 0:
                 character.give_bonus(bonus, 'TBS Bonus: 50 dkp max based on 30 day attendance', dry_run=False)
+        write_checkpoints()
@@ -1,6 +1,7 @@
 import datetime as dt
 import datetime as dt
 from padkp_show.models import Character, RaidDump
+from padkp_show.ledger import bulk_attendance, write_checkpoints
 
 from django.core.management.base import BaseCommand, CommandError
 
@@ -12,7 +13,9 @@ class Command(BaseCommand):
         pass
 
     def handle(self, *args, **options):
+        attendance_by_name = bulk_attendance()
         for character in Character.objects.all():
-            attendance = character.attendance(30)
+            attendance = attendance_by_name[character.name][30]
             character.give_bonus(
                 int(attendance/2.5), 'TSS Bonus: 40 dkp max based on 30 day attendance', dry_run=False)
+        write_checkpoints()
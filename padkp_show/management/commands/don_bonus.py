@@ -1,5 +1,6 @@
 import datetime as dt
 from padkp_show.models import Character, RaidDump
+from padkp_show.ledger import bulk_attendance, write_checkpoints
 
 from django.core.management.base import BaseCommand, CommandError
 
@@ -10,7 +11,9 @@ class Command(BaseCommand):
         pass
 
     def handle(self, *args, **options):
+        attendance_by_name = bulk_attendance()
         for character in Character.objects.all():
-            if character.attendance(30) >= 50:
+            if attendance_by_name[character.name][30] >= 50:
                 character.give_bonus(25, 'Bonus for >50% attendance in the last 30 days of omens', dry_run=False)
+        write_checkpoints()
 
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from padkp_show.snapshot import export_site
+
+
+class Command(BaseCommand):
+    help = ('Render the public pages and every character page to static, pre-compressed files. '
+            'Only pages whose data changed since the last export are rewritten.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', nargs='?', default=getattr(settings, 'SNAPSHOT_DIR', None),
+                            help='where to write the pages, defaults to SNAPSHOT_DIR')
+        parser.add_argument('--full', action='store_true', help='rewrite every page')
+
+    def handle(self, *args, **options):
+        if not options['directory']:
+            raise CommandError('give a directory or set SNAPSHOT_DIR')
+        counts = export_site(options['directory'], full=options['full'])
+        print('wrote {} pages, removed {}'.format(counts['pages'], counts['removed']))
@@ -0,0 +1,29 @@
+import json
+
+from padkp_show.models import Character, CasualCharacter
+from padkp_show.synthetic import generate_guild
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Fill an empty database with a deterministic synthetic guild for load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--characters', type=int, default=100)
+        parser.add_argument('--alts', type=float, default=0.5,
+                            help='fraction of mains that own an alt')
+        parser.add_argument('--years', type=float, default=1)
+        parser.add_argument('--auctions-per-night', type=int, default=4)
+        parser.add_argument('--casual-characters', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if Character.objects.exists() or CasualCharacter.objects.exists():
+            raise CommandError('refusing to generate a guild into a database that already has characters')
+        counts = generate_guild(characters=options['characters'], alts=options['alts'],
+                                years=options['years'],
+                                auctions_per_night=options['auctions_per_night'],
+                                casual_characters=options['casual_characters'],
+                                seed=options['seed'])
+        print(json.dumps(counts, indent=2))
@@ -1,5 +1,6 @@
 import datetime as dt
 from padkp_show.models import Character, RaidDump
+from padkp_show.ledger import bulk_attendance, write_checkpoints
 
 from django.core.management.base import BaseCommand, CommandError
 
@@ -20,7 +21,9 @@ class Command(BaseCommand):
         for character in Character.objects.all():
             character.decay_dkp(0.5, '50% DKP decay for planes of power', dry_run=False)
 
+        attendance_by_name = bulk_attendance()
         for character in Character.objects.all():
-            if character.attendance(30) >= 50:
+            if attendance_by_name[character.name][30] >= 50:
                 character.give_bonus(40, 'Bonus for >50% attendance in the last 30 days of luclin', dry_run=False)
+        write_checkpoints()
 
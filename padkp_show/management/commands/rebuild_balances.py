@@ -0,0 +1,22 @@
+from padkp_show.ledger import rebuild_balances, rebuild_attendance, rebuild_entries, bump_generation, FAMILIES
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Recompute stored DKP balances, attendance buckets and ledger entries from the raw ledger'
+
+    def add_arguments(self, parser):
+        pass
+
+    def handle(self, *args, **options):
+        for family in FAMILIES:
+            balances = rebuild_balances(family)
+            print('rebuilt balances for {} {} characters'.format(
+                len(balances), family.character._meta.verbose_name))
+        rebuild_attendance()
+        print('rebuilt attendance buckets')
+        for family in FAMILIES:
+            rebuild_entries(family)
+        print('rebuilt ledger entries')
+        bump_generation()
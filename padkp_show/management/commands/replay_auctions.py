@@ -0,0 +1,72 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from padkp_show import auction_rules
+from padkp_show.models import Auction, AuctionBid, Purchase
+
+
+class Command(BaseCommand):
+    help = ('Re-run the stored auctions through padkp_show.auction_rules from their recorded bid '
+            'snapshots, print every auction that awards differently than its recorded purchases, '
+            'and report the throughput as JSON. Each auction is replayed with the rules it was '
+            'resolved with; corrected auctions are skipped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rules', choices=['vickrey', 'english'],
+                            help='replay every auction with these rules instead of the recorded ones. '
+                                 'auctions from before the rules were recorded use vickrey by default')
+        parser.add_argument('--limit', type=int, help='only replay the most recent auctions')
+
+    def handle(self, *args, **options):
+        if options['limit'] is not None and options['limit'] < 1:
+            raise CommandError('--limit must be positive')
+        start = time.perf_counter()
+        auctions = Auction.objects.order_by('-time', '-pk').values_list(
+            'pk', 'fingerprint', 'item_name', 'item_count', 'time', 'corrected', 'auction_type')
+        if options['limit']:
+            auctions = auctions[:options['limit']]
+        auctions = list(reversed(auctions))
+
+        bids = AuctionBid.objects.all()
+        purchases = Purchase.objects.filter(auction__isnull=False)
+        if options['limit'] and auctions:
+            bids = bids.filter(auction__time__gte=auctions[0][4])
+            purchases = purchases.filter(auction__time__gte=auctions[0][4])
+        records = {}
+        for auction, name, bid, tag, dkp, attendance in bids.order_by('pk').values_list(
+                'auction', 'character', 'bid', 'tag', 'dkp_snapshot', 'att_snapshot'):
+            records.setdefault(auction, []).append(auction_rules.BidRecord(name, bid, tag, dkp, attendance))
+        recorded = {}
+        for auction, name, value, is_alt in purchases.values_list('auction', 'character', 'value', 'is_alt'):
+            recorded.setdefault(auction, []).append((name, value, is_alt))
+        loaded = time.perf_counter()
+
+        replayed = skipped = divergent = 0
+        for pk, fingerprint, item_name, item_count, when, corrected, auction_type in auctions:
+            if corrected:
+                skipped += 1
+                continue
+            rule = getattr(auction_rules, options['rules'] or auction_type or 'vickrey')
+            tie_losers, winners = rule(records.get(pk, []), item_count, auction_rules.seeded_rng(fingerprint))
+            replayed += 1
+            awarded = sorted((record.name, price, record.tag == 'ALT') for record, price in winners)
+            expected = sorted(recorded.get(pk, []))
+            if awarded != expected:
+                divergent += 1
+                print('auction {} ({} on {}): recorded {}, replayed {}{}'.format(
+                    pk, item_name, when.isoformat(), expected, awarded,
+                    ' after a tie' if tie_losers else ''))
+        finished = time.perf_counter()
+
+        print(json.dumps({
+            'rules': options['rules'] or 'recorded',
+            'auctions': len(auctions),
+            'replayed': replayed,
+            'skipped_corrected': skipped,
+            'divergent': divergent,
+            'load_seconds': round(loaded - start, 3),
+            'replay_seconds': round(finished - loaded, 3),
+            'auctions_per_second': round(replayed / (finished - loaded), 1) if finished > loaded else None,
+        }, indent=2))
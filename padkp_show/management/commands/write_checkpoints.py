@@ -0,0 +1,14 @@
+from padkp_show.ledger import write_checkpoints
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Record a balance checkpoint for every character, meant to be run on a schedule'
+
+    def add_arguments(self, parser):
+        pass
+
+    def handle(self, *args, **options):
+        count = write_checkpoints()
+        print('wrote balance checkpoints for {} characters'.format(count))
@@ -1,12 +1,14 @@
 import datetime as dt
+import random
 import re
 import pytz
-import random
 
-from django.db import models
-from django.db.models import Sum
+from django.db import models, transaction
+from django.db.models import F, Q
 from django.core.exceptions import ObjectDoesNotExist
 
+from . import auction_rules
+
 DON_RELEASE = dt.datetime(year=2020, month=11, day=16)
 
 EQ_CLASSES = [
@@ -41,41 +43,26 @@ class Character(models.Model):
         return self.cleaned_data['name'].capitalize()
 
     def attendance(self, days):
-        days_ago = pytz.utc.localize(
-            dt.datetime.utcnow()) - dt.timedelta(days=days)
-        raid_dumps = RaidDump.objects.filter(
-            time__gte=days_ago).aggregate(total=Sum('attendance_value'))
-        my_raid_dumps = RaidDump.objects.filter(time__gte=days_ago).filter(
-            characters_present=self.name).aggregate(total=Sum('attendance_value'))
-        my_awards = DkpSpecialAward.objects.filter(time__gte=days_ago).filter(
-            character=self.name).aggregate(total=Sum('attendance_value'))
-        my_attendance_points = (
-            my_raid_dumps['total'] or 0) + (my_awards['total'] or 0)
-        return 100 * float(my_attendance_points) / (raid_dumps['total'] or 1)
+        from .ledger import bulk_attendance
+        return bulk_attendance([self.name], (days,))[self.name][days]
 
-    def current_dkp(self):
-        dumps = RaidDump.objects.filter(
-            characters_present=self.name).aggregate(total=Sum('value'))
-        purchases = Purchase.objects.filter(
-            is_alt=False, character=self.name).aggregate(total=Sum('value'))
-        extra_awards = DkpSpecialAward.objects.filter(
-            character=self.name).aggregate(total=Sum('value'))
+    def balance(self):
+        """ the stored CharacterBalance for this character, built on first use """
+        from .ledger import get_balance
+        return get_balance(self.name)
 
-        current_dkp = (dumps['total'] or 0) + \
-            (extra_awards['total'] or 0) - (purchases['total'] or 0)
-        return current_dkp
+    def current_dkp(self):
+        return self.balance().main_dkp
 
     def current_alt_dkp(self):
-        dumps = RaidDump.objects.filter(
-            time__gte=DON_RELEASE, characters_present=self.name).aggregate(total=Sum('value'))
-        purchases = Purchase.objects.filter(
-            character=self.name, is_alt=True).aggregate(total=Sum('value'))
-        extra_awards = DkpSpecialAward.objects.filter(
-            time__gte=DON_RELEASE, character=self.name).aggregate(total=Sum('value'))
+        return self.balance().alt_dkp
 
-        current_dkp = (dumps['total'] or 0) + \
-            (extra_awards['total'] or 0) - (purchases['total'] or 0)
-        return current_dkp
+    def display_rank(self):
+        if self.inactive:
+            return 'Inactive'
+        if self.leave_of_absence:
+            return 'Leave of Absence'
+        return self.get_status_display()
 
     def decay_dkp(self, decay, notes, dry_run=True):
         current_dkp = self.current_dkp()
@@ -152,10 +139,145 @@ class Character(models.Model):
             except ObjectDoesNotExist:
                 return False, None
 
+    @classmethod
+    def find_characters(cls, cnames):
+        """ find_character for many names with a single query. returns
+        {cname: (is_alt, character)}, (False, None) for unknown names """
+        names = {cname: re.sub("'s alt", "", cname, flags=re.IGNORECASE) for cname in cnames}
+        wanted = set(names.values())
+        mains = {}
+        alts = {}
+        # one row per (character, alt) pair, the alt join is shared by filter and annotate
+        for character in cls.objects.filter(Q(name__in=wanted) | Q(characteralt__name__in=wanted)).annotate(
+                alt=F('characteralt__name')):
+            if character.alt in wanted:
+                alts[character.alt] = character
+            if character.name in wanted:
+                mains[character.name] = character
+
+        result = {}
+        for cname, name in names.items():
+            if name in alts:
+                result[cname] = True, alts[name]
+            elif name in mains:
+                result[cname] = name != cname, mains[name]
+            else:
+                result[cname] = False, None
+        return result
+
 
 Character._meta.ordering = ['name']
 
 
+class BaseBalance(models.Model):
+    """ Materialized DKP totals for a character.
+
+    Maintained by padkp_show.ledger whenever a raid dump, purchase or special
+    award touching the character is written, so reading a balance is a single
+    primary key lookup. Rebuild with the rebuild_balances command.
+    """
+    main_dkp = models.IntegerField(default=0)
+    alt_dkp = models.IntegerField(default=0)
+    earned = models.IntegerField(default=0)
+    spent = models.IntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+    def __str__(self):
+        return '{}: {} dkp ({} alt)'.format(self.character_id, self.main_dkp, self.alt_dkp)
+
+
+class CharacterBalance(BaseBalance):
+    character = models.OneToOneField(
+        Character, primary_key=True, on_delete=models.CASCADE)
+
+
+class BalanceCheckpoint(models.Model):
+    """ A character's DKP totals as of a point in time, covering every ledger
+    entry at or before that time. Written by padkp_show.ledger.write_checkpoints
+    and used to answer point-in-time balance questions without summing the
+    whole history. """
+    character = models.ForeignKey(Character, on_delete=models.CASCADE)
+    time = models.DateTimeField()
+    main_dkp = models.IntegerField(default=0)
+    alt_dkp = models.IntegerField(default=0)
+    earned = models.IntegerField(default=0)
+    spent = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [('character', 'time')]
+
+    def __str__(self):
+        return '{} as of {}: {} dkp ({} alt)'.format(self.character_id, self.time, self.main_dkp, self.alt_dkp)
+
+
+class AttendanceDay(models.Model):
+    """ Total attendance points handed out by raid dumps on one raid day.
+
+    A raid day is a calendar day in US/Eastern. Maintained by padkp_show.ledger.
+    """
+    day = models.DateField(primary_key=True)
+    available = models.IntegerField(default=0)
+
+    def __str__(self):
+        return '{}: {} attendance points'.format(self.day, self.available)
+
+
+class CharacterAttendanceDay(models.Model):
+    """ Attendance points a character earned on one raid day, from raid dumps
+    and special awards. Maintained by padkp_show.ledger. """
+    character = models.ForeignKey(Character, on_delete=models.CASCADE)
+    day = models.DateField()
+    earned = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [('character', 'day')]
+        indexes = [models.Index(fields=['day'])]
+
+    def __str__(self):
+        return '{} on {}: {} attendance points'.format(self.character_id, self.day, self.earned)
+
+
+class CharacterProfile(models.Model):
+    """ The summary shown at the top of a character's page. Built by
+    padkp_show.ledger.get_profile and valid for the ledger generation and raid
+    day it was built on. """
+    character = models.OneToOneField(
+        Character, primary_key=True, on_delete=models.CASCADE)
+    character_class = models.CharField(max_length=20)
+    rank = models.CharField(max_length=20)
+    alts = models.TextField(default="", blank=True)
+    main_dkp = models.IntegerField(default=0)
+    alt_dkp = models.IntegerField(default=0)
+    attendance_30 = models.FloatField(default=0)
+    last_raid = models.DateTimeField(blank=True, null=True)
+    generation = models.BigIntegerField(default=0)
+    day = models.DateField()
+
+    def alt_names(self):
+        return self.alts.split(',') if self.alts else []
+
+    def days_since_raid(self):
+        if self.last_raid is None:
+            return None
+        return (dt.datetime.now(dt.timezone.utc) - self.last_raid).days
+
+    def __str__(self):
+        return 'profile of {}'.format(self.character_id)
+
+
+class LedgerGeneration(models.Model):
+    """ A single row counting writes to the DKP data. Bumped by padkp_show.ledger
+    whenever a character, raid dump, award, purchase or auction changes, and used
+    to version cached pages. """
+    generation = models.BigIntegerField(default=0)
+    changed = models.DateTimeField()
+
+    def __str__(self):
+        return 'generation {} at {}'.format(self.generation, self.changed)
+
+
 class CharacterAlt(models.Model):
     """ Represents a member's alt """
     name = models.CharField(primary_key=True, max_length=100)
@@ -165,7 +287,20 @@ class CharacterAlt(models.Model):
         return self.name
 
 
-class RaidDump(models.Model):
+class LedgerSource(models.Model):
+    """ A raid dump, special award or purchase. Saving one refreshes the derived
+    ledger tables from padkp_show.ledger's post_save handlers, and the save and
+    the refresh commit together or not at all. """
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+
+
+class RaidDump(LedgerSource):
     """ Represents a raid dump upload. Awards dkp and optionally attendance"""
     value = models.IntegerField()
     attendance_value = models.IntegerField()
@@ -180,6 +315,9 @@ class RaidDump(models.Model):
     award_type = models.CharField(max_length=15, choices=type_choices)
     notes = models.TextField(default="", blank=True)
 
+    class Meta:
+        indexes = [models.Index(fields=['time'])]
+
     def __str__(self):
         attendance_str = '' if self.attendance_value else " -- not counted for attendance"
         notes_str = '' if not self.notes else '({}) '.format(self.notes)
@@ -188,7 +326,7 @@ class RaidDump(models.Model):
         return '{} for {} {}on {} {}'.format(self.value, self.award_type, notes_str, time_str, attendance_str)
 
 
-class DkpSpecialAward(models.Model):
+class DkpSpecialAward(LedgerSource):
     """ represents a character being awarded dkp or attendance that is not attached
     to a raid dump.
 
@@ -201,6 +339,9 @@ class DkpSpecialAward(models.Model):
     time = models.DateTimeField(default=dt.datetime.utcnow, blank=True)
     notes = models.TextField(default="", blank=True)
 
+    class Meta:
+        indexes = [models.Index(fields=['character', 'time'])]
+
     def __str__(self):
         attendance_str = '' if self.attendance_value else " -- not counted for attendance"
         notes_str = '' if not self.notes else '({}) '.format(self.notes)
@@ -216,6 +357,11 @@ class Auction(models.Model):
     item_name = models.CharField(max_length=200)
     item_count = models.IntegerField(default=1)
     corrected = models.BooleanField(default=False)
+    # the reply sent when the auction was resolved, returned again to retries
+    message = models.TextField(default="", blank=True)
+    warnings = models.TextField(default="", blank=True)
+    # the rules it was resolved with, blank for auctions from before they were recorded
+    auction_type = models.CharField(max_length=10, default="", blank=True)
 
     class Meta:
         ordering = ['-time']
@@ -225,146 +371,105 @@ class Auction(models.Model):
             'US/Eastern')).strftime('%A, %d %b %Y %I:%M %p Eastern')
         return 'auction for {}x{} on {}'.format(self.item_name, self.item_count, time_str)
 
-    def process_bids(self, bids):
-        warnings = []
-        for bid in bids:
-            if int(bid['bid']) == 0:
-                continue
-            is_alt, char = Character.find_character(bid['name'])
-            if bid['tag'] == 'Main':
-                is_alt = False
-            if not char:
-                warnings.append(
-                    'Received bid for unknown character: {}'.format(bid['name']))
-                continue
-            dkp = char.current_dkp()
-            attendance = char.attendance(30)
-            if is_alt or bid['tag'] == 'ALT':
-                bid['tag'] = 'ALT'
-                dkp = char.current_alt_dkp()
-            elif char.status != 'MN' and bid['tag'] not in ['INA', 'FNF', 'Recruit']:
-                warnings.append('{} bid with tag "{}" but is registered as "{}"'.format(
-                    bid['name'], bid['tag'], char.status))
-
-            if dkp < int(bid['bid']):
-                # warnings.append('{} bid {} dkp but only has {} on the site, lowered their bid'.format(
-                warnings.append('{} bid {} dkp but only has {} on the site'.format(
-                    bid['name'], bid['bid'], dkp
-                ))
-                # bid['bid'] = dkp
-
-            AuctionBid(
-                auction=self, bid=bid['bid'], tag=bid['tag'], character=char, dkp_snapshot=dkp, att_snapshot=attendance
-            ).save()
+    def warning_list(self):
+        return self.warnings.split('\n') if self.warnings else []
+
+    def process_bids(self, bids, balances=None, found=None):
+        """ record the bids with their dkp and attendance snapshots. names,
+        balances and attendance are looked up for all bidders at once.
+
+        balances is an optional ledger.bulk_balances() result to read the
+        snapshots from; bidders missing from it are looked up and added. found
+        is an optional Character.find_characters() result for the bid names,
+        names missing from it are looked up.
+        """
+        from .ledger import bump_generation
+        with transaction.atomic():
+            rows, warnings = self.bid_rows(bids, balances, found=found)
+            AuctionBid.objects.bulk_create(rows)
+            # bulk_create sends no post_save, record the write ourselves
+            bump_generation()
         return warnings
 
-    def determine_winners_english(self):
-        def ordering(bid):
-            char = bid.character
-            max_bid = bid.bid
-            if bid.tag == 'ALT':
-                max_bid = min(max_bid, 5)
-            if bid.tag in ['INA', 'Recruit', 'FNF']:
-                max_bid = min(max_bid, 10)
-            return max_bid, bid.bid, bid.dkp_snapshot, bid.att_snapshot
-
-        bids = [b for b in self.auctionbid_set.all()]
-        sorting_criteria = {b: ordering(b) for b in bids}
-        random.shuffle(bids)
-        winners_in_order = sorted(
-            bids, key=lambda b: sorting_criteria[b], reverse=True)
-        tie_losers = []
-        if len(winners_in_order) > self.item_count:  # More bidders than items to hand out
-            i = self.item_count
-            while winners_in_order[i-1].bid == winners_in_order[i].bid:
-                tie_losers.append(winners_in_order[i].character.name)
-                i += 1
-                if len(winners_in_order) == i:
-                    break
-
-        result = [{'char': w.character, 'bid': w.bid, 'tag': w.tag } for w in winners_in_order[0:self.item_count]]
-
-        return [tie_losers, result]
-
-
-    def determine_winners_vickrey(self):
-        def max_bid(bid):
-            max_bid = bid.bid
-            if bid.tag == 'ALT':
-                max_bid = min(max_bid, 5)
-            return max_bid
-
-        def ordering(bid):
-            return max_bid(bid), bid.bid
-
-        def offset_value(target, offset, tie_fallback):
-            if offset is None:
-                return 5
-            if offset.tag == 'ALT' and target.tag != 'ALT':
-                return max_bid(offset)+1
-            if offset.bid == target.bid or offset.character == target.character:
-                return min(tie_fallback, target.bid)
-            return offset.bid+1
-
-
-        bids = [b for b in self.auctionbid_set.all()]
-        sorting_criteria = {b: ordering(b) for b in bids}
-        random.shuffle(bids)
-        winners_in_order = sorted(
-            bids, key=lambda b: sorting_criteria[b], reverse=True)
-
-        main_winners = [x for x in winners_in_order[0:self.item_count] if x.tag != 'ALT' ]
-        alt_winners = [x for x in winners_in_order[0:self.item_count] if x.tag == 'ALT' ]
-        all_winners = main_winners + alt_winners
-        left_overs = [x for x in winners_in_order if x not in all_winners]
-        result = []
-        tie_losers = []
-
-        effective_count = min(len(all_winners), self.item_count)
-
-        if effective_count == 0:
-            return [tie_losers, reversed(result)]
-
-        # print('all:', all_winners)
-        # print('leftovers:', left_overs)
-
-        last_winner = all_winners[effective_count-1]
-        offset_from = None
-        if self.item_count > 1 and self.item_count <= len(bids):
-            offset_from = last_winner
-        for possible in all_winners[effective_count:]:
-            if possible.character != last_winner.character:
-                if possible.bid == last_winner.bid:
-                    tie_losers.append(possible.character.name)
-                if offset_from is None:
-                    offset_from = possible
-        for possible in left_overs:
-            if possible.character != last_winner.character:
-                if possible.bid == last_winner.bid:
-                    tie_losers.append(possible.character.name)
-                if offset_from is None:
-                    offset_from = possible
-
-        replacing = last_winner.bid
-
-        def last_result_bid():
-            if len(result) > 0:
-                return result[len(result)-1]['bid']
-            else:
-                return 10000
-
-        # print(offset_from)
-        # print(last_winner)
-        for winner in reversed(all_winners[0:effective_count]):
-            new_bid = min(last_result_bid(), offset_value(winner, offset_from, last_result_bid()))
-            # print(f'{new_bid}:{replacing}')
-            offset_from = winner
-            replacing = winner.bid
+    def bid_rows(self, bids, balances=None, store=True, found=None):
+        """ the unsaved AuctionBid rows for the bids and the warnings about them,
+        see process_bids. with store=False nothing is written, not even a
+        missing stored balance. """
+        from .ledger import bulk_balances
+        warnings = []
+        bids = [bid for bid in bids if int(bid['bid']) != 0]
+        names = [bid['name'] for bid in bids]
+        if found is None:
+            found = Character.find_characters(names)
+        elif any(name not in found for name in names):
+            found = dict(found, **Character.find_characters([name for name in names if name not in found]))
+        if balances is None:
+            balances = {}
+        missing = {char.name for _, char in found.values() if char and char.name not in balances}
+        if missing:
+            balances.update(bulk_balances(missing, windows=(30,), store=store))
+        rows = []
+        for bid in bids:
+            row = self._bid_row(bid, found[bid['name']], balances, warnings)
+            if row is not None:
+                rows.append(row)
+        return rows, warnings
+
+    def _bid_row(self, bid, found, balances, warnings):
+        is_alt, char = found
+        if bid['tag'] == 'Main':
+            is_alt = False
+        if not char:
+            warnings.append(
+                'Received bid for unknown character: {}'.format(bid['name']))
+            return None
+        dkp = balances[char.name]['main_dkp']
+        attendance = balances[char.name]['attendance'][30]
+        if is_alt or bid['tag'] == 'ALT':
+            bid['tag'] = 'ALT'
+            dkp = balances[char.name]['alt_dkp']
+        elif char.status != 'MN' and bid['tag'] not in ['INA', 'FNF', 'Recruit']:
+            warnings.append('{} bid with tag "{}" but is registered as "{}"'.format(
+                bid['name'], bid['tag'], char.status))
+
+        if dkp < int(bid['bid']):
+            # warnings.append('{} bid {} dkp but only has {} on the site, lowered their bid'.format(
+            warnings.append('{} bid {} dkp but only has {} on the site'.format(
+                bid['name'], bid['bid'], dkp
+            ))
+            # bid['bid'] = dkp
+
+        return AuctionBid(
+            auction=self, bid=int(bid['bid']), tag=bid['tag'], character=char, dkp_snapshot=dkp, att_snapshot=attendance
+        )
+
+    def _run_rules(self, rule, bids, rng):
+        """ run one of padkp_show.auction_rules on the bids, the stored ones by
+        default, and map the winners back to characters. ties are broken with
+        an rng seeded from the fingerprint unless another is given, or at
+        random when there is no fingerprint. """
+        if rng is None:
+            rng = auction_rules.seeded_rng(self.fingerprint) if self.fingerprint else random.Random()
+        if bids is None:
+            # in pk order, as replay_auctions reads them, so the seeded shuffle
+            # sees the same sequence
+            bids = self.auctionbid_set.select_related('character').order_by('pk')
+        characters = {}
+        records = []
+        for bid in bids:
+            characters[bid.character_id] = bid.character
+            records.append(auction_rules.BidRecord(bid.character_id, bid.bid, bid.tag,
+                                     bid.dkp_snapshot, bid.att_snapshot))
+        tie_losers, winners = rule(records, self.item_count, rng)
+        return [tie_losers, [{'char': characters[record.name], 'bid': price, 'tag': record.tag}
+                             for record, price in winners]]
 
-            result.append({'char': winner.character, 'bid': new_bid, 'tag': winner.tag })
+    def determine_winners_english(self, bids=None, rng=None):
+        return self._run_rules(auction_rules.english, bids, rng)
 
+    def determine_winners_vickrey(self, bids=None, rng=None):
+        return self._run_rules(auction_rules.vickrey, bids, rng)
 
-        return [tie_losers, reversed(result)]
 
 class AuctionBid(models.Model):
     """ Represents a bid in an auction """
@@ -379,7 +484,7 @@ class AuctionBid(models.Model):
         return '{} bid {} on {}'.format(self.auction.item_name, self.bid, self.character)
 
 
-class Purchase(models.Model):
+class Purchase(LedgerSource):
     """ Represents a character spending DKP for an item"""
     character = models.ForeignKey(Character, on_delete=models.CASCADE)
     item_name = models.CharField(max_length=200)
@@ -390,6 +495,10 @@ class Purchase(models.Model):
     auction = models.ForeignKey(
         Auction, blank=True, null=True, on_delete=models.SET_NULL)
 
+    class Meta:
+        indexes = [models.Index(fields=['character', 'is_alt', 'time']),
+                   models.Index(fields=['time'])]
+
     def character_display(self):
         return self.character.name+"'s alt" if self.is_alt else self.character.name
 
@@ -401,6 +510,44 @@ class Purchase(models.Model):
                                                   'US/Eastern')).strftime("%m/%d/%y"))
 
 
+class BaseLedgerEntry(models.Model):
+    """ One line of a character's history: a raid dump they attended, a special
+    award or a purchase, flattened so a timeline is a single ordered query.
+    Maintained by padkp_show.ledger from the source rows. """
+    DUMP = 'dump'
+    AWARD = 'award'
+    PURCHASE = 'purchase'
+    source_choices = [(DUMP, 'Raid dump'), (AWARD, 'Special award'),
+                      (PURCHASE, 'Purchase')]
+
+    source = models.CharField(max_length=8, choices=source_choices)
+    time = models.DateTimeField()
+    dkp = models.IntegerField(default=0)
+    attendance = models.IntegerField(default=0)
+    is_alt = models.BooleanField(default=False)
+    description = models.TextField(default="", blank=True)
+
+    class Meta:
+        abstract = True
+
+    def __str__(self):
+        return self.description
+
+
+class LedgerEntry(BaseLedgerEntry):
+    character = models.ForeignKey(
+        Character, related_name='ledger_entries', on_delete=models.CASCADE)
+    raid_dump = models.ForeignKey(
+        RaidDump, blank=True, null=True, on_delete=models.CASCADE)
+    award = models.ForeignKey(
+        DkpSpecialAward, blank=True, null=True, on_delete=models.CASCADE)
+    purchase = models.ForeignKey(
+        Purchase, blank=True, null=True, on_delete=models.CASCADE)
+
+    class Meta:
+        indexes = [models.Index(fields=['character', 'time'])]
+
+
 def main_change(name_from, name_to):
     print('main changing {} to {}'.format(name_from, name_to))
     char_from, = Character.objects.filter(name=name_from)
@@ -490,23 +637,26 @@ class CasualCharacter(models.Model):
     def clean_name(self):
         return self.cleaned_data['name'].capitalize()
 
-    def current_dkp(self):
-        dumps = CasualRaidDump.objects.filter(
-            characters_present=self.name).aggregate(total=Sum('value'))
-        purchases = CasualPurchase.objects.filter(
-            character=self.name).aggregate(total=Sum('value'))
-        extra_awards = CasualDkpSpecialAward.objects.filter(
-            character=self.name).aggregate(total=Sum('value'))
+    def balance(self):
+        """ the stored CasualCharacterBalance for this character, built on first use """
+        from .ledger import get_balance, CASUAL
+        return get_balance(self.name, CASUAL)
 
-        current_dkp = (dumps['total'] or 0) + \
-            (extra_awards['total'] or 0) - (purchases['total'] or 0)
-        return current_dkp
+    def current_dkp(self):
+        return self.balance().main_dkp
 
 
 CasualCharacter._meta.ordering = ['name']
 
 
-class CasualRaidDump(models.Model):
+class CasualCharacterBalance(BaseBalance):
+    """ the casual track's CharacterBalance. casual purchases are never alt
+    purchases, so alt_dkp stays 0. """
+    character = models.OneToOneField(
+        CasualCharacter, primary_key=True, on_delete=models.CASCADE)
+
+
+class CasualRaidDump(LedgerSource):
     """ Represents a raid dump upload. Awards dkp and optionally attendance"""
     value = models.IntegerField()
     time = models.DateTimeField()
@@ -516,6 +666,9 @@ class CasualRaidDump(models.Model):
 
     notes = models.TextField(default="", blank=True)
 
+    class Meta:
+        indexes = [models.Index(fields=['time'])]
+
     def __str__(self):
         notes_str = '' if not self.notes else '({}) '.format(self.notes)
         time_str = self.time.astimezone(pytz.timezone(
@@ -523,7 +676,7 @@ class CasualRaidDump(models.Model):
         return '{} on {} -- {}'.format(self.value, time_str, notes_str)
 
 
-class CasualDkpSpecialAward(models.Model):
+class CasualDkpSpecialAward(LedgerSource):
     """ represents a character being awarded dkp or attendance that is not attached
     to a raid dump.
 
@@ -535,6 +688,9 @@ class CasualDkpSpecialAward(models.Model):
     time = models.DateTimeField(default=dt.datetime.utcnow, blank=True)
     notes = models.TextField(default="", blank=True)
 
+    class Meta:
+        indexes = [models.Index(fields=['character', 'time'])]
+
     def __str__(self):
         attendance_str = ''
         notes_str = '' if not self.notes else '({}) '.format(self.notes)
@@ -543,7 +699,7 @@ class CasualDkpSpecialAward(models.Model):
         return '{} {}on {} {}'.format(self.value, notes_str, time_str, attendance_str)
 
 
-class CasualPurchase(models.Model):
+class CasualPurchase(LedgerSource):
     """ Represents a character spending DKP for an item"""
     character = models.ForeignKey(CasualCharacter, on_delete=models.CASCADE)
     item_name = models.CharField(max_length=200)
@@ -551,8 +707,25 @@ class CasualPurchase(models.Model):
     time = models.DateTimeField(default=dt.datetime.utcnow)
     notes = models.TextField(default="", blank=True)
 
+    class Meta:
+        indexes = [models.Index(fields=['character', 'time'])]
+
     def __str__(self):
         return "{} to {} for {} on {}".format(self.item_name,
                                               self.character,
                                               self.value,
                                               self.time.strftime("%m/%d/%y"))
+
+
+class CasualLedgerEntry(BaseLedgerEntry):
+    character = models.ForeignKey(
+        CasualCharacter, related_name='ledger_entries', on_delete=models.CASCADE)
+    raid_dump = models.ForeignKey(
+        CasualRaidDump, blank=True, null=True, on_delete=models.CASCADE)
+    award = models.ForeignKey(
+        CasualDkpSpecialAward, blank=True, null=True, on_delete=models.CASCADE)
+    purchase = models.ForeignKey(
+        CasualPurchase, blank=True, null=True, on_delete=models.CASCADE)
+
+    class Meta:
+        indexes = [models.Index(fields=['character', 'time'])]
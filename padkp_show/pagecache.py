@@ -0,0 +1,65 @@
+"""
+Full-page caching for the public pages, versioned by the ledger generation.
+
+Every write to the DKP data bumps LedgerGeneration (see padkp_show.ledger), so a
+rendered page stays valid until the next write or until the raid day rolls
+over and the attendance windows move. versioned_page caches the response under
+a key made of the generation, the raid day and the request path, and answers
+conditional requests with 304 using an ETag built from the same values and a
+Last-Modified of the last write or the start of the raid day, whichever is
+later.
+"""
+import functools
+
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from . import ledger
+
+TIMEOUT = 24 * 60 * 60
+
+
+def page_version():
+    """ the string cached pages are keyed on, and the time of the last write """
+    number, changed = ledger.generation()
+    stamp = changed.timestamp() if changed else 0
+    return '{}-{}-{}'.format(number, stamp, ledger.today().isoformat()), changed
+
+
+def versioned_page(view):
+    """ cache a GET view that only depends on its URL and the DKP data """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(request, *args, **kwargs)
+
+        version, changed = page_version()
+        etag = '"{}"'.format(version)
+        # the attendance windows move at the start of each raid day
+        day_start = ledger.day_bounds(ledger.today())[0]
+        last_modified = int(max(changed, day_start).timestamp() if changed else day_start.timestamp())
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            key = 'page:{}:{}'.format(version, request.get_full_path())
+            cached = cache.get(key)
+            if cached is not None:
+                content, content_type = cached
+                response = HttpResponse(content, content_type=content_type)
+            else:
+                response = view(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                # streamed pages are only revalidated, never held in the cache
+                if not response.streaming:
+                    if hasattr(response, 'render'):
+                        # template and rest framework responses render lazily
+                        response.render()
+                    cache.set(key, (response.content, response['Content-Type']), TIMEOUT)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        # browsers keep the page but check back every time
+        patch_cache_control(response, no_cache=True)
+        return response
+    return wrapper
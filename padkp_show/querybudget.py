@@ -0,0 +1,92 @@
+"""
+Per-request query accounting.
+
+QueryBudget is a context manager that counts the SQL statements run on a
+connection, their total time and how often each statement shape (the SQL with
+its parameters left as placeholders) repeats, which is what an N+1 pattern
+looks like. QueryBudgetMiddleware wraps every request in one when
+QUERY_BUDGET_ENABLED is set, adds the numbers as response headers when
+QUERY_BUDGET_HEADERS is set, and logs requests that run more than QUERY_BUDGET
+queries. QueryBudgetTestMixin gives test cases assertMaxQueries().
+"""
+import collections
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUDGET = 50
+
+
+class QueryBudget(object):
+    """ records the queries run on a connection while the context is active """
+
+    def __init__(self, using=connection):
+        self.connection = using
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = collections.Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.count += 1
+            self.shapes[sql] += 1
+
+    def __enter__(self):
+        self._wrapper = self.connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._wrapper.__exit__(*exc_info)
+
+    def repeated(self, top=5):
+        """ the most repeated statement shapes as (count, sql), most repeated first """
+        return [(count, sql) for sql, count in self.shapes.most_common(top) if count > 1]
+
+    def summary(self, top=5):
+        lines = ['{} queries in {:.1f} ms'.format(self.count, self.seconds * 1000)]
+        lines += ['  {}x {}'.format(count, sql) for count, sql in self.repeated(top)]
+        return '\n'.join(lines)
+
+
+class QueryBudgetMiddleware(object):
+    """ reports and logs the queries each request runs, see the module docstring """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not getattr(settings, 'QUERY_BUDGET_ENABLED', False):
+            return self.get_response(request)
+
+        with QueryBudget() as budget:
+            response = self.get_response(request)
+        if getattr(settings, 'QUERY_BUDGET_HEADERS', False):
+            response['X-Query-Count'] = str(budget.count)
+            response['X-Query-Time-Ms'] = '{:.1f}'.format(budget.seconds * 1000)
+            response['X-Query-Repeated'] = str(sum(count for count, _ in budget.repeated(top=None)))
+        limit = getattr(settings, 'QUERY_BUDGET', DEFAULT_BUDGET)
+        if budget.count > limit:
+            logger.warning('%s %s went over its query budget of %s: %s',
+                           request.method, request.path, limit, budget.summary())
+        return response
+
+
+class QueryBudgetTestMixin(object):
+    """ for TestCase subclasses """
+
+    def assertMaxQueries(self, limit, func, *args, **kwargs):
+        """ call func and fail if it runs more than limit queries """
+        with QueryBudget() as budget:
+            result = func(*args, **kwargs)
+        if budget.count > limit:
+            self.fail('expected at most {} queries, ran {}'.format(limit, budget.summary()))
+        return result
@@ -0,0 +1,183 @@
+"""
+Static export of the public pages for nginx to serve directly.
+
+export_site() renders the index, attendance, class balance, items and awards
+pages and every character page into a directory, each as index.html plus a
+gzipped index.html.gz for gzip_static. A state file in the directory records
+the page version (see padkp_show.pagecache) and a fingerprint of each
+character's ledger, so an export after a write only re-renders the shared
+pages and the pages of the characters whose entries changed. A change to the
+raid dumps or a new raid day moves everyone's attendance and re-renders every
+page.
+
+When SNAPSHOT_DIR is set, SnapshotMiddleware starts an export in a background
+thread after each write to one of the API endpoints in WRITE_ENDPOINTS has
+committed. The export_site command does the same on demand or from cron.
+"""
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import threading
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Max
+from django.test import RequestFactory
+from django.urls import resolve
+
+from .models import Character, CharacterAlt, LedgerEntry, RaidDump
+from .pagecache import page_version
+from . import ledger
+
+logger = logging.getLogger(__name__)
+
+PAGES = ('/', '/attendance/', '/class_balance/', '/items/', '/awards/')
+STATE_FILE = '.snapshot.json'
+# the padkp_api endpoints whose writes change an exported page
+WRITE_ENDPOINTS = ('/api/upload_dump/', '/api/charge_dkp/', '/api/resolve_auction/',
+                   '/api/resolve_auctions/', '/api/correct_auction/', '/api/cancel_auction/',
+                   '/api/characters/', '/api/awards/')
+
+# one export thread per process at a time; writes while it runs ask it for
+# another pass
+_export_lock = threading.Lock()
+_export = {'running': False, 'again': False}
+
+
+def _raid_fingerprint():
+    dumps = RaidDump.objects.order_by('pk').values_list('pk', 'time', 'value', 'attendance_value')
+    return hashlib.sha256(repr(list(dumps)).encode()).hexdigest()
+
+
+def _character_fingerprints():
+    """ {name: fingerprint} of everything a character page shows. ledger entries
+    are rewritten with new ids whenever their source changes, so the entry
+    count and newest id move with any edit. """
+    entries = {row['character']: [row['count'], row['last']] for row in
+               LedgerEntry.objects.values('character').annotate(count=Count('pk'), last=Max('pk'))}
+    alts = {}
+    for name, main in CharacterAlt.objects.order_by('name').values_list('name', 'main'):
+        alts.setdefault(main, []).append(name)
+    return {name: [status, character_class, inactive, leave_of_absence,
+                   alts.get(name, []), entries.get(name, [0, None])]
+            for name, status, character_class, inactive, leave_of_absence in
+            Character.objects.values_list('name', 'status', 'character_class',
+                                          'inactive', 'leave_of_absence')}
+
+
+def _render(factory, path):
+    match = resolve(path)
+    response = match.func(factory.get(path), *match.args, **match.kwargs)
+    if hasattr(response, 'render'):
+        response.render()
+    if response.streaming:
+        return b''.join(response.streaming_content)
+    return response.content
+
+
+def _replace(filename, content):
+    partial = filename + '.partial'
+    with open(partial, 'wb') as f:
+        f.write(content)
+    os.replace(partial, filename)
+
+
+def _write(directory, path, content):
+    folder = os.path.join(directory, path.strip('/'))
+    os.makedirs(folder, exist_ok=True)
+    filename = os.path.join(folder, 'index.html')
+    _replace(filename, content)
+    # a fixed mtime keeps the archive identical for identical pages
+    compressed = io.BytesIO()
+    with gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0) as f:
+        f.write(content)
+    _replace(filename + '.gz', compressed.getvalue())
+
+
+def _load_state(directory):
+    try:
+        with open(os.path.join(directory, STATE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def export_site(directory, full=False):
+    """ bring the static export in directory up to date and return the number
+    of pages written and removed. full re-renders every page. """
+    state = _load_state(directory)
+    version = page_version()[0]
+    if not full and state.get('version') == version:
+        return {'pages': 0, 'removed': 0}
+
+    raids = _raid_fingerprint()
+    day = ledger.today().isoformat()
+    characters = _character_fingerprints()
+    full = full or state.get('raids') != raids or state.get('day') != day
+    previous = state.get('characters', {})
+
+    factory = RequestFactory()
+    os.makedirs(directory, exist_ok=True)
+    paths = list(PAGES) + ['/{}/'.format(name) for name, fingerprint in sorted(characters.items())
+                           if full or previous.get(name) != fingerprint]
+    for path in paths:
+        _write(directory, path, _render(factory, path))
+    removed = [name for name in previous if name not in characters]
+    for name in removed:
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+    _replace(os.path.join(directory, STATE_FILE), json.dumps(
+        {'version': version, 'raids': raids, 'day': day, 'characters': characters}).encode())
+    return {'pages': len(paths), 'removed': len(removed)}
+
+
+def _export_worker(directory):
+    """ export until no write has asked for another pass """
+    while True:
+        try:
+            export_site(directory)
+        except Exception:
+            # the next write or the export_site command retries
+            logger.exception('static export to %s failed', directory)
+        with _export_lock:
+            if not _export['again']:
+                _export['running'] = False
+                return
+            _export['again'] = False
+
+
+def _export_thread(directory):
+    try:
+        _export_worker(directory)
+    finally:
+        connection.close()
+
+
+def start_export(directory):
+    """ export in a background thread, or have the running export go again """
+    with _export_lock:
+        if _export['running']:
+            _export['again'] = True
+            return
+        _export['running'] = True
+    threading.Thread(target=_export_thread, args=(directory,), daemon=True).start()
+
+
+class SnapshotMiddleware(object):
+    """ refreshes the static export after writes to WRITE_ENDPOINTS, see the
+    module docstring """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        directory = getattr(settings, 'SNAPSHOT_DIR', None)
+        if directory and request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400 \
+                and request.path.startswith(WRITE_ENDPOINTS):
+            transaction.on_commit(lambda: start_export(directory))
+        return response
@@ -0,0 +1,214 @@
+"""
+Deterministic synthetic guild data for load testing.
+
+generate_guild() fills an empty database with a guild of the requested size:
+mains with alts, hourly raid dumps and boss kills on raid nights, auctions with
+bids and the purchases padkp_show.auction_rules awards for them, and monthly
+decays, plus a small casual track. Rows are written with bulk inserts, which bypass the ledger signals, so
+the stored balances, attendance buckets and ledger entries are rebuilt at the
+end. The same arguments always produce the same guild.
+"""
+import datetime as dt
+import hashlib
+import random
+
+import pytz
+
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Character, CharacterAlt, RaidDump, DkpSpecialAward, Auction, AuctionBid, Purchase
+from .models import CasualCharacter, CasualRaidDump, CasualPurchase, EQ_CLASSES
+from . import auction_rules, ledger
+
+EASTERN = pytz.timezone('US/Eastern')
+
+# weekday -> raid night, raids start at 8pm eastern
+RAID_NIGHTS = (0, 2, 3, 6)
+RAID_HOURS = (20, 21, 22, 23)
+# the tag a bid from each rank carries, as the auction client sends it
+BID_TAGS = {Character.RECRUIT: 'Recruit', Character.FNF: 'FNF'}
+BID_AMOUNTS = (1, 2, 3, 5, 10, 15, 20, 30, 40, 60)
+SYLLABLES = ['an', 'bel', 'cor', 'dra', 'el', 'fin', 'gar', 'hal', 'is', 'jor',
+             'kal', 'lan', 'mor', 'nar', 'or', 'pel', 'quin', 'ras', 'sul', 'tor',
+             'ul', 'vin', 'wen', 'xar', 'yl', 'zan']
+
+
+def _name(rnd, taken):
+    while True:
+        name = ''.join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 4))).capitalize()
+        if name not in taken:
+            taken.add(name)
+            return name
+
+
+def _raid_nights(start, end):
+    day = start
+    while day <= end:
+        if day.weekday() in RAID_NIGHTS:
+            yield day
+        day += dt.timedelta(days=1)
+
+
+def _at(day, hour, minute=0):
+    return EASTERN.localize(dt.datetime(day.year, day.month, day.day, hour, minute)).astimezone(pytz.utc)
+
+
+def _reset_sequences(models):
+    statements = connection.ops.sequence_reset_sql(no_style(), models)
+    with connection.cursor() as cursor:
+        for sql in statements:
+            cursor.execute(sql)
+
+
+def generate_guild(characters=100, alts=0.5, years=1, auctions_per_night=4,
+                   casual_characters=20, seed=0, end=None):
+    """ generate a guild into an empty database and return the row counts.
+
+    alts is the fraction of mains that own an alt. end is the last raid day and
+    defaults to today.
+    """
+    rnd = random.Random(seed)
+    end = end or timezone.now().astimezone(EASTERN).date()
+    start = end - dt.timedelta(days=int(365 * years))
+    taken = set()
+
+    mains = []
+    for _ in range(characters):
+        status = rnd.choices([Character.MAIN, Character.RECRUIT, Character.FNF, Character.INACTIVE],
+                             weights=[80, 8, 7, 5])[0]
+        mains.append(Character(name=_name(rnd, taken), character_class=rnd.choice(EQ_CLASSES[:-1]),
+                               status=status, inactive=status == Character.INACTIVE))
+    alt_characters = []
+    alt_links = []
+    for main in mains:
+        if rnd.random() < alts:
+            alt = Character(name=_name(rnd, taken), character_class=rnd.choice(EQ_CLASSES[:-1]),
+                            status=Character.ALT)
+            alt_characters.append(alt)
+            alt_links.append(CharacterAlt(name=alt.name, main=main))
+    # how likely each main is to show up on a raid night
+    reliability = {c.name: rnd.uniform(0.2, 0.95) for c in mains}
+
+    dumps = []
+    attendees = []
+    awards = []
+    auctions = []
+    bids = []
+    purchases = []
+    dkp = {c.name: 0 for c in mains}
+    through = RaidDump.characters_present.through
+    month = None
+    for day in _raid_nights(start, end):
+        if day.month != month:
+            month = day.month
+            for character in mains:
+                decay = int(dkp[character.name] * 0.1)
+                if decay:
+                    dkp[character.name] -= decay
+                    awards.append(DkpSpecialAward(character=character, value=-decay, attendance_value=0,
+                                                  time=_at(day, 12), notes='monthly decay'))
+        present = [c for c in mains if not c.inactive and rnd.random() < reliability[c.name]]
+        if not present:
+            continue
+        night = []
+        for hour in RAID_HOURS:
+            dump = RaidDump(id=len(dumps) + 1, value=2, attendance_value=1, award_type='Time',
+                            time=_at(day, hour), filename='synthetic.txt')
+            dumps.append(dump)
+            night.append(dump)
+            for character in present:
+                if rnd.random() < 0.95:
+                    attendees.append(through(raiddump_id=dump.id, character_id=character.name))
+                    dkp[character.name] += dump.value
+        for kill in range(rnd.randint(1, 3)):
+            dump = RaidDump(id=len(dumps) + 1, value=rnd.choice([3, 5, 10]), attendance_value=0,
+                            award_type='Boss Kill', time=_at(day, 21, 10 + 15 * kill),
+                            filename='synthetic.txt', notes='boss {}'.format(kill + 1))
+            dumps.append(dump)
+            for character in present:
+                attendees.append(through(raiddump_id=dump.id, character_id=character.name))
+                dkp[character.name] += dump.value
+
+        for number in range(auctions_per_night):
+            time = _at(day, 22, 5 + 10 * number)
+            auction = Auction(id=len(auctions) + 1, time=time, item_name='Item {}'.format(rnd.randint(1, 500)),
+                              item_count=rnd.choices([1, 2, 3], weights=[80, 15, 5])[0],
+                              auction_type=rnd.choices(['vickrey', 'english'], weights=[80, 20])[0],
+                              fingerprint=hashlib.sha256('synthetic-{}-{}'.format(seed, len(auctions)).encode()).hexdigest())
+            auctions.append(auction)
+            able = [c for c in present if dkp[c.name] > 0]
+            bidders = rnd.sample(able, min(len(able), rnd.randint(1, 8)))
+            records = []
+            for character in bidders:
+                # round numbers within their dkp, so bids tie now and then
+                amount = rnd.choice([x for x in BID_AMOUNTS if x <= dkp[character.name]])
+                record = auction_rules.BidRecord(character.name, amount, BID_TAGS.get(character.status, 'MN'),
+                                                 dkp[character.name], round(100 * reliability[character.name], 2))
+                records.append(record)
+                bids.append(AuctionBid(auction_id=auction.id, bid=record.bid, tag=record.tag, character=character,
+                                       dkp_snapshot=record.dkp, att_snapshot=record.attendance))
+            # awarded the way resolve_auction would, so replay_auctions agrees with it
+            rule = getattr(auction_rules, auction.auction_type)
+            characters = {c.name: c for c in bidders}
+            _, winners = rule(records, auction.item_count, auction_rules.seeded_rng(auction.fingerprint))
+            for record, price in winners:
+                dkp[record.name] -= price
+                purchases.append(Purchase(character=characters[record.name], item_name=auction.item_name,
+                                          value=price, time=time, auction_id=auction.id, is_alt=False))
+        for character in present:
+            if rnd.random() < 0.05:
+                purchases.append(Purchase(character=character, item_name='Alt item', value=rnd.randint(1, 5),
+                                          time=_at(day, 23, 30), is_alt=True))
+
+    casual = [CasualCharacter(name=_name(rnd, taken), character_class=rnd.choice(EQ_CLASSES[:-1]))
+              for _ in range(casual_characters)]
+    casual_dumps = []
+    casual_attendees = []
+    casual_purchases = []
+    casual_through = CasualRaidDump.characters_present.through
+    for day in _raid_nights(start, end):
+        if day.weekday() != RAID_NIGHTS[-1] or not casual:
+            continue
+        dump = CasualRaidDump(id=len(casual_dumps) + 1, value=5, time=_at(day, 14), filename='synthetic.txt')
+        casual_dumps.append(dump)
+        for character in rnd.sample(casual, rnd.randint(1, len(casual))):
+            casual_attendees.append(casual_through(casualraiddump_id=dump.id, casualcharacter_id=character.name))
+        if rnd.random() < 0.5:
+            casual_purchases.append(CasualPurchase(character=rnd.choice(casual), item_name='Casual item',
+                                                   value=rnd.randint(1, 10), time=_at(day, 15)))
+
+    with transaction.atomic():
+        Character.objects.bulk_create(mains + alt_characters)
+        CharacterAlt.objects.bulk_create(alt_links)
+        RaidDump.objects.bulk_create(dumps)
+        through.objects.bulk_create(attendees)
+        DkpSpecialAward.objects.bulk_create(awards)
+        Auction.objects.bulk_create(auctions)
+        AuctionBid.objects.bulk_create(bids)
+        Purchase.objects.bulk_create(purchases)
+        CasualCharacter.objects.bulk_create(casual)
+        CasualRaidDump.objects.bulk_create(casual_dumps)
+        casual_through.objects.bulk_create(casual_attendees)
+        CasualPurchase.objects.bulk_create(casual_purchases)
+        # ids were assigned above, move the sequences past them
+        _reset_sequences([RaidDump, Auction, CasualRaidDump])
+
+        ledger.rebuild_attendance()
+        for family in ledger.FAMILIES:
+            ledger.rebuild_balances(family)
+            ledger.rebuild_entries(family)
+        ledger.bump_generation()
+
+    return {
+        'characters': len(mains) + len(alt_characters),
+        'raid_dumps': len(dumps),
+        'attendees': len(attendees),
+        'awards': len(awards),
+        'auctions': len(auctions),
+        'bids': len(bids),
+        'purchases': len(purchases),
+        'casual_characters': len(casual),
+        'casual_raid_dumps': len(casual_dumps),
+    }
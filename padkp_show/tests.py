@@ -1,9 +1,31 @@
-from django.test import TestCase
-from padkp_show.models import Character, RaidDump, CharacterAlt, Purchase
-from padkp_show.models import main_change
+from django.core.management import call_command
+from django.db import OperationalError, connection, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from padkp_show.models import Character, RaidDump, CharacterAlt, Purchase, Auction
+from padkp_show.models import main_change, CharacterBalance, DkpSpecialAward
+from padkp_show.models import AttendanceDay, CharacterAttendanceDay, BalanceCheckpoint, LedgerEntry
+from padkp_show.models import CasualCharacter, CasualRaidDump, CasualPurchase, CasualDkpSpecialAward
+from padkp_show.models import CasualCharacterBalance
+from padkp_show import auction_rules, ledger, snapshot
+from padkp_show.auction_rules import BidRecord
+from padkp_show.ledger import rebuild_balances, rebuild_attendance, bulk_balances
+from padkp_show.ledger import balance_as_of, write_checkpoints, rebuild_entries
+from padkp_show.ledger import compute_balances, standings, generation, history, get_profile, MAIN
+from padkp_show.querybudget import QueryBudgetTestMixin
+from padkp_show.snapshot import export_site, SnapshotMiddleware
+from padkp_show.synthetic import generate_guild
 from django.utils import timezone
+import contextlib
 import datetime as dt
-
+import gzip
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
 
 class DkpCapTests(TestCase):
     def setUp(self):
@@ -149,3 +171,812 @@ class MainChangeTests(TestCase):
         self.assertEqual(self.char1.current_dkp(), 0)
         self.assertEqual(self.char2.current_dkp(), 7)
         self.assertEqual(self.char2.current_alt_dkp(), 8)
+
+
+class ProcessBidsTests(TestCase):
+
+    def setUp(self):
+        self.main = Character.objects.create(name='Lancegar', status='MN')
+        CharacterAlt.objects.create(name='Seped', main=self.main)
+        self.recruit = Character.objects.create(name='Quaff', status='Recruit')
+        dump = RaidDump(value=10, attendance_value=1, time=timezone.now())
+        dump.save()
+        dump.characters_present.set([self.main, self.recruit])
+
+    def test_find_characters(self):
+        found = Character.find_characters(['Lancegar', "Lancegar's alt", 'Seped', 'Nobody'])
+        self.assertEqual(found['Lancegar'], (False, self.main))
+        self.assertEqual(found["Lancegar's alt"], (True, self.main))
+        self.assertEqual(found['Seped'], (True, self.main))
+        self.assertEqual(found['Nobody'], (False, None))
+
+    def test_bids_are_snapshotted_together(self):
+        auction = Auction.objects.create(fingerprint='bids', item_name='Shiny', time=timezone.now())
+        bids = [{'name': 'Lancegar', 'bid': '4', 'tag': ''},
+                {'name': 'Seped', 'bid': '12', 'tag': ''},
+                {'name': 'Quaff', 'bid': '3', 'tag': 'MN'},
+                {'name': 'Nobody', 'bid': '1', 'tag': ''},
+                {'name': 'Quaff', 'bid': '0', 'tag': ''}]
+        # a savepoint, the names, balances, attendance, the insert and the generation bump
+        with self.assertNumQueries(8):
+            warnings = auction.process_bids(bids)
+        self.assertEqual(warnings, ['Seped bid 12 dkp but only has 10 on the site',
+                                    'Quaff bid with tag "MN" but is registered as "Recruit"',
+                                    'Received bid for unknown character: Nobody'])
+        snapshots = {(b.character_id, b.tag): (b.bid, b.dkp_snapshot, b.att_snapshot)
+                     for b in auction.auctionbid_set.all()}
+        self.assertEqual(snapshots, {('Lancegar', ''): (4, 10, 100.0),
+                                     ('Lancegar', 'ALT'): (12, 10, 100.0),
+                                     ('Quaff', 'MN'): (3, 10, 100.0)})
+
+
+class AuctionRulesTests(TestCase):
+
+    def test_vickrey_prices(self):
+        bids = [BidRecord('Quaff', 12, ''), BidRecord('Lancegar', 25, 'ALT'),
+                BidRecord('Bid', 6, ''), BidRecord('LowBid', 2, '')]
+        tie_losers, winners = auction_rules.vickrey(bids, 1)
+        self.assertEqual(tie_losers, [])
+        self.assertEqual([(r.name, price) for r, price in winners], [('Quaff', 7)])
+        # mains win before alts and pay one more than the alt's capped bid.
+        # the last winner is priced from its own bid
+        tie_losers, winners = auction_rules.vickrey(bids, 3)
+        self.assertEqual([(r.name, price) for r, price in winners],
+                         [('Quaff', 6), ('Bid', 6), ('Lancegar', 25)])
+        self.assertEqual(auction_rules.vickrey([], 2), ([], []))
+
+    def test_english_ordering(self):
+        bids = [BidRecord('Quaff', 8, '', dkp=10), BidRecord('Lancegar', 8, '', dkp=30),
+                BidRecord('Recruit', 20, 'Recruit'), BidRecord('Bid', 4, '')]
+        tie_losers, winners = auction_rules.english(bids, 2)
+        self.assertEqual([(r.name, price) for r, price in winners], [('Recruit', 20), ('Lancegar', 8)])
+        self.assertEqual(tie_losers, ['Quaff'])
+
+    def test_seeded_ties_are_reproducible(self):
+        bids = [BidRecord('Char{}'.format(i), 10, '') for i in range(20)]
+        runs = [auction_rules.vickrey(bids, 3, random.Random('fingerprint')) for _ in range(2)]
+        self.assertEqual(*[([r.name for r, _ in winners], losers) for losers, winners in runs])
+
+    def test_large_multi_item_auction(self):
+        rnd = random.Random(0)
+        bids = [BidRecord('Char{}'.format(i), rnd.randint(1, 500), rnd.choice(['', 'ALT']))
+                for i in range(5000)]
+        tie_losers, winners = auction_rules.vickrey(bids, 200, rnd)
+        self.assertEqual(len(winners), 200)
+        self.assertEqual(len({id(r) for r, _ in winners}), 200)
+
+
+class CharacterBalanceTests(TestCase):
+
+    def setUp(self):
+        self.char1 = Character.objects.create(name='Lancegar', status='MN')
+        self.char2 = Character.objects.create(name='Quaff', status='MN')
+        self.dump = RaidDump(value=10, attendance_value=1, time=timezone.now())
+        self.dump.save()
+        self.dump.characters_present.set([self.char1, self.char2])
+
+    def test_balance_follows_dump_attendance(self):
+        self.assertEqual(self.char1.current_dkp(), 10)
+        self.dump.characters_present.remove(self.char1)
+        self.assertEqual(self.char1.current_dkp(), 0)
+        self.assertEqual(self.char2.current_dkp(), 10)
+        self.char1.raid_dumps.add(self.dump)
+        self.assertEqual(self.char1.current_dkp(), 10)
+
+    def test_balance_follows_dump_edits_and_deletes(self):
+        self.dump.value = 25
+        self.dump.save()
+        self.assertEqual(self.char1.current_dkp(), 25)
+        self.dump.delete()
+        self.assertEqual(self.char1.current_dkp(), 0)
+        self.assertEqual(self.char2.current_dkp(), 0)
+
+    def test_balance_follows_purchase_changes(self):
+        purchase = Purchase(character=self.char1, item_name='Awesome Shiny',
+                            value=4, time=timezone.now(), is_alt=0)
+        purchase.save()
+        self.assertEqual(self.char1.current_dkp(), 6)
+        purchase.character = self.char2
+        purchase.save()
+        self.assertEqual(self.char1.current_dkp(), 10)
+        self.assertEqual(self.char2.current_dkp(), 6)
+        purchase.is_alt = True
+        purchase.save()
+        self.assertEqual(self.char2.current_dkp(), 10)
+        self.assertEqual(self.char2.current_alt_dkp(), 6)
+        purchase.delete()
+        self.assertEqual(self.char2.current_alt_dkp(), 10)
+
+    def test_balance_follows_special_awards(self):
+        self.char1.give_bonus(5, 'bonus', dry_run=False)
+        self.assertEqual(self.char1.current_dkp(), 15)
+        balance = CharacterBalance.objects.get(character=self.char1)
+        self.assertEqual(balance.earned, 15)
+
+    def test_rebuild_balances(self):
+        CharacterBalance.objects.all().delete()
+        rebuild_balances()
+        self.assertEqual(CharacterBalance.objects.get(character=self.char1).main_dkp, 10)
+
+    def test_deleting_character_removes_balance(self):
+        self.char1.give_bonus(5, 'bonus', dry_run=False)
+        self.char1.delete()
+        self.assertFalse(CharacterBalance.objects.filter(character='Lancegar').exists())
+        self.assertFalse(CharacterAttendanceDay.objects.filter(character='Lancegar').exists())
+
+    def test_failed_refresh_rolls_back_the_write(self):
+        def locked(*args, **kwargs):
+            raise OperationalError('database is locked')
+        original = ledger.compute_balances
+        ledger.compute_balances = locked
+        try:
+            with self.assertRaises(OperationalError):
+                Purchase(character=self.char1, item_name='Awesome Shiny',
+                         value=4, time=timezone.now(), is_alt=0).save()
+        finally:
+            ledger.compute_balances = original
+        self.assertFalse(Purchase.objects.filter(item_name='Awesome Shiny').exists())
+        self.assertEqual(CharacterBalance.objects.get(character=self.char1).main_dkp, 10)
+        self.assertEqual(compute_balances(['Lancegar'])['Lancegar'].main_dkp, 10)
+
+    def test_failed_delete_keeps_balance_refreshing(self):
+        class Abort(Exception):
+            pass
+        with self.assertRaises(Abort):
+            with transaction.atomic():
+                self.char1.delete()
+                raise Abort()
+        char1 = Character.objects.get(name='Lancegar')
+        char1.give_bonus(5, 'bonus', dry_run=False)
+        self.assertEqual(CharacterBalance.objects.get(character=char1).main_dkp, 15)
+
+
+class CasualBalanceTests(QueryBudgetTestMixin, TestCase):
+
+    def setUp(self):
+        self.characters = [CasualCharacter.objects.create(name='Casual{}'.format(i), character_class='Bard')
+                           for i in range(10)]
+        self.dump = CasualRaidDump(value=5, time=timezone.now())
+        self.dump.save()
+        self.dump.characters_present.set(self.characters)
+
+    def test_balance_follows_the_casual_ledger(self):
+        char0, char1 = self.characters[:2]
+        self.assertEqual(char0.current_dkp(), 5)
+        purchase = CasualPurchase(character=char0, item_name='Shiny', value=2, time=timezone.now())
+        purchase.save()
+        CasualDkpSpecialAward(character=char1, value=3, time=timezone.now()).save()
+        self.assertEqual(char0.current_dkp(), 3)
+        self.assertEqual(char1.current_dkp(), 8)
+        self.dump.characters_present.remove(char1)
+        self.assertEqual(char1.current_dkp(), 3)
+        purchase.delete()
+        self.dump.value = 7
+        self.dump.save()
+        self.assertEqual(char0.current_dkp(), 7)
+        self.assertEqual(char0.balance().alt_dkp, 0)
+        self.dump.delete()
+        self.assertEqual(char0.current_dkp(), 0)
+
+    def test_tracks_are_kept_apart(self):
+        main = Character.objects.create(name='Casual0', status='MN')
+        self.assertEqual(main.current_dkp(), 0)
+        self.assertEqual(self.characters[0].current_dkp(), 5)
+
+    def test_rebuild_balances(self):
+        CasualCharacterBalance.objects.all().delete()
+        rebuild_balances(ledger.CASUAL)
+        self.assertEqual(CasualCharacterBalance.objects.get(character=self.characters[0]).main_dkp, 5)
+
+    def test_casual_pages_query_count_is_constant(self):
+        CasualCharacterBalance.objects.filter(character=self.characters[3]).delete()
+        # the missing balance is rebuilt with a fixed number of queries
+        response = self.assertMaxQueries(10, self.client.get, '/casual/')
+        self.assertEqual([r['current_dkp'] for r in response.context['records']], [5] * 10)
+        self.assertMaxQueries(1, self.client.get, '/casual/')
+        self.assertMaxQueries(6, self.client.get, '/casual/Casual0/')
+
+    def test_deleting_character_removes_balance(self):
+        self.characters[0].delete()
+        self.assertFalse(CasualCharacterBalance.objects.filter(character='Casual0').exists())
+
+
+class BulkBalanceTests(TestCase):
+
+    def setUp(self):
+        self.characters = [Character.objects.create(name='Char{}'.format(i), status='MN')
+                           for i in range(10)]
+        old = timezone.now() - dt.timedelta(days=20)
+        dump = RaidDump(value=10, attendance_value=1, time=old)
+        dump.save()
+        dump.characters_present.set(self.characters)
+        dump = RaidDump(value=5, attendance_value=1, time=timezone.now())
+        dump.save()
+        dump.characters_present.set(self.characters[:5])
+        Purchase(character=self.characters[0], item_name='Awesome Shiny',
+                 value=3, time=timezone.now(), is_alt=1).save()
+
+    def test_bulk_balances_match_per_character_values(self):
+        balances = bulk_balances(windows=(15, 30))
+        for character in self.characters:
+            balance = balances[character.name]
+            self.assertEqual(balance['main_dkp'], character.current_dkp())
+            self.assertEqual(balance['alt_dkp'], character.current_alt_dkp())
+            self.assertAlmostEqual(balance['attendance'][30], character.attendance(30))
+            self.assertAlmostEqual(balance['attendance'][15], character.attendance(15))
+
+    def test_standings_match_bulk_balances(self):
+        with self.assertNumQueries(2):
+            standings()
+        CharacterBalance.objects.filter(character=self.characters[3]).delete()
+        characters = standings()
+        self.assertTrue(CharacterBalance.objects.filter(character=self.characters[3]).exists())
+        balances = bulk_balances(self.characters)
+        self.assertEqual(len(characters), 10)
+        for character in characters:
+            balance = balances[character.name]
+            self.assertEqual(character.main_dkp, balance['main_dkp'])
+            self.assertEqual(character.alt_dkp, balance['alt_dkp'])
+            self.assertAlmostEqual(character.attendance, balance['attendance'][30])
+
+    def test_bulk_balances_query_count_is_constant(self):
+        bulk_balances()
+        with self.assertNumQueries(4):
+            bulk_balances(windows=(15, 30, 90))
+        with self.assertNumQueries(3):
+            bulk_balances(self.characters[:2])
+
+
+class AttendanceBucketTests(TestCase):
+
+    def setUp(self):
+        self.char1 = Character.objects.create(name='Lancegar', status='MN')
+        self.char2 = Character.objects.create(name='Quaff', status='MN')
+        self.recent = RaidDump(value=1, attendance_value=1, time=timezone.now())
+        self.recent.save()
+        self.recent.characters_present.set([self.char1, self.char2])
+        self.old = RaidDump(value=1, attendance_value=1,
+                            time=timezone.now() - dt.timedelta(days=40))
+        self.old.save()
+        self.old.characters_present.set([self.char1])
+
+    def test_windows(self):
+        self.assertEqual(self.char1.attendance(30), 100)
+        self.assertEqual(self.char2.attendance(30), 100)
+        self.assertEqual(self.char2.attendance(60), 50)
+
+    def test_dump_time_edit_moves_bucket(self):
+        self.old.time = timezone.now()
+        self.old.save()
+        self.assertEqual(self.char2.attendance(30), 50)
+
+    def test_dump_attendance_edits(self):
+        self.recent.characters_present.remove(self.char2)
+        self.assertEqual(self.char2.attendance(30), 0)
+        self.recent.attendance_value = 0
+        self.recent.save()
+        self.assertEqual(self.char1.attendance(60), 100)
+        self.assertFalse(AttendanceDay.objects.filter(
+            day__gte=dt.date.today() - dt.timedelta(days=2)).exists())
+
+    def test_special_award_attendance(self):
+        DkpSpecialAward(character=self.char2, value=0, attendance_value=1,
+                        time=self.old.time).save()
+        self.assertEqual(self.char2.attendance(60), 100)
+
+    def test_attendance_page_windows(self):
+        response = self.client.get('/attendance/')
+        self.assertEqual(response.context['window'], '30')
+        self.assertEqual([r['attendance'] for r in response.context['records']], ['100.0', '100.0'])
+        response = self.client.get('/attendance/60/')
+        self.assertEqual([(r['name'], r['attendance']) for r in response.context['records']],
+                         [('Lancegar', '100.0'), ('Quaff', '50.0')])
+        response = self.client.get('/attendance/all/')
+        self.assertEqual(response.context['records'][1]['attendance'], '50.0')
+        self.assertEqual(self.client.get('/attendance/7/').status_code, 404)
+
+    def test_rebuild_matches_incremental(self):
+        DkpSpecialAward(character=self.char2, value=0, attendance_value=1,
+                        time=self.old.time).save()
+        before = set(CharacterAttendanceDay.objects.values_list('character', 'day', 'earned'))
+        rebuild_attendance()
+        after = set(CharacterAttendanceDay.objects.values_list('character', 'day', 'earned'))
+        self.assertEqual(before, after)
+
+
+class BalanceCheckpointTests(TestCase):
+
+    def setUp(self):
+        self.char1 = Character.objects.create(name='Lancegar', status='MN')
+        self.start = timezone.now() - dt.timedelta(days=10)
+        for day in range(5):
+            dump = RaidDump(value=10, attendance_value=1,
+                            time=self.start + dt.timedelta(days=day))
+            dump.save()
+            dump.characters_present.set([self.char1])
+        Purchase(character=self.char1, item_name='Awesome Shiny', value=15,
+                 time=self.start + dt.timedelta(days=2, hours=1), is_alt=0).save()
+
+    def test_balance_as_of_without_checkpoints(self):
+        when = self.start + dt.timedelta(days=2, hours=2)
+        self.assertEqual(balance_as_of(self.char1, when).main_dkp, 15)
+
+    def test_balance_as_of_uses_nearest_checkpoint(self):
+        write_checkpoints(when=self.start + dt.timedelta(days=1, hours=1))
+        checkpoint, = BalanceCheckpoint.objects.filter(character=self.char1)
+        self.assertEqual(checkpoint.main_dkp, 20)
+        when = self.start + dt.timedelta(days=3, hours=1)
+        self.assertEqual(balance_as_of(self.char1, when).main_dkp, 25)
+        self.assertEqual(balance_as_of(self.char1, timezone.now()).main_dkp,
+                         self.char1.current_dkp())
+
+    def test_backdated_entries_invalidate_checkpoints(self):
+        write_checkpoints(when=self.start + dt.timedelta(days=1, hours=1))
+        write_checkpoints(when=self.start + dt.timedelta(days=4, hours=1))
+        DkpSpecialAward(character=self.char1, value=7, attendance_value=0,
+                        time=self.start + dt.timedelta(days=3)).save()
+        self.assertEqual(BalanceCheckpoint.objects.filter(character=self.char1).count(), 1)
+        self.assertEqual(balance_as_of(self.char1, timezone.now()).main_dkp,
+                         self.char1.current_dkp())
+
+
+class LedgerEntryTests(TestCase):
+
+    def setUp(self):
+        self.char1 = Character.objects.create(name='Lancegar', status='MN')
+        self.char2 = Character.objects.create(name='Quaff', status='MN')
+        self.dump = RaidDump(value=10, attendance_value=1, time=timezone.now(),
+                             award_type='Time')
+        self.dump.save()
+        self.dump.characters_present.set([self.char1, self.char2])
+
+    def test_entries_follow_sources(self):
+        purchase = Purchase(character=self.char1, item_name='Awesome Shiny',
+                            value=4, time=timezone.now(), is_alt=0)
+        purchase.save()
+        self.char1.give_bonus(3, 'bonus', dry_run=False)
+        entries = LedgerEntry.objects.filter(character=self.char1)
+        self.assertEqual(sorted(e.dkp for e in entries), [-4, 3, 10])
+        self.assertEqual(sum(e.dkp for e in entries), self.char1.current_dkp())
+
+        self.dump.value = 20
+        self.dump.save()
+        self.assertEqual(LedgerEntry.objects.get(character=self.char2).dkp, 20)
+
+        self.dump.characters_present.remove(self.char2)
+        self.assertFalse(LedgerEntry.objects.filter(character=self.char2).exists())
+
+        purchase.delete()
+        self.assertEqual(LedgerEntry.objects.filter(character=self.char1).count(), 2)
+
+    def test_rebuild_entries_matches_incremental(self):
+        Purchase(character=self.char1, item_name='Awesome Shiny',
+                 value=4, time=timezone.now(), is_alt=0).save()
+        fields = ('character', 'source', 'time', 'dkp', 'attendance', 'description')
+        before = set(LedgerEntry.objects.values_list(*fields))
+        rebuild_entries()
+        self.assertEqual(before, set(LedgerEntry.objects.values_list(*fields)))
+
+    def test_history_pages_match_full_history(self):
+        time = self.dump.time
+        for i in range(3):
+            Purchase(character=self.char1, item_name='Shiny {}'.format(i),
+                     value=1, time=time, is_alt=0).save()
+            RaidDump(value=5, attendance_value=1, time=time, award_type='Boss Kill').save()
+        everything, cursor = history(MAIN, self.char1, limit=None)
+        self.assertIsNone(cursor)
+        self.assertEqual(len(everything), 7)
+        self.assertEqual(sum(not x['present'] for x in everything), 3)
+
+        pages = []
+        cursor = None
+        while True:
+            with self.assertNumQueries(2):
+                items, cursor = history(MAIN, self.char1, before=cursor, limit=2)
+            pages += items
+            if cursor is None:
+                break
+        self.assertEqual(pages, everything)
+        with self.assertRaises(ValueError):
+            history(MAIN, self.char1, before='garbage')
+
+    def test_character_page_timeline(self):
+        Purchase(character=self.char1, item_name='Awesome Shiny',
+                 value=4, time=timezone.now(), is_alt=0).save()
+        missed = RaidDump(value=5, attendance_value=1, time=timezone.now(),
+                          award_type='Boss Kill')
+        missed.save()
+        response = self.client.get('/Lancegar/')
+        self.assertEqual(response.status_code, 200)
+        awards = response.context['awards_14']
+        self.assertEqual([x['present'] for x in awards], [False, True])
+        self.assertEqual(response.context['purchases_30'], [str(Purchase.objects.get())])
+
+
+class QueryPlanTests(TestCase):
+    """ Runs EXPLAIN QUERY PLAN over the queries behind the hot pages and fails
+    when a ledger table is scanned instead of searched through an index. """
+
+    # roster sized tables, reading them whole is expected
+    roster_tables = {'padkp_show_character', 'padkp_show_characterbalance',
+                     'padkp_show_characteralt'}
+
+    def setUp(self):
+        self.characters = [Character.objects.create(name='Char{}'.format(i), status='MN')
+                           for i in range(5)]
+        for day in range(3):
+            dump = RaidDump(value=10, attendance_value=1, award_type='Time',
+                            time=timezone.now() - dt.timedelta(days=day))
+            dump.save()
+            dump.characters_present.set(self.characters[day:])
+        Purchase(character=self.characters[0], item_name='Awesome Shiny',
+                 value=3, time=timezone.now(), is_alt=0).save()
+        self.characters[1].give_bonus(2, 'bonus', dry_run=False)
+
+    def scans(self, queries):
+        found = []
+        with connection.cursor() as cursor:
+            for query in queries:
+                if not query['sql'].startswith('SELECT'):
+                    continue
+                cursor.execute('EXPLAIN QUERY PLAN ' + query['sql'])
+                for row in cursor.fetchall():
+                    detail = row[-1]
+                    words = detail.split()
+                    if words[0] != 'SCAN' or 'INDEX' in words:
+                        continue
+                    table = words[2] if words[1] == 'TABLE' else words[1]
+                    if table.startswith('padkp_') and table not in self.roster_tables:
+                        found.append('{}\n    {}'.format(detail, query['sql']))
+        return found
+
+    def assertIndexed(self, func):
+        if connection.vendor != 'sqlite':
+            self.skipTest('query plans are checked on sqlite only')
+        with CaptureQueriesContext(connection) as context:
+            func()
+        self.assertEqual(self.scans(context.captured_queries), [])
+
+    def test_attendance(self):
+        self.assertIndexed(lambda: self.characters[0].attendance(30))
+
+    def test_current_dkp(self):
+        CharacterBalance.objects.all().delete()
+        self.assertIndexed(lambda: self.characters[0].current_dkp())
+
+    def test_index(self):
+        self.assertIndexed(lambda: self.client.get('/'))
+
+    def test_character_dkp(self):
+        self.assertIndexed(lambda: self.client.get('/Char0/'))
+
+
+class SyntheticGuildTests(TestCase):
+
+    def test_generated_guild_is_consistent(self):
+        counts = generate_guild(characters=12, years=0.1, auctions_per_night=2,
+                                casual_characters=3, seed=7)
+        self.assertEqual(Character.objects.count(), counts['characters'])
+        self.assertEqual(RaidDump.objects.count(), counts['raid_dumps'])
+        self.assertEqual(Purchase.objects.count(), counts['purchases'])
+        stored = {b.character_id: b.main_dkp for b in CharacterBalance.objects.all()}
+        self.assertEqual(stored, {name: b.main_dkp for name, b in compute_balances(list(stored)).items()})
+        self.assertTrue(all(dkp >= 0 for dkp in stored.values()))
+        self.assertEqual(LedgerEntry.objects.filter(source=LedgerEntry.PURCHASE).count(),
+                         counts['purchases'])
+        # the purchases are the ones the recorded rules award
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            call_command('replay_auctions')
+        lines = output.getvalue()
+        summary = json.loads(lines[lines.index('{'):])
+        self.assertEqual((summary['replayed'], summary['divergent']), (counts['auctions'], 0))
+        self.assertEqual(set(Auction.objects.values_list('auction_type', flat=True)), {'vickrey', 'english'})
+
+
+class QueryBudgetTests(QueryBudgetTestMixin, TestCase):
+    """ page query counts must not grow with the size of the roster """
+
+    def setUp(self):
+        self.characters = [Character.objects.create(name='Char{}'.format(i), status='MN')
+                           for i in range(20)]
+        for day in range(5):
+            dump = RaidDump(value=10, attendance_value=1, award_type='Time',
+                            time=timezone.now() - dt.timedelta(days=day))
+            dump.save()
+            dump.characters_present.set(self.characters[day:])
+        for character in self.characters[:10]:
+            Purchase(character=character, item_name='Awesome Shiny',
+                     value=3, time=timezone.now(), is_alt=0).save()
+            character.give_bonus(2, 'bonus', dry_run=False)
+
+    def test_index(self):
+        self.assertMaxQueries(3, self.client.get, '/')
+
+    def test_attendance_table(self):
+        self.assertMaxQueries(3, self.client.get, '/attendance/')
+        self.assertMaxQueries(3, self.client.get, '/attendance/all/')
+
+    def test_character_dkp(self):
+        self.assertMaxQueries(13, self.client.get, '/Char0/')
+        # the profile built by the first render is reused
+        self.assertMaxQueries(5, self.client.get, '/Char0/?all')
+
+    @override_settings(QUERY_BUDGET_ENABLED=True, QUERY_BUDGET_HEADERS=True, QUERY_BUDGET=1)
+    def test_middleware_headers_and_log(self):
+        with self.assertLogs('padkp_show.querybudget', 'WARNING'):
+            response = self.client.get('/Char0/')
+        self.assertGreater(int(response['X-Query-Count']), 1)
+        self.assertIn('X-Query-Time-Ms', response)
+
+
+class PageCacheTests(TestCase):
+
+    def setUp(self):
+        self.char1 = Character.objects.create(name='Lancegar', status='MN')
+        self.dump = RaidDump(value=10, attendance_value=1, time=timezone.now(), award_type='Time')
+        self.dump.save()
+        self.dump.characters_present.set([self.char1])
+
+    def test_writes_bump_generation(self):
+        number, _ = generation()
+        Purchase(character=self.char1, item_name='Awesome Shiny', value=3,
+                 time=timezone.now(), is_alt=0).save()
+        self.assertEqual(generation()[0], number + 1)
+        self.dump.characters_present.clear()
+        self.assertEqual(generation()[0], number + 2)
+        CharacterBalance.objects.all().delete()
+        self.assertEqual(generation()[0], number + 2)
+
+    def test_cached_until_next_write(self):
+        response = self.client.get('/')
+        self.assertContains(response, '10')
+        with self.assertNumQueries(1):
+            cached = self.client.get('/')
+        self.assertEqual(cached.content, response.content)
+
+        Purchase(character=self.char1, item_name='Awesome Shiny', value=3,
+                 time=timezone.now(), is_alt=0).save()
+        response = self.client.get('/')
+        self.assertNotEqual(response.content, cached.content)
+
+    def test_conditional_get(self):
+        response = self.client.get('/Lancegar/')
+        self.assertIn('no-cache', response['Cache-Control'])
+        response = self.client.get('/Lancegar/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/Lancegar/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+        self.char1.give_bonus(5, 'bonus', dry_run=False)
+        response = self.client.get('/Lancegar/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_conditional_get_after_raid_day_rollover(self):
+        response = self.client.get('/attendance/')
+        last_modified = response['Last-Modified']
+        tomorrow = ledger.today() + dt.timedelta(days=1)
+        original = ledger.today
+        ledger.today = lambda: tomorrow
+        try:
+            response = self.client.get('/attendance/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        finally:
+            ledger.today = original
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['Last-Modified'], last_modified)
+
+
+class CharacterProfileTests(TestCase):
+
+    def setUp(self):
+        self.char1 = Character.objects.create(name='Lancegar', status='MN', character_class='Bard')
+        CharacterAlt.objects.create(name='Seped', main=self.char1)
+        self.dump = RaidDump(value=10, attendance_value=1, time=timezone.now(), award_type='Time')
+        self.dump.save()
+        self.dump.characters_present.set([self.char1])
+
+    def test_profile_matches_character(self):
+        profile = get_profile('Lancegar')
+        self.assertEqual(profile.main_dkp, self.char1.current_dkp())
+        self.assertEqual(profile.alt_names(), ['Seped'])
+        self.assertEqual(profile.attendance_30, 100)
+        self.assertEqual(profile.days_since_raid(), 0)
+        self.assertEqual(profile.rank, 'Main')
+        self.assertIsNone(get_profile('Nobody'))
+
+    def test_profile_is_reused_until_the_ledger_changes(self):
+        get_profile('Lancegar')
+        with self.assertNumQueries(2):
+            get_profile('Lancegar')
+        RaidDump(value=5, attendance_value=1, time=timezone.now(), award_type='Time').save()
+        self.assertEqual(get_profile('Lancegar').attendance_30, 50)
+        self.char1.leave_of_absence = True
+        self.char1.save()
+        self.assertEqual(get_profile('Lancegar').rank, 'Leave of Absence')
+
+    def test_character_page_reads_profile(self):
+        response = self.client.get('/Lancegar/')
+        self.assertEqual(response.context['alt_string'], 'Seped')
+        self.assertEqual(response.context['current_dkp'], 10)
+        self.assertEqual(self.client.get('/Nobody/').status_code, 404)
+
+
+class ItemHistoryTests(TestCase):
+
+    def setUp(self):
+        self.char1 = Character.objects.create(name='Lancegar', status='MN')
+        self.char2 = Character.objects.create(name='Quaff', status='MN')
+        start = timezone.now() - dt.timedelta(days=200)
+        for i in range(120):
+            Purchase(character=self.char1 if i % 2 else self.char2, item_name='Shiny {}'.format(i),
+                     value=i, time=start + dt.timedelta(days=i), is_alt=i % 3 == 0).save()
+        self.auction = Auction.objects.create(fingerprint='x', time=timezone.now(), item_name='Sword <b>')
+        Purchase(character=self.char1, item_name='Sword <b>', value=5,
+                 time=timezone.now(), auction=self.auction).save()
+
+    def test_items_are_paginated(self):
+        with self.assertNumQueries(3):
+            response = self.client.get('/items/')
+        records = list(response.context['records'])
+        self.assertEqual(len(records), 100)
+        self.assertEqual(records[0]['item_name'], 'Sword <b>')
+        response = self.client.get('/items/?page=2')
+        self.assertEqual(len(response.context['records']), 21)
+
+    def test_items_filters(self):
+        response = self.client.get('/items/?character=lancegar&alt=alt')
+        records = response.context['records']
+        self.assertEqual(len(records), 20)
+        self.assertTrue(all(r['character_id'] == 'Lancegar' and r['is_alt'] for r in records))
+        self.assertEqual(response.context['query'], 'character=Lancegar&alt=alt')
+        response = self.client.get('/items/?item=shiny 11')
+        self.assertEqual(len(response.context['records']), 11)
+        day = ledger.raid_day(Purchase.objects.get(item_name='Shiny 5').time).isoformat()
+        response = self.client.get('/items/', {'since': day, 'until': day})
+        self.assertEqual([r['item_name'] for r in response.context['records']], ['Shiny 5'])
+        response = self.client.get('/items/?since=2021-02-31')
+        self.assertEqual(response.context['page'].paginator.count, 121)
+        response = self.client.get('/items/?until=9999-12-31')
+        self.assertEqual(response.context['page'].paginator.count, 121)
+        response = self.client.get('/all_items/?until=9999-12-31')
+        self.assertEqual(b''.join(response.streaming_content).decode().count('<tr><td>'), 121)
+
+    def test_all_items_streams(self):
+        with self.assertNumQueries(2):
+            response = self.client.get('/all_items/')
+            content = b''.join(response.streaming_content).decode()
+        self.assertTrue(response.streaming)
+        self.assertEqual(content.count('<tr><td>'), 121)
+        self.assertIn('<a href="/auctions/{}">Sword &lt;b&gt;</a>'.format(self.auction.id), content)
+        self.assertIn("Lancegar</a>'s alt", content)
+        self.assertTrue(content.rstrip().endswith('</body>'))
+        response = self.client.get('/all_items/?character=Quaff')
+        self.assertEqual(b''.join(response.streaming_content).decode().count('<tr><td>'), 60)
+
+
+class AwardsPageTests(TestCase):
+
+    def setUp(self):
+        characters = [Character.objects.create(name='Char{}'.format(i), status='MN') for i in range(3)]
+        start = timezone.now() - dt.timedelta(days=150)
+        for i in range(130):
+            dump = RaidDump(value=1, attendance_value=i % 2, time=start + dt.timedelta(days=i),
+                            award_type='Boss Kill' if i % 5 == 0 else 'Time')
+            dump.save()
+            dump.characters_present.set(characters[:i % 3 + 1])
+
+    def test_awards_are_paginated_with_headcounts(self):
+        with self.assertNumQueries(3):
+            response = self.client.get('/awards/')
+        records = list(response.context['records'])
+        self.assertEqual(len(records), 100)
+        self.assertEqual([r['headcount'] for r in records[:3]], [1, 3, 2])
+        response = self.client.get('/awards/?page=2')
+        self.assertEqual(len(response.context['records']), 30)
+
+    def test_awards_filters(self):
+        response = self.client.get('/awards/?type=Boss Kill&attendance=yes')
+        records = response.context['records']
+        self.assertEqual(len(records), 13)
+        self.assertTrue(all(r['award_type'] == 'Boss Kill' and r['attendance_value'] for r in records))
+        dump = RaidDump.objects.order_by('time')[3]
+        day = ledger.raid_day(dump.time).isoformat()
+        response = self.client.get('/awards/', {'since': day, 'until': day, 'type': 'bogus'})
+        self.assertEqual([r['id'] for r in response.context['records']], [dump.id])
+        response = self.client.get('/awards/?until=9999-12-31')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['page'].paginator.count, RaidDump.objects.count())
+
+
+class ClassBalanceTests(TestCase):
+
+    def setUp(self):
+        self.bard = Character.objects.create(name='Lancegar', status='MN', character_class='Bard')
+        self.cleric = Character.objects.create(name='Quaff', status='MN', character_class='Cleric')
+        self.recruit = Character.objects.create(name='Newbie', status='REC', character_class='Bard')
+        for days, present in [(1, [self.bard, self.cleric, self.recruit]), (2, [self.bard]),
+                              (20, [self.cleric]), (40, [self.cleric])]:
+            dump = RaidDump(value=1, attendance_value=1, award_type='Time',
+                            time=timezone.now() - dt.timedelta(days=days))
+            dump.save()
+            dump.characters_present.set(present)
+        RaidDump(value=1, attendance_value=1, award_type='Time', time=timezone.now()).save()
+
+    def test_class_balance_page(self):
+        with self.assertNumQueries(3):
+            response = self.client.get('/class_balance/')
+        self.assertEqual(response.context['windows'], ['15 days', '30 days'])
+        records = {r['character_class']: r['counts'] for r in response.context['records']}
+        self.assertEqual(records['Bard'], ['0.7', '0.5'])
+        self.assertEqual(records['Cleric'], ['0.3', '0.5'])
+        self.assertEqual(records['Warrior'], ['0.0', '0.0'])
+        self.assertEqual(response.context['totals'], ['1.0', '1.0'])
+
+    def test_class_balance_json(self):
+        response = self.client.get('/class_balance/?windows=30,all,bogus,30&format=json')
+        data = response.json()
+        self.assertEqual(data['windows'], ['30', 'all'])
+        self.assertEqual(data['dumps'], {'30': 4, 'all': 5})
+        self.assertEqual(data['classes']['Cleric'], {'30': 0.5, 'all': 0.6})
+
+
+class SnapshotTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.characters = [Character.objects.create(name='Char{}'.format(i), status='MN')
+                           for i in range(3)]
+        dump = RaidDump(value=10, attendance_value=1, award_type='Time', time=timezone.now())
+        dump.save()
+        dump.characters_present.set(self.characters)
+
+    def read(self, *path):
+        with open(os.path.join(self.directory, *path), 'rb') as f:
+            return f.read()
+
+    def test_export_writes_compressed_pages(self):
+        self.assertEqual(export_site(self.directory), {'pages': 8, 'removed': 0})
+        for folder in ('', 'attendance', 'class_balance', 'items', 'awards', 'Char0'):
+            page = self.read(folder, 'index.html')
+            self.assertEqual(gzip.decompress(self.read(folder, 'index.html.gz')), page)
+        self.assertIn(b'Char1', self.read('index.html'))
+
+    def test_export_only_rewrites_touched_characters(self):
+        export_site(self.directory)
+        self.assertEqual(export_site(self.directory)['pages'], 0)
+        Purchase(character=self.characters[1], item_name='Awesome Shiny', value=3,
+                 time=timezone.now(), is_alt=0).save()
+        self.assertEqual(export_site(self.directory)['pages'], 6)
+        self.assertIn(b'Awesome Shiny', self.read('Char1', 'index.html'))
+        self.characters[2].delete()
+        self.assertEqual(export_site(self.directory), {'pages': 5, 'removed': 1})
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'Char2')))
+        # a new dump moves everyone's attendance
+        RaidDump(value=1, attendance_value=1, award_type='Time', time=timezone.now()).save()
+        self.assertEqual(export_site(self.directory)['pages'], 7)
+
+    def test_export_worker_runs_requested_passes(self):
+        snapshot._export.update(running=True, again=True)
+        snapshot._export_worker(self.directory)
+        self.assertEqual(snapshot._export, {'running': False, 'again': False})
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'Char0', 'index.html.gz')))
+
+
+class SnapshotMiddlewareTests(SimpleTestCase):
+
+    def test_middleware_exports_after_api_writes(self):
+        started = []
+        original = snapshot.start_export
+        snapshot.start_export = started.append
+        self.addCleanup(setattr, snapshot, 'start_export', original)
+        middleware = SnapshotMiddleware(lambda request: HttpResponse())
+        factory = RequestFactory()
+        with override_settings(SNAPSHOT_DIR='/srv/snapshot'):
+            middleware(factory.get('/api/resolve_auction/'))
+            middleware(factory.post('/api/preview_auction/'))
+            middleware(factory.post('/admin/login/'))
+            self.assertEqual(started, [])
+            middleware(factory.post('/api/resolve_auction/'))
+        middleware(factory.post('/api/resolve_auction/'))
+        self.assertEqual(started, ['/srv/snapshot'])
@@ -8,6 +8,7 @@ urlpatterns = [
     path('casual/<slug:character>/', views.casual_character_dkp, name='casual_dkp'),
     # ex: /polls/5/
     path('attendance/', views.attendance_table, name='dkp'),
+    path('attendance/<str:window>/', views.attendance_table, name='attendance_window'),
     path('class_balance/', views.class_balance_table, name='class_balance'),
     path('awards/', views.awards, name='awards'),
     path('items/', views.items, name='items'),
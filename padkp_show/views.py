@@ -2,77 +2,61 @@ import datetime as dt
 from datetime import timezone
 
 from django.shortcuts import render, redirect
-from django.http import HttpResponse
+from django.http import HttpResponse, Http404, JsonResponse, StreamingHttpResponse
 from django.template import loader
+from django.core.paginator import Paginator
+from django.utils.dateparse import parse_date
+from django.utils.html import escape, format_html
+from django.utils.safestring import mark_safe
+from django.utils.http import urlencode
 
 from rest_framework import viewsets, routers
 
-from django.db.models import Sum
-from .models import Purchase, Character, RaidDump, DkpSpecialAward, CharacterAlt, Auction, AuctionBid
-from .models import CasualPurchase, CasualCharacter, CasualRaidDump, CasualDkpSpecialAward
-from .models import DON_RELEASE
+from django.db.models import Count, Q
+from .models import Purchase, Character, RaidDump, Auction, AuctionBid
+from .models import CasualCharacter
+from .models import EQ_CLASSES
+from . import ledger
+from .pagecache import versioned_page
 
 
+@versioned_page
 def index(request):
     template = loader.get_template('padkp_show/index.html')
 
-    dumps = RaidDump.objects.values(
-        'characters_present').annotate(value=Sum('value'))
-    total_earned = {x['characters_present']: x['value'] for x in dumps}
-    print(total_earned)
-
-    purchases = Purchase.objects.filter(is_alt=False).values(
-        'character').annotate(value=Sum('value'))
-    total_spent = {x['character']: x['value'] for x in purchases}
-    extra_awards = DkpSpecialAward.objects.values(
-        'character').annotate(value=Sum('value'))
-    total_extra = {x['character']: x['value'] for x in extra_awards}
-
-    alt_dumps = RaidDump.objects.filter(time__gte=DON_RELEASE).values(
-        'characters_present').annotate(value=Sum('value'))
-    alt_total_earned = {x['characters_present']: x['value'] for x in dumps}
-    alt_purchases = Purchase.objects.filter(is_alt=True).values(
-        'character').annotate(value=Sum('value'))
-    alt_total_spent = {x['character']: x['value'] for x in purchases}
-    alt_extra_awards = DkpSpecialAward.objects.filter(
-        time__gte=DON_RELEASE).values('character').annotate(value=Sum('value'))
-    alt_total_extra = {x['character']: x['value'] for x in extra_awards}
+    characters = ledger.standings()
 
     result = []
-    for character in Character.objects.all().filter(name__in=total_earned.keys()):
-        if (character.status  == 'INA' or character.inactive) and character.attendance(30) <= 0:
+    for character in characters:
+        if (character.status  == 'INA' or character.inactive) and character.attendance <= 0:
             continue
         if character.leave_of_absence or character.status == 'ALT':
             continue
-        spent = total_spent.get(character.name, 0)
-        earned = total_earned.get(character.name, 0) + \
-            total_extra.get(character.name, 0)
         result.append({'name': character.name, 'character_class': character.character_class,
-                       'character_status': character.get_status_display(), 'current_dkp': earned - spent})
-    result = sorted(result, key=lambda x: x['name'])
+                       'character_status': character.get_status_display(), 'current_dkp': character.main_dkp})
     return HttpResponse(template.render({'records': result}, request))
 
 
-def attendance_table(request):
-    template = loader.get_template('padkp_show/attendance.html')
+# attendance page windows, by their URL name. None is all time.
+ATTENDANCE_WINDOWS = [('15', 15), ('30', 30), ('60', 60), ('90', 90), ('all', None)]
 
-    dumps = RaidDump.objects.values('characters_present').annotate(
-        attendance_value=Sum('attendance_value'))
-    total_earned = {x['characters_present']                    : x['attendance_value'] for x in dumps}
 
-    extra_awards = DkpSpecialAward.objects.values(
-        'character').annotate(attendance_value=Sum('attendance_value'))
-    total_extra = {x['character']: x['attendance_value'] for x in extra_awards}
+@versioned_page
+def attendance_table(request, window='30'):
+    template = loader.get_template('padkp_show/attendance.html')
 
-    total_dumps = sum(dump.attendance_value for dump in RaidDump.objects.all())
+    windows = dict(ATTENDANCE_WINDOWS)
+    if window not in windows:
+        raise Http404('Unknown attendance window')
+    characters = ledger.standings(days=windows[window])
 
     result = []
-    for character in Character.objects.all().filter(name__in=total_earned.keys()):
+    for character in characters:
         if character.status in ['INA', 'ALT']:
             continue
         if character.inactive or character.leave_of_absence:
             continue
-        attendance = '%.1f' % (character.attendance(30))
+        attendance = '%.1f' % character.attendance
         if attendance == '0.0':
             continue
 
@@ -81,11 +65,12 @@ def attendance_table(request):
                        'attendance': attendance})
     result = sorted(result, key=lambda x: float(x['attendance']), reverse=True)
 
-    extra = {'total_dumps': total_dumps,
-             'total_earned': total_earned, 'total_extra': total_extra}
-    return HttpResponse(template.render({'records': result, 'extra': extra}, request))
+    context = {'records': result, 'window': window,
+               'windows': [name for name, _ in ATTENDANCE_WINDOWS]}
+    return HttpResponse(template.render(context, request))
 
 
+@versioned_page
 def auctions(request, auction_id):
     template = loader.get_template('padkp_show/auctions.html')
     auction = Auction.objects.get(id=auction_id)
@@ -100,98 +85,162 @@ def auctions(request, auction_id):
     return HttpResponse(template.render(context, request))
 
 
+def _timeline(family, character, since):
+    """ awards (attended and missed) and purchases since a time, newest first,
+    plus the cursor the history endpoint continues from """
+    items, _ = ledger.history(family, character, since=since, limit=None)
+    awards = [{'award': x['description'], 'present': x['present'], 'time': x['time']}
+              for x in items if x['kind'] != 'purchase']
+    purchases = [x['description'] for x in items if x['kind'] == 'purchase']
+    return awards, purchases, ledger.encode_cursor(since, ledger.MISSED, 0)
+
+
+@versioned_page
 def character_dkp(request, character):
-    display_all = 'all' in request.GET
     template = loader.get_template('padkp_show/character_page.html')
     character = character.capitalize()
-    c_obj = Character.objects.get(name=character)
-    dumps = RaidDump.objects.filter(
-        characters_present=character).aggregate(total=Sum('value'))
-    purchases = Purchase.objects.filter(
-        character=character).aggregate(total=Sum('value'))
-    extra_awards = DkpSpecialAward.objects.filter(
-        character=character).aggregate(total=Sum('value'))
-
-    alts = CharacterAlt.objects.filter(main=c_obj)
-    alt_names = [x.name for x in alts]
-    alt_string = "None." if not alt_names else ", ".join(alt_names)
-
-    current_dkp = c_obj.current_dkp()
-    alt_dkp = c_obj.current_alt_dkp()
-    attendance_30 = '%.1f' % (c_obj.attendance(30))
-
-    most_recent_date = RaidDump.objects.filter(characters_present=character).latest('time')
-    days_since_raid = None
-    if most_recent_date:
-        days_since_raid = (dt.datetime.now(timezone.utc) - most_recent_date.time).days
-
-    days_ago_30 = dt.datetime.utcnow() - dt.timedelta(days=30)
-    days_ago_14 = dt.datetime.utcnow() - dt.timedelta(days=14)
-    if display_all:
-        days_ago_30 = RaidDump.objects.filter(characters_present=character).earliest('time').time
-        days_ago_14 = days_ago_30
-    present_awards_14 = sorted([x for x in RaidDump.objects.filter(time__gte=days_ago_30, characters_present=character)] +
-                               [x for x in DkpSpecialAward.objects.filter(
-                                   time__gte=days_ago_30, character=character)],
-                               key=lambda x: x.time, reverse=True)
-    missed_awards_14 = sorted([x for x in RaidDump.objects.filter(time__gte=days_ago_30).exclude(characters_present=character)],
-                              key=lambda x: x.time, reverse=True)
-    awards_14 = [{'award': x, 'present': True} for x in present_awards_14] + \
-                [{'award': x, 'present': False} for x in missed_awards_14]
-    awards_14 = sorted(awards_14, key=lambda x: x['award'].time, reverse=True)
-
-    purchases_30 = [str(x) for x in Purchase.objects.filter(
-        time__gte=days_ago_30, character=character).order_by('-time')]
-
-    if c_obj.inactive:
-        display_rank = 'Inactive'
-    elif c_obj.leave_of_absence:
-        display_rank = 'Leave of Absence'
-    else:
-        display_rank = c_obj.get_status_display()
-
-    context = {'attendance_30': attendance_30,
-               'current_dkp': current_dkp,
-               'alt_dkp': alt_dkp,
-               'alt_string': alt_string,
-               'name': c_obj.name,
-               'character_class': c_obj.character_class,
-               'rank': display_rank,
+    profile = ledger.get_profile(character)
+    if profile is None:
+        raise Http404('No such character')
+
+    days_ago_30 = dt.datetime.now(timezone.utc) - dt.timedelta(days=30)
+    awards_14, purchases_30, older = _timeline(ledger.MAIN, character, days_ago_30)
+
+    context = {'attendance_30': '%.1f' % profile.attendance_30,
+               'current_dkp': profile.main_dkp,
+               'alt_dkp': profile.alt_dkp,
+               'alt_string': ', '.join(profile.alt_names()) or 'None.',
+               'name': character,
+               'character_class': profile.character_class,
+               'rank': profile.rank,
                'purchases_30': purchases_30,
                'awards_14': awards_14,
-               'days_since_raid': days_since_raid
+               'days_since_raid': profile.days_since_raid(),
+               'older': older,
+               'load_all': 'all' in request.GET
                }
 
     return HttpResponse(template.render(context, request))
 
 
+ITEMS_PAGE = 100
+# where all_items splits the rendered items page to stream its rows
+ITEM_ROWS = '<!-- item rows -->'
+
+
+def _date_param(request, name):
+    try:
+        return parse_date(request.GET.get(name, ''))
+    except ValueError:
+        return None
+
+
+def _time_filters(request, queryset):
+    """ queryset narrowed to the since and until query parameters (raid days as
+    YYYY-MM-DD), plus the active filters """
+    filters = {}
+    since = _date_param(request, 'since')
+    if since:
+        queryset = queryset.filter(time__gte=ledger.day_bounds(since)[0])
+        filters['since'] = since.isoformat()
+    until = _date_param(request, 'until')
+    if until:
+        try:
+            queryset = queryset.filter(time__lt=ledger.day_bounds(until)[1])
+        except OverflowError:
+            # the last representable day has no end, nothing lies past it
+            pass
+        filters['until'] = until.isoformat()
+    return queryset, filters
+
+
+def _purchase_filters(request):
+    """ purchases narrowed by the item, character, since, until (raid days as
+    YYYY-MM-DD) and alt (main or alt) query parameters, newest first, plus the
+    active filters """
+    purchases, filters = _time_filters(request, Purchase.objects.all())
+    item = request.GET.get('item', '').strip()
+    if item:
+        purchases = purchases.filter(item_name__icontains=item)
+        filters['item'] = item
+    character = request.GET.get('character', '').strip().capitalize()
+    if character:
+        purchases = purchases.filter(character=character)
+        filters['character'] = character
+    alt = request.GET.get('alt')
+    if alt in ('main', 'alt'):
+        purchases = purchases.filter(is_alt=alt == 'alt')
+        filters['alt'] = alt
+    purchases = purchases.order_by('-time', '-id').values(
+        'id', 'item_name', 'character_id', 'time', 'value', 'is_alt', 'auction_id')
+    return purchases, filters
+
+
+@versioned_page
 def items(request):
     template = loader.get_template('padkp_show/items.html')
 
-    months_ago_3 = dt.datetime.utcnow() - dt.timedelta(days=90)
-    purchases = Purchase.objects.filter(
-        time__gt=months_ago_3).order_by('-time')
-    result = list(purchases)
+    purchases, filters = _purchase_filters(request)
+    page = Paginator(purchases, ITEMS_PAGE).get_page(request.GET.get('page'))
+
+    context = {'records': page.object_list, 'page': page, 'filters': filters,
+               'query': urlencode(filters)}
+    return HttpResponse(template.render(context, request))
 
-    return HttpResponse(template.render({'records': result, 'show_all_link': True}, request))
 
+def _item_row(record):
+    if record['auction_id']:
+        item = format_html('<a href="/auctions/{}">{}</a>', record['auction_id'], record['item_name'])
+    else:
+        item = escape(record['item_name'])
+    character = record['character_id']
+    return format_html('<tr><td>{}</td><td><a href="/{}">{}</a>{}</td><td>{}</td><td>{}</td></tr>\n',
+                       item, character, character, mark_safe("'s alt") if record['is_alt'] else '',
+                       record['time'].astimezone(ledger.EASTERN).strftime('%Y-%m-%d'), record['value'])
 
+
+@versioned_page
 def all_items(request):
+    """ the whole item history, streamed row by row so memory stays flat """
     template = loader.get_template('padkp_show/items.html')
 
-    purchases = Purchase.objects.all().order_by('-time')
-    result = list(purchases)
+    purchases, filters = _purchase_filters(request)
+    head, tail = template.render({'streaming': True, 'filters': filters}, request).split(ITEM_ROWS)
+
+    def rows():
+        yield head
+        for record in purchases.iterator():
+            yield _item_row(record)
+        yield tail
+
+    return StreamingHttpResponse(rows(), content_type='text/html; charset=utf-8')
 
-    return HttpResponse(template.render({'records': result, 'show_all_link': False}, request))
 
+AWARDS_PAGE = 100
 
+
+@versioned_page
 def awards(request):
     template = loader.get_template('padkp_show/awards.html')
 
-    dumps = RaidDump.objects.all().order_by('-time')
-    result = list(dumps)
-
-    return HttpResponse(template.render({'records': result}, request))
+    dumps = RaidDump.objects.all()
+    dumps, filters = _time_filters(request, dumps)
+    award_type = request.GET.get('type')
+    if award_type in dict(RaidDump.type_choices):
+        dumps = dumps.filter(award_type=award_type)
+        filters['type'] = award_type
+    attendance = request.GET.get('attendance')
+    if attendance in ('yes', 'no'):
+        dumps = dumps.filter(attendance_value__gt=0) if attendance == 'yes' else dumps.filter(attendance_value=0)
+        filters['attendance'] = attendance
+    dumps = dumps.order_by('-time', '-id').values(
+        'id', 'time', 'award_type', 'attendance_value', 'value', 'notes').annotate(
+        headcount=Count('characters_present'))
+    page = Paginator(dumps, AWARDS_PAGE).get_page(request.GET.get('page'))
+
+    context = {'records': page.object_list, 'page': page, 'filters': filters,
+               'query': urlencode(filters), 'award_types': RaidDump.type_choices}
+    return HttpResponse(template.render(context, request))
 
 
 def rules(request):
@@ -204,109 +253,93 @@ def discord(request):
     return redirect('https://discord.gg/rxh36B6zSn')
 
 
+def _class_balance(windows):
+    """ average number of mains of each class present per raid dump over each
+    window (raid days, None for all time): one grouped query over the attendee
+    table and one counting the dumps. returns ({class: {window: average}},
+    {window: number of dumps}) """
+    starts = {days: None if days is None else ledger.day_bounds(ledger.today() - dt.timedelta(days=days - 1))[0]
+              for days in windows}
+
+    def in_window(prefix, days):
+        return Q(**{prefix + 'time__gte': starts[days]}) if starts[days] else Q()
+
+    attendees = RaidDump.characters_present.through.objects.filter(character__status=Character.MAIN)
+    if None not in starts.values():
+        attendees = attendees.filter(raiddump__time__gte=min(starts.values()))
+    counts = attendees.values('character__character_class').annotate(
+        **{'window_{}'.format(days): Count('id', filter=in_window('raiddump__', days)) for days in windows})
+    n_dumps = RaidDump.objects.aggregate(
+        **{'window_{}'.format(days): Count('id', filter=in_window('', days)) for days in windows})
+    n_dumps = {days: n_dumps['window_{}'.format(days)] for days in windows}
+
+    result = {}
+    for row in counts:
+        result[row['character__character_class']] = {
+            days: float(row['window_{}'.format(days)]) / (n_dumps[days] or 1) for days in windows}
+    return result, n_dumps
+
+
+def _window_param(request, default):
+    """ windows from a comma separated ?windows= of day counts and 'all' """
+    windows = []
+    for value in request.GET.get('windows', '').split(','):
+        value = value.strip()
+        if value == 'all':
+            windows.append(None)
+        elif value.isdigit() and 0 < int(value) <= 3650:
+            windows.append(int(value))
+    return list(dict.fromkeys(windows)) or list(default)
+
+
+@versioned_page
 def class_balance_table(request):
-    template = loader.get_template('padkp_show/classes.html')
-    days_ago_30 = dt.datetime.utcnow() - dt.timedelta(days=30)
-    days_ago_15 = dt.datetime.utcnow() - dt.timedelta(days=15)
-
-    name_class_map = {
-        c.name: c.character_class for c in Character.objects.all()}
-
-    counts = {character_class: 0 for character_class in name_class_map.values()}
-    n_dumps = 0
-
-    for dump in RaidDump.objects.filter(time__gte=days_ago_15):
-        n_dumps += 1
-        for character in dump.characters_present.all():
-            if character.status == 'MN':
-                counts[character.character_class] += 1
-    class_counts_15 = {}
-    for character_class, count in counts.items():
-        class_counts_15[character_class] = '%.1f' % (float(count) / n_dumps)
-
-    counts = {character_class: 0 for character_class in name_class_map.values()}
-    n_dumps = 0
-
-    for dump in RaidDump.objects.filter(time__gte=days_ago_30):
-        n_dumps += 1
-        for character in dump.characters_present.all():
-            if character.status == 'MN':
-                counts[character.character_class] += 1
-    class_counts_30 = {}
-    for character_class, count in counts.items():
-        class_counts_30[character_class] = '%.1f' % (float(count) / n_dumps)
+    windows = _window_param(request, (15, 30))
+    counts, n_dumps = _class_balance(windows)
+    classes = sorted((set(EQ_CLASSES) | set(counts)) - {'Shadow', 'Unknown'})
 
-    result = []
-    for character_class in counts:
-        if character_class in ['Shadow', 'Unknown']:
-            continue
-        result.append({'character_class': character_class,
-                       'counts_30': class_counts_30[character_class],
-                       'counts_15': class_counts_15[character_class]}
-                      )
-    result = sorted(result, key=lambda record: record['character_class'])
-    totals = {'total_30':  '%.1f' % sum(float(x['counts_30']) for x in result),
-              'total_15':  '%.1f' % sum(float(x['counts_15']) for x in result)}
+    def label(days):
+        return 'all' if days is None else str(days)
 
-    return HttpResponse(template.render({'records': result, 'totals': totals}, request))
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'windows': [label(days) for days in windows],
+            'dumps': {label(days): n_dumps[days] for days in windows},
+            'classes': {c: {label(days): counts.get(c, {}).get(days, 0) for days in windows}
+                        for c in classes},
+        })
+
+    template = loader.get_template('padkp_show/classes.html')
+    result = [{'character_class': c,
+               'counts': ['%.1f' % counts.get(c, {}).get(days, 0) for days in windows]}
+              for c in classes]
+    totals = ['%.1f' % sum(counts.get(c, {}).get(days, 0) for c in classes) for days in windows]
+    context = {'records': result, 'totals': totals,
+               'windows': ['all time' if days is None else '{} days'.format(days) for days in windows]}
+    return HttpResponse(template.render(context, request))
 
 
+@versioned_page
 def casual_index(request):
     template = loader.get_template('padkp_show/casual_index.html')
 
-    dumps = CasualRaidDump.objects.values(
-        'characters_present').annotate(value=Sum('value'))
-    total_earned = {x['characters_present']: x['value'] for x in dumps}
-    print(total_earned)
-
-    purchases = CasualPurchase.objects.values(
-        'character').annotate(value=Sum('value'))
-    total_spent = {x['character']: x['value'] for x in purchases}
-    print(total_spent)
-    extra_awards = CasualDkpSpecialAward.objects.values(
-        'character').annotate(value=Sum('value'))
-    total_extra = {x['character']: x['value'] for x in extra_awards}
-
-    result = []
-    for character in CasualCharacter.objects.all():
-        spent = total_spent.get(character.name, 0)
-        earned = total_earned.get(character.name, 0) + \
-            total_extra.get(character.name, 0)
-        result.append({'name': character.name,
-                       'character_class': character.character_class,
-                       'current_dkp': earned - spent})
+    result = [{'name': character.name,
+               'character_class': character.character_class,
+               'current_dkp': character.main_dkp}
+              for character in ledger.standings(CasualCharacter.objects.all(), family=ledger.CASUAL)]
     result = sorted(result, key=lambda x: x['name'])
     return HttpResponse(template.render({'records': result}, request))
 
 
+@versioned_page
 def casual_character_dkp(request, character):
     template = loader.get_template('padkp_show/casual_character_page.html')
     character = character.capitalize()
     c_obj = CasualCharacter.objects.get(name=character)
-    dumps = CasualRaidDump.objects.filter(
-        characters_present=character).aggregate(total=Sum('value'))
-    purchases = CasualPurchase.objects.filter(
-        character=character).aggregate(total=Sum('value'))
-    extra_awards = CasualDkpSpecialAward.objects.filter(
-        character=character).aggregate(total=Sum('value'))
-
-    current_dkp = (dumps['total'] or 0) \
-        + (extra_awards['total'] or 0) \
-        - (purchases['total'] or 0)
-
-    days_ago_30 = dt.datetime.utcnow() - dt.timedelta(days=30)
-    present_awards_30 = sorted([x for x in CasualRaidDump.objects.filter(time__gte=days_ago_30, characters_present=character)] +
-                               [x for x in CasualDkpSpecialAward.objects.filter(
-                                   time__gte=days_ago_30, character=character)],
-                               key=lambda x: x.time, reverse=True)
-    missed_awards_30 = sorted([x for x in CasualRaidDump.objects.filter(time__gte=days_ago_30).exclude(characters_present=character)],
-                              key=lambda x: x.time, reverse=True)
-    awards_30 = [{'award': x, 'present': True} for x in present_awards_30] + \
-                [{'award': x, 'present': False} for x in missed_awards_30]
-    awards_30 = sorted(awards_30, key=lambda x: x['award'].time, reverse=True)
-
-    purchases_30 = [str(x) for x in CasualPurchase.objects.filter(
-        time__gte=days_ago_30, character=character).order_by('-time')]
+    current_dkp = c_obj.current_dkp()
+
+    days_ago_30 = dt.datetime.now(timezone.utc) - dt.timedelta(days=30)
+    awards_30, purchases_30, _ = _timeline(ledger.CASUAL, character, days_ago_30)
 
     context = {
         'current_dkp': current_dkp,